@@ -26,6 +26,7 @@ import config
 from deb.version import Version
 from merge_report import (read_report, MergeResult)
 from model import Distro, OBSDistro
+from model.changes import ChangeTracker, package_filter
 from util import run
 from util.tree import subdir
 
@@ -46,6 +47,8 @@ def options(parser):
 def main(options, args):
     logger.debug('Committing merges...')
 
+    wanted = package_filter(options)
+    failed = set()
     for target in config.targets(args):
         d = target.distro
 
@@ -54,7 +57,7 @@ def main(options, args):
             continue
 
         for package in d.packages(target.dist, target.component):
-            if options.package and package.name not in options.package:
+            if not wanted(package.name):
                 logger.debug('Skipping package %s: not selected', package.name)
                 continue
 
@@ -118,6 +121,8 @@ def main(options, args):
                     project = d.obsProject(target.dist, target.component)
                     update_report(report, output_dir, True,
                                   committed_to=project)
+                if commit_failed(report):
+                    failed.add(package.name)
                 continue
 
             # else we need to branch it and commit to the branch
@@ -261,6 +266,21 @@ def main(options, args):
                 update_report(report, output_dir, False,
                               "Failed to branch: %s" % e.__class__.__name__)
 
+            if commit_failed(report):
+                failed.add(package.name)
+
+    if failed:
+        logger.warning('Failed to commit %d packages: %s', len(failed),
+                       ', '.join(sorted(failed)))
+        # Try them again next time, even if nothing changes
+        ChangeTracker().defer(failed)
+
+
+def commit_failed(report):
+    # Return whether committing the merge was tried and failed, last time
+    # if not this time
+    return not report['committed'] and report['commit_detail'] is not None
+
 
 def update_report(report, output_dir, committed, message=None,
                   request_url=None, committed_to=None):
@@ -131,6 +131,12 @@ class Source(object):
     def __repr__(self):
         return "Source(%s, %s)" % (self._distro, self._dist)
 
+    def findNewest(self, name):
+        """Return the newest version of the given package in this source
+        as a PackageVersion, or None if it isn't there.
+        """
+        return self._distro.findNewest(name, self._dist)
+
     def __eq__(self, other):
         return self._distro == other._distro and self._dist == other._dist
 
@@ -171,6 +177,18 @@ class SourceList(object):
     def __repr__(self):
         return repr(self._sources)
 
+    def findNewest(self, name):
+        """Return the newest version of the given package in any of these
+        sources (the first, if several have it) as a PackageVersion, or
+        None if none of them have it.
+        """
+        newest = None
+        for s in self._sources:
+            possible = s.findNewest(name)
+            if possible is not None and (newest is None or possible > newest):
+                newest = possible
+        return newest
+
     def findPackage(self, name, version=None):
         for s in self._sources:
             try:
@@ -20,6 +20,8 @@
 from __future__ import with_statement
 
 import gzip
+import mmap
+import os
 
 
 class ControlFile(object):
@@ -43,6 +45,7 @@ class ControlFile(object):
         self.paras = []
         self.para = None
         self.signed = False
+        self._canonical = {}
 
         if fileobj is not None:
             self.parse(fileobj, *args, **kwds)
@@ -59,11 +62,19 @@ class ControlFile(object):
         This can be overriden by adding the canonical capitalisation
         of a field name to the FieldNames list.
         """
+        try:
+            return self._canonical[field]
+        except KeyError:
+            pass
+
         for canon in self.FieldNames:
             if canon.lower() == field.lower():
-                return canon
+                break
+        else:
+            canon = "-".join([w.title() for w in field.split("-")])
 
-        return "-".join([w.title() for w in field.split("-")])
+        self._canonical[field] = canon
+        return canon
 
     def open(self, file, *args, **kwds):
         """Open and parse a control-file format file."""
@@ -74,6 +85,135 @@ class ControlFile(object):
             with open(file) as f:
                 self.parse(f, *args, **kwds)
 
+    def iter_paras(self, file, fields=None):
+        """Iterate over the paragraphs of a multi-paragraph control file.
+
+        File is either a filename, which is opened as open() does, or
+        any object that acts as an iterator and returns lines.
+
+        Each paragraph is yielded as a dictionary as soon as it has been
+        read, and is not kept in the paras list, so the whole file need
+        never be held in memory.  If fields is given, only those fields
+        (canonically capitalised) are kept in each dictionary.
+
+        PGP signatures are not supported in this mode.
+        """
+        if isinstance(file, basestring):
+            if file[-3:] == ".gz":
+                fd = gzip.open(file)
+            else:
+                fd = open(file)
+            with fd:
+                for para in self.iter_paras(fd, fields):
+                    yield para
+            return
+
+        if fields is not None:
+            fields = frozenset(fields)
+
+        canonical = self._canonical
+        para = {}
+        last_field = None
+        lines = None
+
+        for line in file:
+            line = line.rstrip()
+            if line.startswith("#"):
+                continue
+
+            if line[:1].isspace():
+                if last_field is None:
+                    raise IOError
+
+                if lines is not None:
+                    lines.append(line.lstrip())
+
+            elif ":" in line:
+                if lines is not None:
+                    para[last_field] = "\n".join(lines)
+
+                (field, value) = line.split(":", 1)
+                try:
+                    last_field = canonical[field]
+                except KeyError:
+                    if len(field.rstrip().split(None)) > 1:
+                        raise IOError
+                    last_field = self.capitaliseField(field)
+
+                if fields is None or last_field in fields:
+                    lines = [value.lstrip()]
+                else:
+                    lines = None
+
+            elif not len(line):
+                if last_field is None:
+                    continue
+
+                if lines is not None:
+                    para[last_field] = "\n".join(lines)
+                yield para
+                para = {}
+                last_field = None
+                lines = None
+
+            else:
+                raise IOError
+
+        if last_field is not None:
+            if lines is not None:
+                para[last_field] = "\n".join(lines)
+            yield para
+
+    def map_paras(self, filename, keys=("Package", "Version"), spans=None):
+        """Memory-map a multi-paragraph control file.
+
+        Return a MappedParagraph for each paragraph.  Only the offset and
+        length of each paragraph and the values of the given (single-line)
+        key fields are read up front; the paragraph is decoded on first
+        access to any other field.
+
+        The file is scanned to find the paragraphs, unless spans, the
+        MappedParagraph.span of each paragraph from an earlier call on an
+        identical file with the same keys, is given.  The file must not be
+        compressed or modified in place while it is mapped.
+        """
+        keys = tuple(keys)
+        with open(filename, 'rb') as fd:
+            if os.fstat(fd.fileno()).st_size == 0:
+                return []
+            mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if spans is not None:
+            return [MappedParagraph(self, mapped, offset, length, keys, values)
+                    for (offset, length, values) in spans]
+
+        paras = []
+        start = None
+        values = None
+        pos = 0
+        while True:
+            line = mapped.readline()
+            if not len(line) or not len(line.strip()):
+                if start is not None:
+                    paras.append(MappedParagraph(self, mapped, start,
+                                                 pos - start, keys,
+                                                 tuple(values)))
+                    start = None
+                if not len(line):
+                    break
+            elif not line.startswith("#"):
+                if start is None:
+                    start = pos
+                    values = [None] * len(keys)
+                if not line[:1].isspace() and ":" in line:
+                    (field, value) = line.split(":", 1)
+                    field = self.capitaliseField(field)
+                    if field in keys:
+                        values[keys.index(field)] = value.strip()
+            pos += len(line)
+
+        return paras
+
     def parse(self, file, multi_para=False, signed=False):
         """Parse a control-file format file.
 
@@ -158,3 +298,86 @@ class ControlFile(object):
             self.paras.append(self.para)
         elif len(self.paras):
             self.para = self.paras[-1]
+
+
+class MappedParagraph(object):
+    """A paragraph of a memory-mapped control file.
+
+    This acts like the read-only dictionary that parsing the paragraph
+    would give, but only the key fields given to ControlFile.map_paras()
+    are held in memory until another field is accessed.
+    """
+
+    __slots__ = ('_controlfile', '_mapped', '_offset', '_length', '_keys',
+                 '_values', '_fields')
+
+    def __init__(self, controlfile, mapped, offset, length, keys, values):
+        self._controlfile = controlfile
+        self._mapped = mapped
+        self._offset = offset
+        self._length = length
+        self._keys = keys
+        self._values = values
+        self._fields = None
+
+    @property
+    def span(self):
+        """Return (offset, length, key values) for ControlFile.map_paras()."""
+        return (self._offset, self._length, self._values)
+
+    def decode(self):
+        """Return the paragraph as a dictionary, parsing it if necessary."""
+        if self._fields is None:
+            text = self._mapped[self._offset:self._offset + self._length]
+            for para in self._controlfile.iter_paras(text.splitlines(True)):
+                self._fields = para
+                break
+            else:
+                self._fields = {}
+        return self._fields
+
+    def __getitem__(self, field):
+        if self._fields is None and field in self._keys:
+            value = self._values[self._keys.index(field)]
+            if value is not None:
+                return value
+        return self.decode()[field]
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def __contains__(self, field):
+        try:
+            self[field]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __len__(self):
+        return len(self.decode())
+
+    def keys(self):
+        return self.decode().keys()
+
+    def items(self):
+        return self.decode().items()
+
+    def iteritems(self):
+        return self.decode().iteritems()
+
+    def __eq__(self, other):
+        if isinstance(other, MappedParagraph):
+            other = other.decode()
+        return self.decode() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.decode())
@@ -30,6 +30,17 @@ valid_revision = re.compile(r'^[A-Za-z0-9+.~]+$')
 # Character comparison table for upstream and revision components
 cmp_table = "~ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz+-.:"
 
+# Comparison order of each character, with "~" sorting before the end of
+# the string (which has order 0)
+cmp_order = dict((c, i) for (i, c) in enumerate(cmp_table))
+cmp_order["~"] = -1
+
+# Splits a version component into (non-digit, digit) runs
+cmp_parts = re.compile(r'([^0-9]*)([0-9]*)')
+
+# The sort key of an exhausted component: an empty string followed by zero
+cmp_end = ((0,), 0)
+
 
 class Version(object):
     """Debian version number.
@@ -48,44 +59,79 @@ class Version(object):
       revision    Debian/local revision
     """
 
-    def __init__(self, ver):
-        """Parse a string or number into the three components."""
-        self.epoch = None
-        self.upstream = None
-        self.revision = None
+    __slots__ = ('epoch', 'upstream', 'revision', '_key', '_str')
+
+    # Every Version ever constructed, by the string it was constructed from
+    _interned = {}
+
+    def __new__(cls, ver):
+        """Parse a string or number into the three components.
+
+        Versions are immutable, so constructing the same string twice
+        returns the same object.
+        """
+        if isinstance(ver, Version):
+            return ver
 
         ver = str(ver)
+        try:
+            return cls._interned[ver]
+        except KeyError:
+            pass
+
+        text = ver
+        epoch = None
+        revision = None
+
         if not len(ver):
             raise ValueError
 
         # Epoch is component before first colon
         idx = ver.find(":")
         if idx != -1:
-            self.epoch = ver[:idx]
-            if not len(self.epoch):
+            epoch = ver[:idx]
+            if not len(epoch):
                 raise ValueError
-            if not valid_epoch.search(self.epoch):
+            if not valid_epoch.search(epoch):
                 raise ValueError
-            self.epoch = int(self.epoch)
+            epoch = int(epoch)
             ver = ver[idx+1:]
 
         # Revision is component after last hyphen
         idx = ver.rfind("-")
         if idx != -1:
-            self.revision = ver[idx+1:]
-            if not len(self.revision):
+            revision = ver[idx+1:]
+            if not len(revision):
                 raise ValueError
-            if not valid_revision.search(self.revision):
+            if not valid_revision.search(revision):
                 raise ValueError
             ver = ver[:idx]
 
         # Remaining component is upstream
-        self.upstream = ver
-        if not len(self.upstream):
+        upstream = ver
+        if not len(upstream):
             raise ValueError
-        if not valid_upstream.search(self.upstream):
+        if not valid_upstream.search(upstream):
             raise ValueError("%s is not a valid upstream version"
-                             % self.upstream)
+                             % upstream)
+
+        self = object.__new__(cls)
+        object.__setattr__(self, 'epoch', epoch)
+        object.__setattr__(self, 'upstream', upstream)
+        object.__setattr__(self, 'revision', revision)
+        object.__setattr__(self, '_key', (epoch or 0, deb_key(upstream),
+                                          deb_key(revision or "")))
+        object.__setattr__(self, '_str', None)
+        return cls._interned.setdefault(text, self)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Version objects are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Version objects are immutable")
+
+    def __reduce__(self):
+        return (Version, (str(self),))
 
     def getWithoutEpoch(self):
         """Return the version without the epoch."""
@@ -98,13 +144,15 @@ class Version(object):
 
     def __str__(self):
         """Return the class as a string for printing."""
-        str = ""
-        if self.epoch is not None:
-            str += "%d:" % (self.epoch,)
-        str += self.upstream
-        if self.revision is not None:
-            str += "-%s" % (self.revision,)
-        return str
+        if self._str is None:
+            str = ""
+            if self.epoch is not None:
+                str += "%d:" % (self.epoch,)
+            str += self.upstream
+            if self.revision is not None:
+                str += "-%s" % (self.revision,)
+            object.__setattr__(self, '_str', str)
+        return self._str
 
     def __repr__(self):
         """Return a debugging representation of the object."""
@@ -114,24 +162,47 @@ class Version(object):
 
     def __cmp__(self, other):
         """Compare two Version classes."""
-        other = Version(other)
-
-        result = cmp(self.epoch, other.epoch)
-        if result != 0:
-            return result
-
-        result = deb_cmp(self.upstream, other.upstream)
-        if result != 0:
-            return result
-
-        result = deb_cmp(self.revision or "", other.revision or "")
-        if result != 0:
-            return result
-
-        return 0
+        if not isinstance(other, Version):
+            other = Version(other)
+        return cmp(self._key, other._key)
+
+    def __eq__(self, other):
+        if not isinstance(other, Version):
+            other = Version(other)
+        return self._key == other._key
+
+    def __ne__(self, other):
+        if not isinstance(other, Version):
+            other = Version(other)
+        return self._key != other._key
+
+    def __lt__(self, other):
+        if not isinstance(other, Version):
+            other = Version(other)
+        return self._key < other._key
+
+    def __le__(self, other):
+        if not isinstance(other, Version):
+            other = Version(other)
+        return self._key <= other._key
+
+    def __gt__(self, other):
+        if not isinstance(other, Version):
+            other = Version(other)
+        return self._key > other._key
+
+    def __ge__(self, other):
+        if not isinstance(other, Version):
+            other = Version(other)
+        return self._key >= other._key
 
     def __hash__(self):
-        return hash((self.epoch, self.upstream, self.revision))
+        return hash(self._key)
+
+    @property
+    def sort_key(self):
+        """A tuple that orders the same way as this version."""
+        return self._key
 
     def base(self, slip=False):
         def strip_suffix(text, suffix):
@@ -157,24 +228,68 @@ class Version(object):
         return Version(v)
 
 
+def sort_versions(items, key=None):
+    """Sort a list of Versions in place, oldest first.
+
+    If key is given, the list contains other objects (such as
+    PackageVersions) and key returns the Version of each.
+    """
+    if key is None:
+        items.sort(key=lambda v: v._key)
+    else:
+        items.sort(key=lambda x: key(x)._key)
+
+
+def max_version(items, key=None):
+    """Return the newest of a non-empty sequence of Versions, or of other
+    objects whose Version is returned by key.
+    """
+    if key is None:
+        return max(items, key=lambda v: v._key)
+    else:
+        return max(items, key=lambda x: key(x)._key)
+
+
+def deb_key(str):
+    """Return a tuple that sorts like str under deb_cmp().
+
+    Each (non-digit, digit) run becomes a pair of the character orders
+    (terminated by the order of the end of the string) and the number.
+    Trailing runs that compare equal to an exhausted string are dropped,
+    and two end markers are appended so that a shorter component compares
+    against the rest of a longer one exactly as deb_cmp() does; two are
+    needed because only a leading run can equal the end marker.
+    """
+    parts = []
+    for (chars, digits) in cmp_parts.findall(str):
+        if not chars and not digits:
+            continue
+        parts.append((tuple([cmp_order[c] for c in chars]) + (0,),
+                      int(digits or "0")))
+
+    while parts and parts[-1] == cmp_end:
+        parts.pop()
+
+    parts.append(cmp_end)
+    parts.append(cmp_end)
+    return tuple(parts)
+
+
 def strcut(str, idx, accept):
     """Cut characters from str that are entirely in accept."""
-    ret = ""
-    while idx < len(str) and str[idx] in accept:
-        ret += str[idx]
-        idx += 1
+    end = idx
+    while end < len(str) and str[end] in accept:
+        end += 1
 
-    return (ret, idx)
+    return (str[idx:end], end)
 
 
 def deb_order(str, idx):
     """Return the comparison order of two characters."""
     if idx >= len(str):
         return 0
-    elif str[idx] == "~":
-        return -1
     else:
-        return cmp_table.index(str[idx])
+        return cmp_order[str[idx]]
 
 
 def deb_cmp_str(x, y):
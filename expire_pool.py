@@ -21,11 +21,12 @@ import errno
 import logging
 
 import config
-from model.base import Distro
+from deb.version import max_version
+from model.base import Distro, sha256sums
 from model.error import PackageNotFound
 from merge_report import (read_report, MergeResult)
 from momlib import *
-from util import tree, run
+from util import run
 
 logger = logging.getLogger('expire_pool')
 
@@ -82,6 +83,10 @@ def main(options, args):
                         except PackageNotFound:
                             continue
 
+    # Collect any blobs whose pool files went some other way
+    (count, freed) = Distro.blobStore().collect()
+    logger.info("Removed %d unused blobs (%d bytes)", count, freed)
+
 
 def expire_pool_sources(pkg, base):
     """Remove sources older than the given base.
@@ -109,8 +114,8 @@ def expire_pool_sources(pkg, base):
 
     # If the base wasn't found, we want the newest source below that
     if not base_found and len(bases):
-        version_sort(bases)
-        pv = bases.pop()
+        pv = max_version(bases, key=lambda x: x.version)
+        bases.remove(pv)
         logger.info("Leaving %s (is newest before base)", pv)
 
         keep.append(pv)
@@ -119,23 +124,36 @@ def expire_pool_sources(pkg, base):
     keep_files = []
     for pv in keep:
         if has_files(pv):
-            for md5sum, size, name in files(pv.getDscContents()):
+            for md5sum, size, name in files(pv.getPoolEntry()):
                 keep_files.append(name)
 
-    # Expire the older packages
+    # Expire the older packages, along with their blobs unless another
+    # pool still links to them
+    blobs = Distro.blobStore()
+    index = pkg.distro.getPoolIndex(pkg.component)
     need_update = False
     for pv in bases:
         logger.info("Expiring %s", pv)
 
-        for md5sum, size, name in files(pv.getDscContents()):
+        entry = pv.getPoolEntry()
+        sums = sha256sums(entry)
+        for md5sum, size, name in files(entry):
             if name in keep_files:
                 logger.debug("Not removing %s/%s", pooldir, name)
                 continue
 
-            tree.remove("%s/%s" % (pooldir, name))
+            blobs.release("%s/%s" % (pooldir, name), sums.get(name))
             logger.debug("Removed %s/%s", pooldir, name)
             need_update = True
 
+        # Without its files the .dsc is no use, and leaving it behind
+        # would bring the version back if the index is rebuilt
+        blobs.release(pv.dscPath)
+        index.forget(pkg.name, pv.version)
+
+        # Nor is the copy of its changelog kept by source_changelog()
+        cleanup(changelog_file(pv))
+
 
 if __name__ == "__main__":
     run(main, usage="%prog [DISTRO...]",
@@ -23,6 +23,7 @@ import logging
 import config
 from momlib import *
 from model.base import (Distro, PackageVersion)
+from model.changes import package_filter
 from util import tree, run
 
 logger = logging.getLogger('generate_diffs')
@@ -40,36 +41,30 @@ def main(options, args):
     # For latest version of each package in the given distributions, iterate
     # the pool in order and generate a diff from the previous version and a
     # changes file
+    wanted = package_filter(options)
     for target in config.targets(args):
         d = target.distro
         for pkg in d.packages(target.dist, target.component):
-            if options.package and pkg.name not in options.package:
+            if not wanted(pkg.name):
                 continue
             if pkg.name in target.blacklist:
                 logger.debug("%s is blacklisted, skipping", source['Package'])
                 continue
 
             pvs = pkg.getPoolVersions()
-            pvs.sort()
+            version_sort(pvs)
 
             last = None
-            try:
-                for pv in pvs:
-                    try:
-                        generate_diff(last, pv)
-                    except model.error.PackageNotFound:
-                        logger.exception("Could not find a package to diff "
-                                         "against.")
-                    except ValueError:
-                        logger.exception("Could not find a .dsc file, "
-                                         "perhaps it moved components?")
-                    finally:
-                        if last is not None:
-                            cleanup_source(pv)
-                    last = pv
-            finally:
-                if last is not None:
-                    cleanup_source(pv)
+            for pv in pvs:
+                try:
+                    generate_diff(last, pv)
+                except model.error.PackageNotFound:
+                    logger.exception("Could not find a package to diff "
+                                     "against.")
+                except ValueError:
+                    logger.exception("Could not find a .dsc file, "
+                                     "perhaps it moved components?")
+                last = pv
 
 
 def generate_diff(last, this):
@@ -92,17 +87,25 @@ def generate_diff(last, this):
         except (ValueError, OSError):
             logger.error("dpkg-genchanges for %s failed",
                          tree.subdir(config.get('ROOT'), changes_filename))
+        finally:
+            cleanup_source(this)
 
     logger.debug("Producing diff from %s to %s", this, last)
     diff_filename = diff_file(this.package.distro.name, this)
     if not os.path.isfile(diff_filename) \
             and not os.path.isfile(diff_filename + ".bz2"):
         unpack_source(this)
-        unpack_source(last)
-        save_patch_file(diff_filename, last, this)
-        save_basis(diff_filename, last.version)
-        logger.info("Saved diff file: %s", tree.subdir(config.get('ROOT'),
-                                                       diff_filename))
+        try:
+            unpack_source(last)
+            try:
+                save_patch_file(diff_filename, last, this)
+                save_basis(diff_filename, last.version)
+                logger.info("Saved diff file: %s",
+                            tree.subdir(config.get('ROOT'), diff_filename))
+            finally:
+                cleanup_source(last)
+        finally:
+            cleanup_source(this)
 
 
 if __name__ == "__main__":
@@ -22,6 +22,7 @@ import logging
 
 import config
 from model import Distro
+from model.changes import package_filter
 import model.error
 from momlib import *
 from util import tree, run
@@ -38,17 +39,18 @@ def options(parser):
 def main(options, args):
     logger.info('Extracting debian/patches from packages...')
 
+    wanted = package_filter(options)
     for target in config.targets(args):
         d = target.distro
         for pkg in d.packages(target.dist, target.component):
-            if options.package and pkg.name not in options.package:
+            if not wanted(pkg.name):
                 continue
             if pkg.name in target.blacklist:
                 logger.debug("%s is blacklisted,skipping", source['Package'])
                 continue
 
             pvs = pkg.getPoolVersions()
-            pvs.sort()
+            version_sort(pvs)
             for pv in pvs:
                 try:
                     generate_dpatch(d.name, pv)
@@ -59,10 +59,19 @@ def generate_patch(base, distro, ours,
     if not os.path.exists(filename):
         if not unpacked:
             unpack_source(base)
-            unpack_source(ours)
+            try:
+                unpack_source(ours)
+            except Exception:
+                cleanup_source(base)
+                raise
 
-        tree.ensure(filename)
-        save_patch_file(filename, base, ours)
-        save_basis(filename, base.version)
-        logging.info("Saved patch file: %s", tree.subdir(config.get('ROOT'),
-                                                         filename))
+        try:
+            tree.ensure(filename)
+            save_patch_file(filename, base, ours)
+            save_basis(filename, base.version)
+            logging.info("Saved patch file: %s",
+                         tree.subdir(config.get('ROOT'), filename))
+        finally:
+            if not unpacked:
+                cleanup_source(ours)
+                cleanup_source(base)
@@ -29,6 +29,8 @@ import expire_pool
 import generate_diffs
 import generate_dpatches
 import merge_status
+from model.changes import ChangeTracker
+from momlib import unpack_cache
 from momversion import VERSION
 import notify_action_needed
 import publish_patches
@@ -47,6 +49,8 @@ def options(parser):
     parser.add_option("-d", "--dry-run", action="store_true",
                       help="Don't actually fiddle with OBS, just print what "
                       "would've happened.")
+    parser.add_option("-j", "--jobs", type="int", metavar="N", default=1,
+                      help="Handle up to N packages at once where possible")
 
 
 def main(options, args):
@@ -57,7 +61,6 @@ def main(options, args):
     ROOT = config.get('ROOT')
     lockdir = "%s/.lock" % ROOT
     codedir = os.path.abspath(os.path.dirname(__file__))
-    unpackeddir = "%s/unpacked" % ROOT
 
     # Some modules assume we're already here
     os.chdir(ROOT)
@@ -68,6 +71,7 @@ def main(options, args):
     options.version = None
     options.source_distro = None
     options.source_suite = None
+    options.debsnap_offline = False
     try:
         os.umask(002)
         try:
@@ -111,14 +115,17 @@ def main(options, args):
         # Expire any old packages from the pool
         expire_pool.main(options, args)
 
-        # ?! untidy
+        # Every stage has now seen the changes found by update_sources,
+        # unless this run was limited to some packages or targets
+        if not options.package and not options.target and not args:
+            ChangeTracker().finish()
+
+        # Let go of whatever the stages left unpacked, other than what
+        # fits in the cache for next time
         try:
-            for entry in os.listdir(unpackeddir):
-                p = "%s/%s" % (unpackeddir, entry)
-                logger.debug('Removing unpacked directory %s', p)
-                shutil.rmtree(p)
+            unpack_cache().trim()
         except Exception as e:
-            logger.debug('Cancelling removal of unpacked directories: %r', e)
+            logger.debug('Cancelling trimming of unpacked sources: %r', e)
 
     finally:
         try:
@@ -1,19 +1,25 @@
+import fcntl
 from glob import glob
 import gzip
 import json
 import logging
+import marshal
 import os
 from os import path
-import urllib2
+import sqlite3
+import threading
 
 import apt
 import apt_pkg
 
 import config
 from deb.controlfile import ControlFile
-from deb.version import Version
+from deb.version import Version, max_version, sort_versions
 import error
-from util import tree, pathhash, shell
+from util import tree, pathhash, sha256sum, shell
+from util.aptlists import SourcesFetcher
+from util.blobstore import BlobStore
+from util.download import Downloader, DEFAULT_JOBS, DEFAULT_TIMEOUT
 
 logger = logging.getLogger('model.base')
 
@@ -23,6 +29,10 @@ class Distro(object):
     such as "debian" or "ubuntu", and for temporary distribution branches.
     """
     SOURCES_CACHE = {}
+    NEWEST_CACHE = {}
+    DOWNLOADERS = {}
+    # Guards the above, which update_sources shares between threads
+    _cacheLock = threading.RLock()
 
     @staticmethod
     def all():
@@ -46,18 +56,12 @@ class Distro(object):
         return '<%s "%s">' % (self.__class__.__name__, self.name)
 
     def newestPackageVersions(self, dist, component):
-        sources = self.getSources(dist, component)
-        newest = {}
-        for source in sources:
-            package = source["Package"]
-            version = Version(source['Version'])
-            if package not in newest or version > newest[package]:
-                newest[package] = version
+        index = self.getSourcesIndex(dist, component)
 
         ret = []
-        for name in sorted(newest.keys()):
+        for name in index.names():
             pkg = Package(self, dist, component, name)
-            ret.append(PackageVersion(pkg, newest[name]))
+            ret.append(PackageVersion(pkg, index.newestVersion(name)))
 
         return ret
 
@@ -86,6 +90,26 @@ class Distro(object):
         """Return the absolute URL of the top of the mirror"""
         return self.config("mirror")
 
+    def downloader(self):
+        """Return the Downloader used to fetch files from the mirror.
+
+        It downloads up to DISTROS[name]["download_jobs"] files at once,
+        gives up on a mirror that doesn't answer within DOWNLOAD_TIMEOUT
+        seconds, and keeps its connections to the mirror open between calls.
+        """
+        with Distro._cacheLock:
+            if self.name not in Distro.DOWNLOADERS:
+                jobs = self.config("download_jobs") or DEFAULT_JOBS
+                timeout = config.get("DOWNLOAD_TIMEOUT",
+                                     default=DEFAULT_TIMEOUT)
+                Distro.DOWNLOADERS[self.name] = Downloader(jobs, timeout)
+            return Distro.DOWNLOADERS[self.name]
+
+    @staticmethod
+    def blobStore():
+        """Return the BlobStore that the pools of all distros link into."""
+        return BlobStore("%s/blobs" % config.get('ROOT'))
+
     def downloadPackage(self, dist, component, package=None, version=None):
         """Populate the 'pool' directory by downloading Debian source packages
         from the given release and component.
@@ -106,13 +130,15 @@ class Distro(object):
                          package, self, dist, component, self)
 
         mirror = self.mirrorURL()
-        sources = self.getSources(dist, component)
+        if package is None:
+            sources = self.getSources(dist, component)
+        else:
+            sources = self.getSourcesIndex(dist, component).stanzas(package)
 
-        changed = False
+        blobs = Distro.blobStore()
+        downloads = []
 
         for source in sources:
-            if package != source["Package"] and not (package is None):
-                continue
             if package is not None and version is not None \
                     and source["Version"] != str(version):
                 continue
@@ -120,30 +146,45 @@ class Distro(object):
             sourcedir = source["Directory"]
 
             pkg = self.package(dist, component, source['Package'])
+            sums = sha256sums(source)
             for md5sum, size, name in files(source):
                 url = "%s/%s/%s" % (mirror, sourcedir, name)
                 filename = "%s/%s" % (pkg.poolPath, name)
 
                 if os.path.isfile(filename):
-                    if os.path.getsize(filename) == int(size):
+                    st = os.stat(filename)
+                    if st.st_size == int(size) and (
+                            st.st_nlink > 1 or name not in sums or
+                            self._addToBlobStore(blobs, filename, sums[name])):
                         logger.debug("Skipping %s, already downloaded.",
                                      filename)
                         continue
 
-                logger.debug("Downloading %s", url)
-                changed = True
-                tree.ensure(filename)
-                with open(filename, 'w') as fd:
-                    try:
-                        dl = urllib2.urlopen(url)
-                        fd.write(dl.read())
-                    except IOError:
-                        logger.error("Downloading %s failed", url)
-                        raise
-                logger.debug("Saved %s",
-                             tree.subdir(config.get('ROOT'), filename))
-
-        return changed
+                downloads.append((url, filename, size, sums.get(name)))
+
+        try:
+            self.downloader().fetch_all(downloads, blobs)
+        except IOError, e:
+            logger.error("Downloading from %s failed: %s", mirror, e)
+            raise
+        for download in downloads:
+            logger.debug("Saved %s",
+                         tree.subdir(config.get('ROOT'), download[1]))
+            if download[1].endswith('.dsc'):
+                self.getPoolIndex(component).record(download[1])
+
+        return len(downloads) > 0
+
+    @staticmethod
+    def _addToBlobStore(blobs, filename, sha256):
+        """Add a pool file that was downloaded before the blob store
+        existed to it, or return False if it turns out to be corrupt.
+        """
+        if sha256sum(filename) != sha256:
+            logger.warning("%s does not match its checksum", filename)
+            return False
+        blobs.add(filename, sha256)
+        return True
 
     def findPackage(self, name, searchDist=None, searchComponent=None,
                     version=None):
@@ -183,6 +224,49 @@ class Distro(object):
             raise error.PackageNotFound(name, searchDist, searchComponent)
         return ret
 
+    def newestVersions(self, dist):
+        """Return a dictionary mapping the name of every source package in
+        the given release to its newest (Version, component).
+
+        This is built from the Sources indexes once per process, or again
+        if they are reloaded, so that looking up the newest version of
+        many packages doesn't mean searching every component for each.
+
+        @param dist a release codename like "precise"
+        """
+        indexes = [(component, self.getSourcesIndex(dist, component))
+                   for component in self.components()]
+        key = (self.name, dist)
+        with Distro._cacheLock:
+            cached = Distro.NEWEST_CACHE.get(key)
+            if cached is not None and len(cached[0]) == len(indexes) and \
+                    all(a is b for (a, (c, b)) in zip(cached[0], indexes)):
+                return cached[1]
+
+            candidates = {}
+            for (component, index) in indexes:
+                for name in index.names():
+                    candidates.setdefault(name, []).append(
+                        (index.newestVersion(name), component))
+            newest = dict((name, max_version(c, key=lambda x: x[0]))
+                          for (name, c) in candidates.iteritems())
+            Distro.NEWEST_CACHE[key] = ([index for (c, index) in indexes],
+                                        newest)
+            return newest
+
+    def findNewest(self, name, dist):
+        """Return the newest version of the given package in the given
+        release as a PackageVersion, or None if it isn't there.
+
+        @param name the name of a source package
+        @param dist a release codename like "precise"
+        """
+        entry = self.newestVersions(dist).get(name)
+        if entry is None:
+            return None
+        (version, component) = entry
+        return PackageVersion(Package(self, dist, component, name), version)
+
     def package(self, dist, component, name):
         """Return a Package for the given (release, component, source package)
         tuple, or raise PackageNotFound.
@@ -191,10 +275,8 @@ class Distro(object):
         @param component a component (archive area) like "universe"
         @param name the name of a source package
         """
-        source = None
-        for s in self.getSources(dist, component):
-            if s['Package'] == name:
-                return Package(self, dist, component, name)
+        if name in self.getSourcesIndex(dist, component):
+            return Package(self, dist, component, name)
         raise error.PackageNotFound(name, dist, component)
 
     def branch(self, name):
@@ -222,12 +304,8 @@ class Distro(object):
         @param component a component (archive area) like "universe", or None if
         this distro does not have release subdirectories
         """
-        sources = self.getSources(dist, component)
-        ret = map(lambda x: self.package(dist, component, x["Package"]),
-                  sources)
-        # Multiple versions of a package could exist in the sources.
-        # De-duplicate the returned list.
-        return list(set(ret))
+        index = self.getSourcesIndex(dist, component)
+        return [self.package(dist, component, name) for name in index.names()]
 
     def config(self, *args, **kwargs):
         args = ("DISTROS", self.name) + args
@@ -275,19 +353,53 @@ class Distro(object):
         """Parse a cached Sources file. Return its stanzas, each representing
         a source package, as dictionaries of the form { "Field": "value" }.
         """
+        return self.getSourcesIndex(dist, component).paras
+
+    def getSourcesIndex(self, dist, component):
+        """Return a SourcesIndex for the cached Sources file of the given
+        release and component. The file is indexed at most once per process,
+        and is only parsed if its on-disk snapshot is missing or stale.
 
+        @param dist a release codename like "precise"
+        @param component a component (archive area) like "universe"
+        """
         filename = self.sourcesFile(dist, component)
         if filename is None:
-            return {}
+            return SourcesIndex([])
 
-        if filename not in Distro.SOURCES_CACHE:
-                Distro.SOURCES_CACHE[filename] = ControlFile(filename,
-                                                             multi_para=True,
-                                                             signed=False)
-
-        return Distro.SOURCES_CACHE[filename].paras
+        with Distro._cacheLock:
+            if filename not in Distro.SOURCES_CACHE:
+                Distro.SOURCES_CACHE[filename] = SourcesIndex.load(filename)
+            return Distro.SOURCES_CACHE[filename]
 
     def updateSources(self, dist):
+        """Refresh the cached Sources files for the given release from the
+        mirror. Return True if any of them changed.
+
+        If DISTROS[name]["sources_fetcher"] is "direct", the files are
+        fetched by a SourcesFetcher, which only asks the mirror for what
+        has changed. Otherwise apt does it, which sets apt's configuration;
+        that is global to the process, so refreshing several releases at
+        once then needs a process for each.
+        """
+        before = self._sourcesStamps(dist)
+        if self.config("sources_fetcher") == "direct":
+            listsdir = os.path.join(self.getDistDir(dist),
+                                    'var/lib/apt/lists')
+            SourcesFetcher(self.mirrorURL(), dist, self.components(),
+                           listsdir, self.downloader()).update()
+        else:
+            self._aptUpdate(dist)
+
+        # Re-index the refreshed Sources files now, so that later stages
+        # (which run in other processes) can load the snapshots directly
+        self.forgetSourcesIndex(dist)
+        for component in self.components():
+            self.getSourcesIndex(dist, component)
+
+        return self._sourcesStamps(dist) != before
+
+    def _aptUpdate(self, dist):
         path = self.getDistDir(dist)
         if not os.path.exists(path):
                 os.makedirs(path)
@@ -315,6 +427,30 @@ class Distro(object):
         cache = apt.Cache(rootdir=path)
         cache.update()
 
+    def _sourcesStamps(self, dist):
+        # apt replaces a Sources file when it changes, and otherwise leaves
+        # it alone, so this is enough to tell whether it was updated
+        stamps = []
+        for component in self.components():
+            filename = self.sourcesFile(dist, component)
+            if filename is None:
+                stamps.append(None)
+            else:
+                st = os.stat(filename)
+                stamps.append((filename, st.st_ino, st.st_size, st.st_mtime))
+        return stamps
+
+    def forgetSourcesIndex(self, dist):
+        """Drop any SourcesIndex for the given release cached by this
+        process, so that it is loaded again when next needed.
+        """
+        with Distro._cacheLock:
+            Distro.NEWEST_CACHE.pop((self.name, dist), None)
+            for component in self.components():
+                filename = self.sourcesFile(dist, component)
+                if filename is not None:
+                    Distro.SOURCES_CACHE.pop(filename, None)
+
     def getPoolPath(self, component):
         """Return the absolute path to the pool for a given component
         source packages for the given component.
@@ -323,13 +459,340 @@ class Distro(object):
                                   self.config('pool', default=self.name),
                                   component)
 
+    def getPoolIndex(self, component):
+        """Return the PoolIndex of the pool for a given component."""
+        return PoolIndex.get(self.getPoolPath(component))
+
     def shouldExpire(self):
         return self.config('expire', default=False)
 
 
+class SourcesIndex(object):
+    """The stanzas of a Sources file, indexed by source package name.
+
+    The Sources file is memory-mapped, and each stanza is only parsed when
+    a field other than Package or Version is first looked up. Scanning a
+    large Sources file is still slow, so the position of each stanza is
+    also saved as a marshal snapshot under ROOT/sources-index, which is
+    reused for as long as the Sources file is unchanged.
+
+    Properties:
+      paras       List of stanzas as read-only dictionaries
+                  (MappedParagraph objects), in file order
+    """
+
+    # Bump this whenever the layout of the snapshot changes
+    SNAPSHOT_FORMAT = 3
+
+    def __init__(self, paras):
+        """Index an iterable of stanzas, in a single pass."""
+        self.paras = []
+        self._byName = {}
+
+        for para in paras:
+            self.paras.append(para)
+            entries = self._byName.setdefault(para['Package'], [])
+            entries.append((Version(para['Version']), para))
+
+        for entries in self._byName.itervalues():
+            sort_versions(entries, key=lambda x: x[0])
+
+    @staticmethod
+    def snapshotPath(filename):
+        """Return the path of the snapshot for the given Sources file."""
+        return '%s/sources-index/%s' % (config.get('ROOT'),
+                                        tree.subdir(config.get('ROOT'),
+                                                    filename))
+
+    @classmethod
+    def load(cls, filename):
+        """Return a SourcesIndex for the given Sources file, from its
+        snapshot if the file's size and mtime (or failing that, its SHA-256)
+        still match, otherwise by parsing the file and saving a new
+        snapshot.
+        """
+        snapshot = cls.snapshotPath(filename)
+        st = os.stat(filename)
+        try:
+            with open(snapshot, 'rb') as fd:
+                (fmt, size, mtime, sha256, spans) = marshal.load(fd)
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        else:
+            if fmt == cls.SNAPSHOT_FORMAT and size == st.st_size:
+                if mtime == st.st_mtime:
+                    return cls(ControlFile().map_paras(filename, spans=spans))
+                if sha256 == sha256sum(filename):
+                    logger.debug('%s was touched but not changed', filename)
+                    cls._saveSnapshot(snapshot, st, sha256, spans)
+                    return cls(ControlFile().map_paras(filename, spans=spans))
+
+        logger.debug('Indexing %s', filename)
+        sha256 = sha256sum(filename)
+        index = cls(ControlFile().map_paras(filename))
+        cls._saveSnapshot(snapshot, st, sha256,
+                          [para.span for para in index.paras])
+        return index
+
+    @classmethod
+    def _saveSnapshot(cls, snapshot, st, sha256, spans):
+        tree.ensure(snapshot)
+        with open(snapshot + '.tmp', 'wb') as fd:
+            marshal.dump((cls.SNAPSHOT_FORMAT, st.st_size, st.st_mtime,
+                          sha256, spans), fd)
+        os.rename(snapshot + '.tmp', snapshot)
+
+    def __contains__(self, name):
+        return name in self._byName
+
+    def __len__(self):
+        return len(self._byName)
+
+    def names(self):
+        """Return the source package names in the index, sorted."""
+        return sorted(self._byName.iterkeys())
+
+    def versions(self, name):
+        """Return the Versions of the given source package, oldest first,
+        or an empty list if there are none.
+        """
+        return [v for (v, para) in self._byName.get(name, ())]
+
+    def stanzas(self, name):
+        """Return the Sources stanzas of the given source package, oldest
+        first, or an empty list if there are none.
+        """
+        return [para for (v, para) in self._byName.get(name, ())]
+
+    def newestVersion(self, name):
+        """Return the newest Version of the given source package, or None."""
+        entries = self._byName.get(name)
+        if not entries:
+            return None
+        return entries[-1][0]
+
+
+class PoolIndex(object):
+    """The source package versions in one component of a pool, indexed by
+    package name, so that finding them doesn't mean globbing and parsing
+    .dsc files.
+
+    The index is kept under ROOT/pool-index as a marshal snapshot plus a
+    journal of the .dsc files recorded and forgotten since, which is
+    folded into the snapshot once it grows long. Anything that adds a .dsc
+    to the pool or expires one must call record() or forget(). If the
+    pool is changed some other way, removing the snapshot makes the index
+    be rebuilt from the .dsc files next time it is loaded.
+
+    Other processes may record and forget versions too, so get() replays
+    whatever they have added to the journal since it was last read, and
+    loads the index again if they have folded the journal away.
+    """
+
+    # Bump this whenever the layout of the snapshot or journal changes
+    SNAPSHOT_FORMAT = 1
+
+    # Fields of each .dsc kept in the index
+    FIELDS = ('Format', 'Files', 'Checksums-Sha256')
+
+    # Number of journal records after which it is folded into the snapshot
+    MAX_JOURNAL = 1000
+
+    CACHE = {}
+    _cacheLock = threading.Lock()
+
+    def __init__(self, pooldir):
+        """Load the index of the pool component at pooldir."""
+        self.pooldir = pooldir
+        self.snapshot = '%s/pool-index/%s' % (config.get('ROOT'),
+                                              tree.subdir(config.get('ROOT'),
+                                                          pooldir))
+        self.journal = self.snapshot + '.journal'
+        self._lock = threading.Lock()
+        # How far into the journal has been read, and which snapshot it
+        # goes with
+        self._journalPos = 0
+        self._snapshotStamp = None
+        self._byName = self._load()
+
+    @classmethod
+    def get(cls, pooldir):
+        """Return the PoolIndex of the pool component at pooldir, loading
+        it only the first time and bringing it up to date after that.
+        """
+        with cls._cacheLock:
+            if pooldir not in cls.CACHE:
+                cls.CACHE[pooldir] = cls(pooldir)
+                return cls.CACHE[pooldir]
+            index = cls.CACHE[pooldir]
+        index._refresh()
+        return index
+
+    @classmethod
+    def forDsc(cls, filename):
+        """Return the PoolIndex covering the .dsc at filename, which is
+        somewhere like <pooldir>/libf/libfoo/libfoo_1.0-1.dsc.
+        """
+        return cls.get(path.dirname(path.dirname(path.dirname(filename))))
+
+    def versions(self, name):
+        """Return the Versions of the given package in the pool, oldest
+        first, or an empty list if there are none.
+        """
+        versions = [Version(v) for v in self._byName.get(name, {})]
+        sort_versions(versions)
+        return versions
+
+    def entry(self, name, version):
+        """Return the FIELDS of the .dsc of the given package version as a
+        dictionary, or None if it isn't in the pool.
+        """
+        return self._byName.get(name, {}).get(str(version))
+
+    def record(self, filename):
+        """Add the .dsc at filename, which has just been put in the pool."""
+        (name, version, entry) = self._readDsc(filename)
+        with self._lock:
+            self._apply(self._byName, ('add', name, version, entry))
+            self._append(('add', name, version, entry))
+
+    def forget(self, name, version):
+        """Remove a package version that has been expired from the pool."""
+        with self._lock:
+            self._apply(self._byName, ('remove', name, str(version), None))
+            self._append(('remove', name, str(version), None))
+
+    @staticmethod
+    def _apply(byName, record):
+        (action, name, version, entry) = record
+        if action == 'add':
+            byName.setdefault(name, {})[version] = entry
+        elif name in byName:
+            byName[name].pop(version, None)
+            if not byName[name]:
+                del byName[name]
+
+    def _readDsc(self, filename):
+        dsc = ControlFile(filename, multi_para=False, signed=True).para
+        entry = dict((field, dsc[field]) for field in self.FIELDS
+                     if field in dsc)
+        return (path.basename(path.dirname(filename)), dsc['Version'], entry)
+
+    def _load(self):
+        tree.ensure(self.journal)
+        with open(self.journal, 'ab+') as journal:
+            # Hold the lock throughout, so that no records are appended
+            # between replaying the journal and truncating it
+            fcntl.flock(journal, fcntl.LOCK_EX)
+
+            self._journalPos = 0
+            self._snapshotStamp = self._snapshotId()
+            byName = self._readSnapshot()
+            if byName is None:
+                byName = self._scan()
+            else:
+                journal.seek(0)
+                if self._replay(journal, byName) <= self.MAX_JOURNAL:
+                    return byName
+
+            with open(self.snapshot + '.tmp', 'wb') as fd:
+                marshal.dump((self.SNAPSHOT_FORMAT, byName), fd)
+            os.rename(self.snapshot + '.tmp', self.snapshot)
+            journal.truncate(0)
+            self._journalPos = 0
+            self._snapshotStamp = self._snapshotId()
+        return byName
+
+    def _readSnapshot(self):
+        try:
+            with open(self.snapshot, 'rb') as fd:
+                (fmt, byName) = marshal.load(fd)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if fmt != self.SNAPSHOT_FORMAT:
+            return None
+        return byName
+
+    def _scan(self):
+        logger.debug('Indexing pool %s', self.pooldir)
+        byName = {}
+        for filename in glob('%s/*/*/*.dsc' % self.pooldir):
+            try:
+                record = ('add',) + self._readDsc(filename)
+            except Exception:
+                logger.exception('Unable to read %s:', filename)
+                continue
+            self._apply(byName, record)
+        return byName
+
+    def _append(self, record):
+        tree.ensure(self.journal)
+        with open(self.journal, 'ab') as journal:
+            fcntl.flock(journal, fcntl.LOCK_EX)
+            journal.seek(0, os.SEEK_END)
+            start = journal.tell()
+            journal.write(marshal.dumps(record))
+            # Unless other processes' records came first, there's nothing
+            # new for _refresh() to replay
+            if start == self._journalPos:
+                self._journalPos = journal.tell()
+
+    def _refresh(self):
+        """Apply the records other processes have added to the journal
+        since it was last read, or load the index again if they have
+        folded the journal into a new snapshot.
+        """
+        try:
+            size = os.path.getsize(self.journal)
+        except OSError:
+            size = 0
+        if size == self._journalPos \
+                and self._snapshotId() == self._snapshotStamp:
+            return
+
+        with self._lock:
+            tree.ensure(self.journal)
+            with open(self.journal, 'ab+') as journal:
+                fcntl.flock(journal, fcntl.LOCK_SH)
+                size = os.fstat(journal.fileno()).st_size
+                reload = size < self._journalPos \
+                    or self._snapshotId() != self._snapshotStamp
+                if not reload:
+                    journal.seek(self._journalPos)
+                    self._replay(journal, self._byName)
+            if reload:
+                logger.debug('Reloading index of pool %s', self.pooldir)
+                self._byName = self._load()
+
+    def _replay(self, journal, byName):
+        """Apply the records in journal from its current position on to
+        byName, and return how many there were.
+        """
+        records = 0
+        while True:
+            try:
+                record = marshal.load(journal)
+            except (EOFError, ValueError, TypeError):
+                # The end, or a record that was only half written
+                break
+            self._apply(byName, record)
+            records += 1
+            self._journalPos = journal.tell()
+        return records
+
+    def _snapshotId(self):
+        try:
+            st = os.stat(self.snapshot)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime)
+
+
 class Package(object):
     """A Debian source package in a distribution."""
 
+    __slots__ = ('distro', 'name', 'dist', 'component')
+
     def __init__(self, distro, dist, component, name):
         """Constructor.
 
@@ -376,13 +839,8 @@ class Package(object):
         available in (self.distro, self.dist, self.component), with
         the oldest version first.
         """
-        sources = self.distro.getSources(self.dist, self.component)
-        matches = []
-        for source in sources:
-            if source['Package'] == self.name:
-                matches.append(source)
-        matches.sort(key=lambda x: Version(x['Version']))
-        return matches
+        index = self.distro.getSourcesIndex(self.dist, self.component)
+        return index.stanzas(self.name)
 
     @staticmethod
     def merge(ours, upstream, base, output_dir, force=False):
@@ -414,36 +872,31 @@ class Package(object):
         """Return all available versions of this package in the pool as
         PackageVersion objects. They are in no particular order.
         """
-        versions = []
-        for f in glob(self.poolPath + '/*.dsc'):
-            dsc = ControlFile(f, multi_para=False, signed=True).para
-            versions.append(PackageVersion(self, Version(dsc['Version'])))
-        return versions
+        index = self.distro.getPoolIndex(self.component)
+        return [PackageVersion(self, v) for v in index.versions(self.name)]
 
     def currentVersions(self):
         """Return all available versions of this package in self.distro.
         They are in no particular order.
         """
-        versions = []
-        for s in self.distro.getSources(self.dist, self.component):
-            if s['Package'] == self.name:
-                versions.append(PackageVersion(self, Version(s['Version'])))
-        return versions
+        index = self.distro.getSourcesIndex(self.dist, self.component)
+        return [PackageVersion(self, v) for v in index.versions(self.name)]
 
     def newestVersion(self):
         """Return the newest version of this package in self.distro.
         """
-        versions = self.currentVersions()
-        newest = versions[0]
-        for v in versions:
-            if v > newest:
-                newest = v
-        return newest
+        index = self.distro.getSourcesIndex(self.dist, self.component)
+        version = index.newestVersion(self.name)
+        if version is None:
+            raise error.PackageNotFound(self.name, self.dist, self.component)
+        return PackageVersion(self, version)
 
 
 class PackageVersion(object):
     """A pair (Package, Version)."""
 
+    __slots__ = ('package', 'version')
+
     def __init__(self, package, version):
         self.package = package
         self.version = version
@@ -475,21 +928,126 @@ class PackageVersion(object):
     def getDscContents(self):
         return ControlFile(self.dscPath, multi_para=False, signed=True).para
 
+    def getPoolEntry(self):
+        """Return the PoolIndex.FIELDS of the .dsc in the pool as a
+        dictionary, from the pool index if possible.
+        """
+        index = self.package.distro.getPoolIndex(self.package.component)
+        entry = index.entry(self.package.name, self.version)
+        if entry is None:
+            dsc = self.getDscContents()
+            entry = dict((field, dsc[field]) for field in PoolIndex.FIELDS
+                         if field in dsc)
+        return entry
+
     def download(self):
         self.package.download(self.version)
 
 
+class UpdateInfoStore(object):
+    """The database in which every UpdateInfo is kept, ROOT/baseinfo.db.
+
+    This is an sqlite database in WAL mode, so that readers don't block
+    the writer. Each thread (and process) gets a connection of its own.
+    The first time the database is opened, any UpdateInfo files left in
+    the ROOT/baseinfo tree by older versions are imported into it.
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS baseinfo (distro TEXT NOT NULL, '
+        'package TEXT NOT NULL, data TEXT NOT NULL, '
+        'PRIMARY KEY (distro, package))',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+    ]
+
+    _local = threading.local()
+
+    @staticmethod
+    def path():
+        return os.path.join(config.get('ROOT'), 'baseinfo.db')
+
+    @classmethod
+    def connection(cls):
+        """Return this thread's connection to the database."""
+        key = (os.getpid(), cls.path())
+        conn = getattr(cls._local, 'conns', {}).get(key)
+        if conn is None:
+            conn = cls._open(key[1])
+            cls._local.conns = {key: conn}
+        return conn
+
+    @classmethod
+    def _open(cls, filename):
+        tree.ensure(filename)
+        conn = sqlite3.connect(filename, timeout=60,
+                               isolation_level='IMMEDIATE')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with conn:
+            for statement in cls.SCHEMA:
+                conn.execute(statement)
+            if conn.execute("SELECT value FROM meta WHERE key='migrated'") \
+                    .fetchone() is None:
+                cls._migrate(conn)
+                conn.execute("INSERT OR REPLACE INTO meta "
+                             "VALUES ('migrated', '1')")
+        return conn
+
+    @staticmethod
+    def _migrate(conn):
+        # Import the UpdateInfo files from ROOT/baseinfo/<distro>/<package>,
+        # where they used to be kept
+        top = os.path.join(config.get('ROOT'), 'baseinfo')
+        if not os.path.isdir(top):
+            return
+
+        rows = []
+        for distro in os.listdir(top):
+            if not os.path.isdir(os.path.join(top, distro)):
+                continue
+            for name in os.listdir(os.path.join(top, distro)):
+                if name.endswith('.tmp'):
+                    continue
+                # A file that can't be read is left behind rather than
+                # stopping the store from ever being opened
+                filename = os.path.join(top, distro, name)
+                try:
+                    with open(filename) as fd:
+                        data = json.load(fd)
+                except (IOError, ValueError), e:
+                    logger.warning('Not importing %s: %s', filename, e)
+                    continue
+                rows.append((distro, name, json.dumps(data, sort_keys=True)))
+
+        conn.executemany('INSERT OR IGNORE INTO baseinfo VALUES (?, ?, ?)',
+                         rows)
+        logger.info('Imported %d UpdateInfo files from %s; it can now be '
+                    'removed', len(rows), top)
+
+
 class UpdateInfo(object):
-    def __init__(self, package):
+    def __init__(self, package, data=None):
+        """Load the UpdateInfo for package, unless its data is given, as
+        from load_all().
+        """
         self.package = package
-        self.path = os.path.join(config.get('ROOT'), 'baseinfo',
-                                 package.distro.name, package.name)
 
-        if os.path.exists(self.path):
-            with open(self.path, 'r') as fd:
-                self.data = json.load(fd)
-        else:
-            self.data = {}
+        if data is None:
+            row = UpdateInfoStore.connection().execute(
+                'SELECT data FROM baseinfo WHERE distro=? AND package=?',
+                (package.distro.name, package.name)).fetchone()
+            data = json.loads(row[0]) if row is not None else {}
+        self.data = data
+
+    @staticmethod
+    def load_all(distro):
+        """Return the data of every UpdateInfo in distro as a dictionary
+        keyed by package name, for UpdateInfo(package, data).
+        """
+        cursor = UpdateInfoStore.connection().execute(
+            'SELECT package, data FROM baseinfo WHERE distro=?',
+            (distro.name,))
+        return dict((name, json.loads(data)) for (name, data) in cursor)
 
     def __unicode__(self):
         return '%s (version=%s base=%s upstream=%s)' % \
@@ -500,12 +1058,13 @@ class UpdateInfo(object):
         return self.__unicode__()
 
     def save(self):
-        base_path = os.path.dirname(self.path)
-        if not os.path.exists(base_path):
-            os.makedirs(base_path)
-
-        with open(self.path, 'w') as fd:
-            json.dump(self.data, fd)
+        # Sort the keys so that the same data is always written out the
+        # same way, whatever order it was set in
+        conn = UpdateInfoStore.connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO baseinfo VALUES (?, ?, ?)',
+                         (self.package.distro.name, self.package.name,
+                          json.dumps(self.data, sort_keys=True)))
 
     @property
     def version(self):
@@ -571,5 +1130,21 @@ def files(source):
     return [f.split(None, 2) for f in files]
 
 
+def sha256sums(source):
+    """Return a dictionary mapping each file's name to its SHA-256,
+    or an empty dictionary if the stanza has no Checksums-Sha256 field.
+
+    @param source a stanza from Sources or a .dsc, as a dictionary in the
+    form {"Field": "value"}
+    """
+    if 'Checksums-Sha256' not in source:
+        return {}
+    sums = {}
+    for line in source['Checksums-Sha256'].strip("\n").split("\n"):
+        (sha256, size, name) = line.split(None, 2)
+        sums[name] = sha256
+    return sums
+
+
 import model.debian
 import model.obs
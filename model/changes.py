@@ -0,0 +1,140 @@
+from __future__ import with_statement
+
+import json
+import logging
+import marshal
+import os
+
+import config
+from util import tree
+
+logger = logging.getLogger('model.changes')
+
+
+class ChangeTracker(object):
+    """The source packages whose inputs have changed since the last
+    complete run, so that each stage can skip the others.
+
+    detect() compares each Sources file with a snapshot of the package
+    versions it listed when it was last looked at, and adds the names of
+    any packages that appeared, disappeared or changed version to the
+    pending set. Those stay pending until finish() is called at the end of
+    a complete run, so a run that stops part way through doesn't lose
+    them. Names passed to defer() are kept pending for the next run too.
+
+    Everything is kept under ROOT/change-tracker (not ROOT/changes, which holds
+    the .changes files made by generate_diffs).
+    """
+
+    def __init__(self):
+        self.path = os.path.join(config.get('ROOT'), 'change-tracker')
+        self.statePath = os.path.join(self.path, 'pending.json')
+
+    def snapshotPath(self, distro, dist, component):
+        return os.path.join(self.path, 'snapshots', distro.name, dist,
+                            component)
+
+    def _loadState(self):
+        if not os.path.exists(self.statePath):
+            return None
+        with open(self.statePath) as fd:
+            return json.load(fd)
+
+    def _saveState(self, state):
+        tree.ensure(self.statePath)
+        with open(self.statePath + '.tmp', 'w') as fd:
+            json.dump(state, fd, sort_keys=True, indent=1)
+        os.rename(self.statePath + '.tmp', self.statePath)
+
+    def pending(self):
+        """Return the set of package names waiting to be handled, or None
+        if changes have never been detected, in which case everything
+        should be.
+        """
+        state = self._loadState()
+        if state is None:
+            return None
+        return set(state['changed']) | set(state['deferred'])
+
+    def detect(self, suites):
+        """Compare the Sources files of each (distro, dist, component) in
+        suites with their snapshots, adding the packages that changed to
+        the pending set, and return that set.
+        """
+        changed = set()
+        snapshots = []
+        for (distro, dist, component) in suites:
+            index = distro.getSourcesIndex(dist, component)
+            current = dict((name, tuple(str(v) for v in
+                                        index.versions(name)))
+                           for name in index.names())
+
+            filename = self.snapshotPath(distro, dist, component)
+            try:
+                with open(filename, 'rb') as fd:
+                    previous = marshal.load(fd)
+            except (IOError, EOFError, ValueError, TypeError):
+                logger.debug('No snapshot of %s/%s/%s, so all of its '
+                             'packages have changed', distro, dist, component)
+                previous = {}
+
+            suiteChanged = set(name for name in set(current) | set(previous)
+                               if current.get(name) != previous.get(name))
+            logger.debug('%d packages changed in %s/%s/%s',
+                         len(suiteChanged), distro, dist, component)
+            changed |= suiteChanged
+            if suiteChanged or not os.path.exists(filename):
+                snapshots.append((filename, current))
+
+        state = self._loadState() or {'changed': [], 'deferred': []}
+        state['changed'] = sorted(changed | set(state['changed']))
+        # Save the pending set before the snapshots, so that nothing is
+        # lost if this is interrupted
+        self._saveState(state)
+        for (filename, current) in snapshots:
+            tree.ensure(filename)
+            with open(filename + '.tmp', 'wb') as fd:
+                marshal.dump(current, fd)
+            os.rename(filename + '.tmp', filename)
+
+        return set(state['changed']) | set(state['deferred'])
+
+    def defer(self, names):
+        """Keep the given packages pending after this run finishes, such
+        as because handling them failed. If changes have never been
+        detected there is nothing to do, as everything is still pending.
+        """
+        state = self._loadState()
+        if state is None:
+            return
+        state['deferred'] = sorted(set(names) | set(state['deferred']))
+        self._saveState(state)
+
+    def finish(self):
+        """Mark the pending changes as handled, other than those deferred
+        during this run.
+        """
+        state = self._loadState()
+        if state is None:
+            return
+        self._saveState({'changed': state['deferred'], 'deferred': []})
+
+
+def package_filter(options):
+    """Return a function that says whether the named package should be
+    handled, given the -p/--package, --full and -f/--force options.
+    Unless told otherwise, only packages with pending changes are handled.
+    """
+    if options.package:
+        wanted = set(options.package)
+        return lambda name: name in wanted
+
+    pending = None
+    if not options.full and not getattr(options, 'force', False):
+        pending = ChangeTracker().pending()
+    if pending is None:
+        return lambda name: True
+
+    logger.info('Only handling the %d packages with changes; use --full or '
+                '--force to handle everything', len(pending))
+    return lambda name: name in pending
@@ -150,13 +150,9 @@ class OBSDistro(Distro):
             self._validateCheckout(dist, component, package)
 
     def package(self, dist, component, name):
-        try:
-            for s in self.getSources(dist, component):
-                if s['Package'] == name:
-                    return OBSPackage(self, dist, component, name)
-            raise error.PackageNotFound(name, dist, component)
-        except KeyError:
-            raise error.PackageNotFound(name, dist, component)
+        if name in self.getSourcesIndex(dist, component):
+            return OBSPackage(self, dist, component, name)
+        raise error.PackageNotFound(name, dist, component)
 
     def getPackageFiles(self, dist, component, obsPkg):
         return osccore.meta_get_filelist(self.config("obs", "url"),
@@ -191,6 +187,8 @@ class OBSDistro(Distro):
 
 
 class OBSPackage(Package):
+    __slots__ = ()
+
     def __init__(self, distro, dist, component, name):
         super(OBSPackage, self).__init__(distro, dist, component, name)
 
@@ -32,6 +32,8 @@ import re
 import sys
 import shutil
 import stat
+import tarfile
+import threading
 import time
 
 import osc.core
@@ -39,22 +41,33 @@ import osc.conf
 
 import config
 from deb.controlfile import ControlFile
-from deb.version import Version
+from deb.version import Version, sort_versions
 from model import Distro
 import model.error
 from util import shell, tree, pathhash
+from util.unpackcache import UnpackCache
 
 try:
     from xml.etree import ElementTree
 except ImportError:
     from elementtree import ElementTree
 
+# Regular expression for a hunk header in a unified diff
+HUNK_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
 # Regular expression for top of debian/changelog
 CL_RE = re.compile(r'^(\w[-+0-9a-z.]*) \(([^\(\) \t]+)\)((\s+[-0-9a-z]+)+)\;',
                    re.IGNORECASE)
 
 logger = logging.getLogger('momlib')
 
+# Where merges are worked on, if not ROOT; see set_scratch_root()
+_scratch_root = None
+
+# The UnpackCache for each ROOT, and the lock for making them
+_unpack_caches = {}
+_unpack_caches_lock = threading.Lock()
+
 
 # --------------------------------------------------------------------------- #
 # Utility functions
@@ -85,11 +98,38 @@ def md5sum(filename):
 # Location functions
 # --------------------------------------------------------------------------- #
 
+def scratch_root():
+    """Return the directory under which merges are worked on, which is
+    ROOT unless set_scratch_root() says otherwise.
+    """
+    if _scratch_root is not None:
+        return _scratch_root
+    return config.get('ROOT')
+
+
+def set_scratch_root(path):
+    """Work on merges under path rather than ROOT, so that several
+    processes can do so at once without colliding. None means ROOT again.
+    """
+    global _scratch_root
+    _scratch_root = path
+
+
 def unpack_directory(pv):
     """Return the location of a local unpacked source."""
-    return "%s/unpacked/%s/%s/%s" % (config.get('ROOT'),
-                                     pathhash(pv.package.name),
-                                     pv.package.name, pv.version)
+    return "%s/%s" % (unpack_cache().path, _unpack_key(pv))
+
+
+def _unpack_key(pv):
+    return "%s/%s/%s" % (pathhash(pv.package.name), pv.package.name,
+                         pv.version)
+
+
+def changelog_file(pv):
+    """Return the location of a source's cached debian/changelog."""
+    return "%s/changelogs/%s/%s/%s" % (config.get('ROOT'),
+                                       pathhash(pv.package.name),
+                                       pv.package.name, pv.version)
 
 
 def changes_file(distro, pv):
@@ -150,7 +190,7 @@ def patch_list_file():
 
 def work_dir(package, version):
     """Return the directory to produce the merge result."""
-    return "%s/work/%s/%s/%s" % (config.get('ROOT'), pathhash(package),
+    return "%s/work/%s/%s/%s" % (scratch_root(), pathhash(package),
                                  package, version)
 
 
@@ -166,12 +206,12 @@ def result_dir(target, package):
 
 def version_sort(sources):
     """Sort the source list by version number."""
-    sources.sort(key=lambda x: x.version)
+    sort_versions(sources, key=lambda x: x.version)
 
 
 def has_files(pv):
     """Return true if source has a Files entry"""
-    return "Files" in pv.getDscContents()
+    return "Files" in pv.getPoolEntry()
 
 
 def files(source):
@@ -201,12 +241,31 @@ def save_basis(filename, version):
 # Unpacked source handling
 # --------------------------------------------------------------------------- #
 
+def unpack_cache():
+    """Return the UnpackCache that sources are unpacked into, which is
+    shared by every thread and process working under ROOT.
+    """
+    root = config.get('ROOT')
+    with _unpack_caches_lock:
+        if root not in _unpack_caches:
+            _unpack_caches[root] = UnpackCache(
+                "%s/unpacked" % root,
+                config.get('UNPACK_CACHE_SIZE', default=10 << 30))
+        return _unpack_caches[root]
+
+
 def unpack_source(pv):
-    """Unpack the given source and return location."""
-    destdir = unpack_directory(pv)
-    if os.path.isdir(destdir):
-        return destdir
+    """Unpack the given source and return location.
+
+    The source stays unpacked for as long as it's in use, until the
+    matching cleanup_source(), and is then kept in the unpack_cache() for
+    whatever needs it next while there's room.
+    """
+    return unpack_cache().acquire(_unpack_key(pv),
+                                  lambda destdir: _unpack(pv, destdir))
+
 
+def _unpack(pv, destdir):
     srcdir = pv.package.poolPath
     dsc_file = pv.dscPath
 
@@ -231,12 +290,10 @@ def unpack_source(pv):
         cleanup(destdir)
         raise
 
-    return destdir
-
 
 def cleanup_source(pv):
-    """Cleanup the given source's unpack location."""
-    cleanup(unpack_directory(pv))
+    """Finish with the given source's unpack location."""
+    unpack_cache().release(_unpack_key(pv))
 
 
 def save_changes_file(filename, pv, previous=None):
@@ -527,31 +584,201 @@ def remove_old_comments(status_file, merges):
 
 
 def read_changelog(filename):
-    """Return a parsed changelog file."""
-    entries = []
+    """Yield the (version, offset, length) of each entry in a changelog
+    file, newest first, as the file is read.
 
+    Only the versions are parsed; the text of an entry is left in the file
+    at offset for changelog_text() to read if it's wanted, so a caller can
+    stop as soon as it has found what it's looking for.
+    """
     with open(filename) as cl:
-        (ver, text) = (None, "")
-        for line in cl:
-            match = CL_RE.search(line)
-            if match:
-                try:
-                    ver = Version(match.group(2))
-                except ValueError:
-                    ver = None
+        for entry in scan_changelog(cl):
+            yield entry
+
+
+def scan_changelog(lines):
+    """Yield the (version, offset, length) of each entry in the changelog
+    lines, as read_changelog does.
+    """
+    (ver, start, offset) = (None, None, 0)
+    for line in lines:
+        end = offset + len(line)
+        match = CL_RE.search(line)
+        if match:
+            try:
+                ver = Version(match.group(2))
+            except ValueError:
+                ver = None
+
+            if start is None:
+                start = offset
+        elif line.startswith(" -- "):
+            if ver is None:
+                ver = Version("0")
 
-                text += line
-            elif line.startswith(" -- "):
-                if ver is None:
-                    ver = Version("0")
+            if start is None:
+                start = offset
+            yield (ver, start, end - start)
+            (ver, start) = (None, None)
+        elif start is None and len(line.strip()):
+            start = offset
+        offset = end
 
-                text += line
-                entries.append((ver, text))
-                (ver, text) = (None, "")
-            elif len(line.strip()) or ver is not None:
-                text += line
+    if start is not None:
+        yield (ver, start, offset - start)
 
-    if len(text):
-        entries.append((ver, text))
 
-    return entries
+def changelog_text(filename, offset, length):
+    """Return the text of the changelog entry found by read_changelog()."""
+    with open(filename) as cl:
+        cl.seek(offset)
+        return cl.read(length)
+
+
+def changelog_entries(filename):
+    """Yield the (version, text) of each entry in a changelog file, reading
+    the text of each only when it's reached.
+    """
+    with open(filename) as cl:
+        for (ver, offset, length) in read_changelog(filename):
+            cl.seek(offset)
+            yield (ver, cl.read(length))
+
+
+def extract_changelog(pv):
+    """Return the text of debian/changelog, read straight from the
+    .debian.tar.* or .diff.gz of the source in the pool, or None if it
+    isn't in either (such as for native packages).
+
+    Only debian/changelog is decompressed and kept, rather than the whole
+    source being unpacked.
+    """
+    for md5sum, size, name in files(pv.getPoolEntry()):
+        filename = "%s/%s" % (pv.package.poolPath, name)
+        if ".debian.tar." in name:
+            return _changelog_from_tar(filename)
+        elif name.endswith(".diff.gz"):
+            return _changelog_from_diff(filename)
+    return None
+
+
+def _changelog_from_tar(filename):
+    # Stream the tarball, decompressing .xz and .lzma with xz(1) as
+    # python can't itself
+    if filename.endswith((".xz", ".lzma")):
+        proc = shell.open(("xz", "-dc", filename))
+        mode = "r|"
+    else:
+        proc = None
+        mode = "r|*"
+
+    text = None
+    try:
+        if proc is not None:
+            tar = tarfile.open(fileobj=proc, mode=mode)
+        else:
+            tar = tarfile.open(filename, mode=mode)
+        for member in tar:
+            name = member.name
+            if name.startswith("./"):
+                name = name[2:]
+            if name == "debian/changelog" and member.isfile():
+                text = tar.extractfile(member).read()
+                break
+        tar.close()
+    finally:
+        if proc is not None:
+            # Let xz finish rather than have it die of SIGPIPE
+            for chunk in iter(lambda: proc.read(1 << 16), ""):
+                pass
+            proc.close()
+    return text
+
+
+def _changelog_from_diff(filename):
+    # The changelog is only in the diff as a whole if the .orig.tar
+    # has no debian/changelog, so it must be added by a hunk starting
+    # at line 0
+    text = None
+    (old_left, new_left) = (0, 0)
+    in_changelog = False
+    with gzip.open(filename) as diff:
+        for line in diff:
+            if line.startswith("\\"):
+                # "\ No newline at end of file"
+                if in_changelog and text:
+                    text[-1] = text[-1].rstrip("\n")
+                continue
+
+            if old_left > 0 or new_left > 0:
+                tag = line[:1]
+                if tag in (" ", "\n", "-"):
+                    old_left -= 1
+                if tag in (" ", "\n", "+"):
+                    new_left -= 1
+                if in_changelog and tag == "+":
+                    text.append(line[1:])
+                continue
+
+            if line.startswith("+++ "):
+                if in_changelog:
+                    break
+                name = line[4:].split("\t", 1)[0].strip()
+                in_changelog = name.split("/", 1)[-1] == "debian/changelog"
+            elif line.startswith("@@ "):
+                match = HUNK_RE.match(line)
+                if match is None:
+                    return None
+                old_left = int(match.group(2) or 1)
+                new_left = int(match.group(4) or 1)
+                if in_changelog:
+                    if match.group(1) != "0" or old_left != 0:
+                        return None
+                    if text is None:
+                        text = []
+
+    if text is None:
+        return None
+    return "".join(text)
+
+
+def source_changelog(pv):
+    """Return the location of a copy of the source's debian/changelog, for
+    read_changelog() and friends.
+
+    The copy is kept in changelog_file(pv). It's taken from the unpacked
+    source if that's already there, or from the source packages in the
+    pool with extract_changelog(), only unpacking the whole source as a
+    last resort.
+    """
+    filename = changelog_file(pv)
+    if os.path.isfile(filename):
+        return filename
+
+    tree.ensure(filename)
+    unpacked_dir = unpack_directory(pv)
+    if os.path.isdir(unpacked_dir):
+        tree.copyfile(unpacked_dir + "/debian/changelog", filename + ".tmp",
+                      dereference=True)
+    else:
+        text = None
+        try:
+            text = extract_changelog(pv)
+        except (IOError, OSError, ValueError, tarfile.TarError), e:
+            logger.debug("Cannot extract the changelog of %s: %s", pv, e)
+
+        if text is not None:
+            with open(filename + ".tmp", "w") as cl:
+                cl.write(text)
+        else:
+            logger.debug("No changelog outside the orig tarball of %s, so "
+                         "unpacking it", pv)
+            unpacked_dir = unpack_source(pv)
+            try:
+                tree.copyfile(unpacked_dir + "/debian/changelog",
+                              filename + ".tmp", dereference=True)
+            finally:
+                cleanup_source(pv)
+
+    os.rename(filename + ".tmp", filename)
+    return filename
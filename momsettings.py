@@ -76,6 +76,11 @@ DISTROS = {
         ],
         "components": ["main", "contrib", "non-free"],
         "expire": True,
+        # How many files to download from the mirror at once (default 4)
+        "download_jobs": 8,
+        # Fetch the Sources files ourselves, asking only for what changed,
+        # rather than with apt (default "apt")
+        "sources_fetcher": "direct",
     },
     # Debian's security updates are in a separate apt repository, so we
     # have to treat them like a separate upstream distro
@@ -173,3 +178,22 @@ defineDist('uderivative', 'badger', ['raring+updates'], False,
 # hello_1.2-3ubuntu2, etc., so they would use "ubuntu1" in their
 # MOM installation.
 LOCAL_SUFFIX = "local"
+
+# How long to wait for a mirror to answer before giving up on a download,
+# in seconds (default 60)
+DOWNLOAD_TIMEOUT = 60
+
+# How many files to download from snapshot.debian.org at once (default 4)
+DEBSNAP_DOWNLOAD_JOBS = 2
+
+# How long to keep the list of a package's versions on snapshot.debian.org
+# before asking for it again, in seconds (default one day)
+DEBSNAP_CACHE_TTL = 2 * 24 * 60 * 60
+
+# How much disk space to leave free when producing several merges at once
+# with produce_merges --jobs, in bytes (default 1 GiB)
+MERGE_MIN_FREE_SPACE = 4 << 30
+
+# How much space sources unpacked by one stage may take up while they're
+# kept for the next, in bytes (default 10 GiB)
+UNPACK_CACHE_SIZE = 20 << 30
@@ -24,6 +24,7 @@ from smtplib import SMTP
 
 import config
 from merge_report import (MergeResult, read_report)
+from model.changes import (package_filter)
 from model.obs import (OBSDistro)
 from momlib import (result_dir)
 from util import (run)
@@ -264,6 +265,7 @@ Regards,
 def main(options, args):
     logger.debug('Sending email if actions are needed...')
 
+    wanted = package_filter(options)
     for target in config.targets(args):
         logger.debug('%r', target)
         d = target.distro
@@ -273,7 +275,7 @@ def main(options, args):
             continue
 
         for pkg in d.packages(target.dist, target.component):
-            if options.package and pkg.name not in options.package:
+            if not wanted(pkg.name):
                 logger.debug('Skipping package %s: not selected', pkg.name)
                 continue
 
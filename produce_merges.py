@@ -19,10 +19,13 @@
 
 from __future__ import with_statement
 
+import hashlib
+import json
 import os
 import re
 import time
 import logging
+import multiprocessing
 import subprocess
 import tempfile
 from textwrap import TextWrapper
@@ -33,6 +36,7 @@ from deb.version import Version
 from generate_patches import generate_patch
 from merge_report import (MergeResult, MergeReport, read_report, write_report)
 from model.base import (PackageVersion, Package, UpdateInfo)
+from model.changes import ChangeTracker, package_filter
 import model.error
 from momlib import *
 from momversion import VERSION
@@ -41,6 +45,18 @@ from util.debtreemerger import DebTreeMerger
 
 logger = logging.getLogger('produce_merges')
 
+# How much free space a merge may need for each byte of our version's
+# source files: three unpacked trees, the merged tree, and the tarballs
+# and diffs made from it
+SPACE_FACTOR = 16
+
+# How many bytes of our version's source files a merge gets through each
+# second, until there are past merges to go by
+DEFAULT_MERGE_RATE = 4 << 20
+
+# How many of the longest merges to list at the end of the stage
+SUMMARY_LENGTH = 10
+
 
 class NoBase(Exception):
     pass
@@ -68,6 +84,9 @@ def options(parser):
                       action="append",
                       help="Only process packages listed in this file")
 
+    parser.add_option("-j", "--jobs", type="int", metavar="N", default=1,
+                      help="Produce up to N merges at once")
+
 
 # Handle the merge of a specific package, returning the new merge report,
 # or None if there was already a merge report that is still valid.
@@ -103,6 +122,18 @@ def handle_package(options, output_dir, target, pkg, our_version):
         report.result = MergeResult.NO_BASE
         return report
 
+    # If the last report was produced from the same versions, by the same
+    # MoM and configuration, and isn't to be retried, that's all there is to
+    # know without looking in the pool
+    fingerprint = merge_fingerprint(target, our_version, update_info)
+    if not options.force and \
+            is_up_to_date(read_fingerprint(output_dir), fingerprint,
+                          pkg.name in target.sync_upstream_packages):
+        logger.info("merge for %s [ours=%s, theirs=%s] already produced, "
+                    "skipping run", pkg, our_version.version,
+                    update_info.upstream_version)
+        return None
+
     upstream = target.findSourcePackage(pkg.name, update_info.upstream_version)
     if not upstream:
         logger.error('Could not find upstream version %s in pool',
@@ -145,6 +176,7 @@ def handle_package(options, output_dir, target, pkg, our_version):
             logger.info("sync to upstream for %s [ours=%s, theirs=%s] "
                         "already produced, skipping run", pkg,
                         our_version.version, upstream.version)
+            save_fingerprint(output_dir, fingerprint, report['result'])
             return None
         elif (not options.force and
               Version(report['right_version']) == upstream.version and
@@ -157,6 +189,7 @@ def handle_package(options, output_dir, target, pkg, our_version):
             logger.info("merge for %s [ours=%s, theirs=%s] already produced, "
                         "skipping run",
                         pkg, our_version.version, upstream.version)
+            save_fingerprint(output_dir, fingerprint, report['result'])
             return None
     except (AttributeError, ValueError, KeyError):
         pass
@@ -211,6 +244,358 @@ def handle_package(options, output_dir, target, pkg, our_version):
         return report
 
 
+def produce_report(options, target, our_version):
+    # Handle the merge of our_version, logging rather than raising any
+    # failure, and return the report to be written or None
+    pkg = our_version.package
+    try:
+        return handle_package(options, result_dir(target.name, pkg.name),
+                              target, pkg, our_version)
+    except Exception:
+        logging.exception('Failed handling merge for %s', pkg)
+        return None
+
+
+def write_merge_report(report, target, our_version):
+    if report is None:
+        return
+    pkg = our_version.package
+    output_dir = result_dir(target.name, pkg.name)
+    try:
+        report.write_report(output_dir)
+        save_fingerprint(output_dir,
+                         merge_fingerprint(target, our_version,
+                                           UpdateInfo(pkg)),
+                         report.result)
+    except Exception:
+        logging.exception('Failed handling merge for %s', pkg)
+
+
+def fingerprint_file(output_dir):
+    return "%s/REPORT.fingerprint" % output_dir
+
+
+def merge_fingerprint(target, our_version, update_info):
+    """Return what a merge report depends on, short of the contents of the
+    pool: the versions merged, this version of MoM and the target's
+    configuration.
+    """
+    settings = json.dumps([target.config(), config.get('LOCAL_SUFFIX')],
+                          sort_keys=True, default=repr)
+    return {
+        'left_version': str(our_version.version),
+        'right_version': str(update_info.upstream_version),
+        'base_version': str(update_info.base_version),
+        'mom_version': str(VERSION),
+        'config': hashlib.sha1(settings).hexdigest(),
+    }
+
+
+def read_fingerprint(output_dir):
+    """Return the fingerprint saved with the report in output_dir, with the
+    result of that report, or None.
+    """
+    try:
+        with open(fingerprint_file(output_dir)) as fd:
+            return json.load(fd)
+    except (IOError, ValueError):
+        return None
+
+
+def save_fingerprint(output_dir, fingerprint, result):
+    filename = fingerprint_file(output_dir)
+    saved = dict(fingerprint, result=str(result))
+    tree.ensure(filename)
+    with open(filename + '.tmp', 'w') as fd:
+        json.dump(saved, fd, sort_keys=True)
+    os.rename(filename + '.tmp', filename)
+
+
+def is_up_to_date(saved, fingerprint, sync):
+    """Return True if saved, as returned by read_fingerprint(), says the
+    report made from fingerprint needn't be made again. Merges that failed,
+    had no base or had some unknown result are tried again, as are syncs
+    that didn't happen while there was something newer to sync to.
+    """
+    if saved is None:
+        return False
+    saved = dict(saved)
+    result = saved.pop('result', None)
+    if saved != fingerprint:
+        return False
+    if sync:
+        return result in (MergeResult.SYNC_THEIRS, MergeResult.KEEP_OURS)
+    return result in (MergeResult.KEEP_OURS, MergeResult.SYNC_THEIRS,
+                      MergeResult.MERGED, MergeResult.CONFLICTS)
+
+
+class LogCollector(logging.Handler):
+    """Keep the log records of a worker process, so that the parent can log
+    them with the rest of its output.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        # Flatten the record so that it can be pickled
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        self.records.append(record)
+
+
+def init_worker(scratch):
+    # Set up a process in the pool with a scratch directory of its own to
+    # merge in, and its log records kept to be passed back to the parent
+    path = "%s/%d" % (scratch, os.getpid())
+    tree.remove(path)
+    set_scratch_root(path)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+
+
+def merge_worker(options, items):
+    # Produce the report for each (target name, package name, version) in
+    # items, in order, in a worker process. Return a (report, log records)
+    # pair for each, and the seconds it took.
+    start = time.time()
+    results = []
+    root = logging.getLogger()
+    for (target_name, name, version) in items:
+        target = config.Target(target_name)
+        pkg = Package(target.distro, target.dist, target.component, name)
+        collector = LogCollector()
+        root.addHandler(collector)
+        try:
+            report = produce_report(options, target,
+                                    PackageVersion(pkg, version))
+        finally:
+            root.removeHandler(collector)
+        results.append((report, collector.records))
+    return (results, time.time() - start)
+
+
+def source_size(items):
+    # Return the total size of the source files of our version in each of
+    # the (target, our_version) pairs in items
+    size = 0
+    for (target, our_version) in items:
+        try:
+            size += sum(int(size) for (md5sum, size, name)
+                        in files(our_version.getPoolEntry()))
+        except (IOError, KeyError, ValueError):
+            pass
+    return size
+
+
+def free_space(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def merge_times_file():
+    return "%s/merge-times.json" % config.get('ROOT')
+
+
+def load_merge_times():
+    """Return {package name: [source size, seconds]} for the last merges
+    produced.
+    """
+    try:
+        with open(merge_times_file()) as fd:
+            return json.load(fd)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_merge_times(times):
+    filename = merge_times_file()
+    tree.ensure(filename)
+    with open(filename + '.tmp', 'w') as fd:
+        json.dump(times, fd, sort_keys=True, indent=1)
+    os.rename(filename + '.tmp', filename)
+
+
+def predict_time(name, size, history):
+    """Return how many seconds the merges of the named package, whose
+    sources add up to size bytes, are expected to take: as long as last
+    time if it was the same size, or otherwise at the rate at which past
+    merges got through their sources.
+    """
+    if name in history and history[name][0] == size:
+        return history[name][1]
+
+    total_size = sum(s for (s, seconds) in history.itervalues())
+    total_seconds = sum(seconds for (s, seconds) in history.itervalues())
+    if total_size and total_seconds:
+        rate = total_size / total_seconds
+    else:
+        rate = DEFAULT_MERGE_RATE
+    return size / float(rate)
+
+
+def log_merge_times(tasks, elapsed):
+    # Log how long the merges took against how long they were expected
+    # to, given the (name, items, size, predicted, actual) of each task
+    # and the seconds taken by the stage as a whole
+    predicted = sum(task[3] for task in tasks)
+    actual = sum(task[4] for task in tasks)
+    logger.info('Produced merges for %d packages in %.1fs: %.1fs of work, '
+                '%.1fs predicted', len(tasks), elapsed, actual, predicted)
+    for (name, items, size, predicted, actual) in \
+            sorted(tasks, key=lambda t: t[4], reverse=True)[:SUMMARY_LENGTH]:
+        logger.info('  %s: %.1fs, %.1fs predicted (%d bytes of source)',
+                    name, actual, predicted, size)
+
+
+def produce_merges(options, work, jobs=1):
+    # Produce the merges for each of the (target, our_version) lists in
+    # work, up to jobs lists at a time. Each list holds the same package
+    # name in different targets, which share patches and so are handled
+    # one after another, in order.
+    #
+    # The lists are started longest first, going by how long each is
+    # predicted to take, so that the run doesn't end waiting on one huge
+    # package started last. How long each took is recorded for the next
+    # prediction, and compared with the prediction at the end.
+    #
+    # Packages whose merges will need to be tried again, having failed or
+    # had no base, are kept pending for the next run.
+    #
+    # Workers merge in scratch directories of their own, sharing the
+    # unpacked source cache with each other and the other stages, and
+    # send back their reports and log records so that those are written
+    # and logged here, just as they are when working serially. A list is
+    # only started if there looks to be enough disk space for it on top
+    # of that reserved by the others.
+    start = time.time()
+    history = load_merge_times()
+    pending = []
+    for items in work:
+        name = items[0][1].package.name
+        size = source_size(items)
+        pending.append([name, items, size,
+                        predict_time(name, size, history), None])
+    pending.sort(key=lambda task: task[3], reverse=True)
+    done = []
+    # Packages whose merges had already been produced, and so took no time
+    # worth remembering
+    skipped = set()
+
+    if jobs <= 1 or len(work) <= 1:
+        for task in pending:
+            task_start = time.time()
+            reports = [produce_report(options, target, our_version)
+                       for (target, our_version) in task[1]]
+            task[4] = time.time() - task_start
+            for ((target, our_version), report) in zip(task[1], reports):
+                write_merge_report(report, target, our_version)
+            if not any(report is not None for report in reports):
+                skipped.add(task[0])
+            done.append(task)
+    else:
+        produce_merges_pool(options, pending, done, skipped, jobs)
+
+    for (name, items, size, predicted, actual) in done:
+        if name not in skipped:
+            history[name] = [size, actual]
+    save_merge_times(history)
+    log_merge_times(done, time.time() - start)
+
+    retry = unsettled_packages(work)
+    if retry:
+        logger.info('%d merges will be tried again next run: %s',
+                    len(retry), ', '.join(sorted(retry)))
+        ChangeTracker().defer(retry)
+
+
+def unsettled_packages(work):
+    # Return the names of the packages in work whose reports, going by
+    # their fingerprints, are to be produced again, including those whose
+    # merges raised an exception and so have no new report at all
+    names = set()
+    for items in work:
+        for (target, our_version) in items:
+            pkg = our_version.package
+            try:
+                fingerprint = merge_fingerprint(target, our_version,
+                                                UpdateInfo(pkg))
+            except Exception:
+                logger.exception('Failed checking merge for %s', pkg)
+                names.add(pkg.name)
+                continue
+            saved = read_fingerprint(result_dir(target.name, pkg.name))
+            if not is_up_to_date(saved, fingerprint,
+                                 pkg.name in target.sync_upstream_packages):
+                names.add(pkg.name)
+    return names
+
+
+def produce_merges_pool(options, pending, done, skipped, jobs):
+    # Carry out the [name, items, size, predicted, actual] tasks in
+    # pending with a pool of jobs worker processes, filling in how long
+    # each took and moving it to done, and adding the names of those that
+    # didn't need merging to skipped.
+    scratch = "%s/scratch" % config.get('ROOT')
+    min_free = config.get('MERGE_MIN_FREE_SPACE', default=1 << 30)
+    pool = multiprocessing.Pool(jobs, init_worker, (scratch,))
+    running = []
+    try:
+        while pending or running:
+            while pending and len(running) < jobs:
+                task = pending[0]
+                space = task[2] * SPACE_FACTOR
+                reserved = sum(r[2] for r in running)
+                if running and \
+                        free_space(config.get('ROOT')) - reserved - space \
+                        < min_free:
+                    logger.debug('Waiting for disk space to merge %s',
+                                 task[0])
+                    break
+                pending.pop(0)
+                args = [(target.name, our_version.package.name,
+                         our_version.version)
+                        for (target, our_version) in task[1]]
+                running.append((pool.apply_async(merge_worker,
+                                                 (options, args)),
+                                task, space))
+
+            finished = [r for r in running if r[0].ready()]
+            if not finished:
+                running[0][0].wait(0.1)
+                continue
+
+            for r in finished:
+                running.remove(r)
+                (result, task, space) = r
+                try:
+                    (reports, task[4]) = result.get()
+                except Exception:
+                    logger.exception('Failed handling merge for %s',
+                                     task[0])
+                    continue
+                for ((target, our_version), (report, records)) in \
+                        zip(task[1], reports):
+                    for record in records:
+                        logging.getLogger(record.name).handle(record)
+                    write_merge_report(report, target, our_version)
+                if not any(report is not None for (report, records)
+                           in reports):
+                    skipped.add(task[0])
+                done.append(task)
+    finally:
+        pool.close()
+        pool.join()
+        tree.remove(scratch)
+
+
 def main(options, args):
     logger.info('Producing merges...')
 
@@ -229,13 +614,16 @@ def main(options, args):
     # For each package in the destination distribution, locate the latest in
     # the source distribution; calculate the base from the destination and
     # produce a merge combining both sets of changes
+    wanted = package_filter(options)
+    work = []
+    byName = {}
     for target in config.targets(args):
         logger.info('considering target %s', target)
         our_dist = target.dist
         our_component = target.component
         d = target.distro
         for pkg in d.packages(target.dist, target.component):
-            if options.package is not None and pkg.name not in options.package:
+            if not wanted(pkg.name):
                 continue
             if len(includes) and pkg.name not in includes:
                 logger.info('skipping package %s: not in include list',
@@ -256,14 +644,12 @@ def main(options, args):
                 our_version = pkg.newestVersion()
                 logger.debug('our version: %s', our_version)
 
-            output_dir = result_dir(target.name, pkg.name)
-            try:
-                report = handle_package(options, output_dir, target, pkg,
-                                        our_version)
-                if report is not None:
-                    report.write_report(output_dir)
-            except Exception:
-                logging.exception('Failed handling merge for %s', pkg)
+            if pkg.name not in byName:
+                byName[pkg.name] = []
+                work.append(byName[pkg.name])
+            byName[pkg.name].append((target, our_version))
+
+    produce_merges(options, work, options.jobs)
 
 
 def is_build_metadata_changed(left_source, right_source):
@@ -433,10 +819,13 @@ def create_source(package, version, since, output_dir, merged_dir):
 def create_patch(version, filename, merged_dir, basis, basis_dir):
     """Create the merged patch."""
 
+    # Diff the trees where they are, through symlinks named after their
+    # versions so that those are what the patch's paths start with
     parent = tempfile.mkdtemp()
     try:
-        tree.copytree(merged_dir, "%s/%s" % (parent, version))
-        tree.copytree(basis_dir, "%s/%s" % (parent, basis.version))
+        os.symlink(os.path.abspath(merged_dir), "%s/%s" % (parent, version))
+        os.symlink(os.path.abspath(basis_dir),
+                   "%s/%s" % (parent, basis.version))
 
         with open(filename, "w") as diff:
             shell.run(("diff", "-pruN",
@@ -466,12 +855,12 @@ def read_package_list(filename):
     return packages
 
 
-def save_changelog(output_dir, cl_versions, pv, bases, limit=None):
+def save_changelog(output_dir, changelog, pv, bases, limit=None):
     fh = None
     name = None
     n = 0
 
-    for (v, text) in cl_versions:
+    for (v, text) in changelog_entries(changelog):
         n += 1
 
         if v in bases:
@@ -503,20 +892,21 @@ def __produce_merge(target, base, base_dir, left, left_dir,
 
     cleanup(output_dir)
 
-    downstream_versions = read_changelog(left_dir + '/debian/changelog')
-    upstream_versions = read_changelog(upstream_dir + '/debian/changelog')
+    downstream_changelog = source_changelog(left)
+    upstream_changelog = source_changelog(upstream)
 
-    report.left_changelog = save_changelog(output_dir, downstream_versions,
+    report.left_changelog = save_changelog(output_dir, downstream_changelog,
                                            left, [base.version])
 
     # If the base is a common ancestor, log everything from the ancestor
     # to the current version. Otherwise just log the first entry.
     limit = 1
-    for upstream_version, text in upstream_versions:
+    for upstream_version, offset, length in \
+            read_changelog(upstream_changelog):
         if upstream_version == base.version:
             limit = None
             break
-    report.right_changelog = save_changelog(output_dir, upstream_versions,
+    report.right_changelog = save_changelog(output_dir, upstream_changelog,
                                             upstream, [base.version], limit)
 
     report.set_base(base)
@@ -569,10 +959,10 @@ def __produce_merge(target, base, base_dir, left, left_dir,
 
     try:
         merger = DebTreeMerger(left_dir, left.package.name,
-                               left.getDscContents()['Format'],
+                               left.getPoolEntry()['Format'],
                                left.package.distro.name,
                                upstream_dir, upstream.package.name,
-                               upstream.getDscContents()['Format'],
+                               upstream.getPoolEntry()['Format'],
                                upstream.package.distro.name,
                                base_dir, merged_dir)
         merger.run()
@@ -659,13 +1049,6 @@ def __produce_merge(target, base, base_dir, left, left_dir,
                 left.getDscContents(), dsc)
             report.merged_files = [src_file] + [f[2] for f in files(dsc)]
 
-            # Some of our merge magic may have tweaked the upstream and left
-            # dirs. Recreate them now so that the diff is accurate.
-            cleanup_source(upstream)
-            upstream_dir = unpack_source(upstream)
-            cleanup_source(left)
-            left_dir = unpack_source(left)
-
             report.merged_patch = create_patch(
                 report.merged_version,
                 "%s/%s_%s_from-theirs.patch" % (output_dir, left.package.name,
@@ -691,14 +1074,18 @@ def __produce_merge(target, base, base_dir, left, left_dir,
 
 def produce_merge(target, base, left, upstream, output_dir):
     left_dir = unpack_source(left)
-    upstream_dir = unpack_source(upstream)
-    base_dir = unpack_source(base)
     try:
-        return __produce_merge(target, base, base_dir, left, left_dir,
-                               upstream, upstream_dir, output_dir)
+        upstream_dir = unpack_source(upstream)
+        try:
+            base_dir = unpack_source(base)
+            try:
+                return __produce_merge(target, base, base_dir, left, left_dir,
+                                       upstream, upstream_dir, output_dir)
+            finally:
+                cleanup_source(base)
+        finally:
+            cleanup_source(upstream)
     finally:
-        cleanup_source(upstream)
-        cleanup_source(base)
         cleanup_source(left)
 
 
@@ -64,8 +64,9 @@ def main(options, args):
         stats["needs-merge"] = 0
         stats["repackaged"] = 0
         stats["modified"] = 0
+        update_infos = UpdateInfo.load_all(target.distro)
         for pkg in target.distro.packages(target.dist, target.component):
-            update_info = UpdateInfo(pkg)
+            update_info = UpdateInfo(pkg, update_infos.get(pkg.name, {}))
             upstream = update_info.upstream_version
             base = update_info.base_version
 
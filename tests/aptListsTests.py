@@ -0,0 +1,213 @@
+import gzip
+import hashlib
+import os
+import shutil
+import StringIO
+import tempfile
+import time
+import unittest
+
+import config
+from model import Distro
+from util.aptlists import SourcesFetcher, apply_ed, uri_to_filename
+from util.download import Downloader
+
+import testhelper as th
+
+
+def gzipped(data):
+    buf = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as fd:
+        fd.write(data)
+    return buf.getvalue()
+
+
+def checksum_line(name, data):
+    return ' %s %d %s\n' % (hashlib.sha256(data).hexdigest(), len(data), name)
+
+
+SOURCES_1 = 'Package: foo\nVersion: 1.0\n\nPackage: bar\nVersion: 2.0\n'
+SOURCES_2 = 'Package: foo\nVersion: 1.1\n\nPackage: bar\nVersion: 2.0\n' \
+    '\nPackage: baz\nVersion: 3.0\n'
+# An ed script turning SOURCES_1 into SOURCES_2
+PATCH = '5a\n\nPackage: baz\nVersion: 3.0\n.\n2c\nVersion: 1.1\n.\n'
+SOURCES_3 = SOURCES_2.replace('1.1', '1.2')
+
+
+class ApplyEdTest(unittest.TestCase):
+    def test_apply(self):
+        lines = SOURCES_1.splitlines(True)
+        apply_ed(lines, PATCH.splitlines(True))
+        self.assertEqual(''.join(lines), SOURCES_2)
+
+        lines = ['a\n', 'b\n', 'c\n', 'd\n']
+        apply_ed(lines, ['2,3d\n', '0a\n', 'z\n', '.\n'])
+        self.assertEqual(lines, ['z\n', 'a\n', 'd\n'])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, apply_ed, ['a\n'], ['5d\n'])
+        self.assertRaises(ValueError, apply_ed, ['a\n'], ['s/.//\n'])
+        self.assertRaises(ValueError, apply_ed, ['a\n'], ['1a\n', 'b\n'])
+
+
+class UriToFilenameTest(unittest.TestCase):
+    def test_uriToFilename(self):
+        self.assertEqual(
+            uri_to_filename('http://deb.debian.org/debian/dists/sid/'
+                            'main/source/Sources'),
+            'deb.debian.org_debian_dists_sid_main_source_Sources')
+        self.assertEqual(uri_to_filename('file:///srv/mirror/dists/x_y'),
+                         '_srv_mirror_dists_x%5fy')
+        self.assertEqual(uri_to_filename('http://user:pw@host:8080/a~b'),
+                         'host:8080_a%7eb')
+
+
+class SourcesFetcherTest(unittest.TestCase):
+    def setUp(self):
+        th.config_create_root()
+        self.mirror = th.TestHTTPMirror()
+        th.config_add_distro('fetchdistro', self.mirror.url)
+        config.configdb.DISTROS['fetchdistro']['sources_fetcher'] = 'direct'
+        Distro.DOWNLOADERS.clear()
+        self.distro = Distro.get('fetchdistro')
+        self.mtime = time.time() - 1000
+
+    def tearDown(self):
+        self.mirror.close()
+        Distro.DOWNLOADERS.clear()
+
+    def publish(self, sources, patches=(), merged=False):
+        # Put a release on the mirror whose Sources is sources, with pdiffs
+        # for each (old Sources, ed script) in patches, each leading to the
+        # next or, if merged, to sources
+        files = {'main/source/Sources.gz': gzipped(sources)}
+        if patches:
+            index = 'SHA256-Current: %s %d\n' % (
+                hashlib.sha256(sources).hexdigest(), len(sources))
+            if merged:
+                index += 'X-Patch-Precedence: merged\n'
+            history = patch_lines = download_lines = ''
+            for (i, (old, patch)) in enumerate(patches):
+                name = 'T-%d' % i
+                history += checksum_line(name, old)
+                patch_lines += checksum_line(name, patch)
+                files['main/source/Sources.diff/%s.gz' % name] = \
+                    gzipped(patch)
+                download_lines += checksum_line(
+                    name + '.gz', files['main/source/Sources.diff/%s.gz' %
+                                        name])
+            index += 'SHA256-History:\n' + history
+            index += 'SHA256-Patches:\n' + patch_lines
+            index += 'SHA256-Download:\n' + download_lines
+            files['main/source/Sources.diff/Index'] = index
+
+        release = 'Suite: stable\nSHA256:\n'
+        release += checksum_line('main/source/Sources', sources)
+        for name in sorted(files):
+            if not name.startswith('main/source/Sources.diff/T-'):
+                release += checksum_line(name, files[name])
+        files['InRelease'] = '-----BEGIN PGP SIGNED MESSAGE-----\n' \
+            'Hash: SHA256\n\n%s-----BEGIN PGP SIGNATURE-----\n\nxyz\n' \
+            '-----END PGP SIGNATURE-----\n' % release
+
+        for (name, data) in files.iteritems():
+            self.mirror.add_file('dists/stable/' + name, data)
+        # Make sure the new InRelease looks modified
+        self.mtime += 10
+        os.utime(os.path.join(self.mirror.path, 'dists/stable/InRelease'),
+                 (self.mtime, self.mtime))
+        del self.mirror.requests[:]
+
+    def sources(self):
+        filename = self.distro.sourcesFile('stable', 'main')
+        self.assertTrue(filename is not None)
+        with open(filename) as fd:
+            return fd.read()
+
+    # The first update downloads Sources in full, and the next only
+    # asks whether InRelease has changed
+    def test_update(self):
+        self.publish(SOURCES_1)
+        self.assertTrue(self.distro.updateSources('stable'))
+        self.assertEqual(self.sources(), SOURCES_1)
+        self.assertEqual(
+            os.path.basename(self.distro.sourcesFile('stable', 'main')),
+            uri_to_filename(self.mirror.url) +
+            '_dists_stable_main_source_Sources')
+        self.assertEqual(
+            self.distro.getSourcesIndex('stable', 'main').versions('foo'),
+            ['1.0'])
+
+        del self.mirror.requests[:]
+        self.assertFalse(self.distro.updateSources('stable'))
+        self.assertEqual(self.mirror.requests, ['/dists/stable/InRelease'])
+
+    # A changed Sources is patched rather than downloaded again
+    def test_pdiff(self):
+        self.publish(SOURCES_1)
+        self.distro.updateSources('stable')
+
+        self.publish(SOURCES_2, [(SOURCES_1, PATCH)])
+        self.assertTrue(self.distro.updateSources('stable'))
+        self.assertEqual(self.sources(), SOURCES_2)
+        self.assertEqual(self.mirror.requests,
+                         ['/dists/stable/InRelease',
+                          '/dists/stable/main/source/Sources.diff/Index',
+                          '/dists/stable/main/source/Sources.diff/T-0.gz'])
+
+    # Only the one merged pdiff for the version we have is applied
+    def test_mergedPdiff(self):
+        self.publish(SOURCES_1)
+        self.distro.updateSources('stable')
+
+        self.publish(SOURCES_3, [(SOURCES_1, PATCH.replace('1.1', '1.2')),
+                                 (SOURCES_2, '2c\nVersion: 1.2\n.\n')],
+                     merged=True)
+        self.assertTrue(self.distro.updateSources('stable'))
+        self.assertEqual(self.sources(), SOURCES_3)
+        self.assertEqual(self.mirror.requests,
+                         ['/dists/stable/InRelease',
+                          '/dists/stable/main/source/Sources.diff/Index',
+                          '/dists/stable/main/source/Sources.diff/T-0.gz'])
+
+    # A component missing from the release is skipped, not fatal
+    def test_missingComponent(self):
+        config.configdb.DISTROS['fetchdistro']['components'] = ['main',
+                                                                'contrib']
+        self.publish(SOURCES_1)
+        self.assertTrue(self.distro.updateSources('stable'))
+        self.assertEqual(self.sources(), SOURCES_1)
+        self.assertEqual(self.distro.sourcesFile('stable', 'contrib'), None)
+
+        del self.mirror.requests[:]
+        self.assertFalse(self.distro.updateSources('stable'))
+        self.assertEqual(self.mirror.requests, ['/dists/stable/InRelease'])
+
+    # A pdiff that doesn't apply is ignored in favour of the whole file
+    def test_badPdiff(self):
+        self.publish(SOURCES_1)
+        self.distro.updateSources('stable')
+
+        self.publish(SOURCES_2, [(SOURCES_1, '2c\nVersion: 9\n.\n')])
+        self.assertTrue(self.distro.updateSources('stable'))
+        self.assertEqual(self.sources(), SOURCES_2)
+        self.assertIn('/dists/stable/main/source/Sources.gz',
+                      self.mirror.requests)
+
+    # A Release file is used if there is no InRelease, such as on
+    # file:// mirrors
+    def test_release(self):
+        self.publish(SOURCES_1)
+        path = os.path.join(self.mirror.path, 'dists/stable')
+        os.rename(os.path.join(path, 'InRelease'),
+                  os.path.join(path, 'Release'))
+        listsdir = tempfile.mkdtemp(prefix='momtest.lists.')
+        try:
+            fetcher = SourcesFetcher('file://' + self.mirror.path, 'stable',
+                                     ['main'], listsdir, Downloader())
+            self.assertTrue(fetcher.update())
+            with open(fetcher.sourcesPath('main')) as fd:
+                self.assertIn('Package: foo', fd.read())
+            self.assertFalse(fetcher.update())
+        finally:
+            shutil.rmtree(listsdir)
@@ -0,0 +1,70 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from util.blobstore import BlobStore
+
+
+class BlobStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='momtest.blobs.')
+        self.blobs = BlobStore(os.path.join(self.root, 'blobs'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, contents):
+        filename = os.path.join(self.root, name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as fd:
+            fd.write(contents)
+        return (filename, hashlib.sha256(contents).hexdigest())
+
+    def test_link(self):
+        (filename, sha256) = self.write('pool/a/foo.tar.xz', 'foo')
+        other = os.path.join(self.root, 'pool/b/foo.tar.xz')
+        self.assertFalse(self.blobs.link(sha256, other))
+
+        self.blobs.add(filename, sha256)
+        self.assertTrue(self.blobs.link(sha256, other))
+        self.assertEqual(os.stat(other).st_ino, os.stat(filename).st_ino)
+        self.assertEqual(os.stat(filename).st_nlink, 3)
+
+    # Adding a second copy of a blob replaces it with a link
+    def test_addDuplicate(self):
+        (first, sha256) = self.write('pool/a/foo.tar.xz', 'foo')
+        (second, sha256) = self.write('pool/b/foo.tar.xz', 'foo')
+        self.blobs.add(first, sha256)
+        self.blobs.add(second, sha256)
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        with open(second) as fd:
+            self.assertEqual(fd.read(), 'foo')
+
+    # The blob goes with the last pool file that links to it
+    def test_release(self):
+        (first, sha256) = self.write('pool/a/foo.tar.xz', 'foo')
+        self.blobs.add(first, sha256)
+        second = os.path.join(self.root, 'pool/b/foo.tar.xz')
+        self.blobs.link(sha256, second)
+
+        self.blobs.release(first, sha256)
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(self.blobs.blob_path(sha256)))
+
+        self.blobs.release(second)
+        self.assertFalse(os.path.exists(second))
+        self.assertFalse(os.path.exists(self.blobs.blob_path(sha256)))
+
+    def test_collect(self):
+        (kept, kept_sha256) = self.write('pool/a/foo.tar.xz', 'foo')
+        (gone, gone_sha256) = self.write('pool/a/bar.tar.xz', 'barbar')
+        self.blobs.add(kept, kept_sha256)
+        self.blobs.add(gone, gone_sha256)
+        os.unlink(gone)
+
+        self.assertEqual(self.blobs.collect(), (1, 6))
+        self.assertTrue(os.path.exists(self.blobs.blob_path(kept_sha256)))
+        self.assertFalse(os.path.exists(self.blobs.blob_path(gone_sha256)))
@@ -0,0 +1,151 @@
+import gzip
+import os
+import StringIO
+import tarfile
+import tempfile
+import unittest
+
+from deb.version import Version
+from model import Distro
+from model.base import Package, PackageVersion, PoolIndex
+from momlib import (changelog_entries, changelog_file, changelog_text,
+                    extract_changelog, read_changelog, source_changelog)
+from util import shell
+
+import testhelper as th
+
+
+CHANGELOG = """foo (1.0-2) unstable; urgency=low
+
+  * Second.
+
+ -- Someone <someone@example.com>  Mon, 02 Jan 2017 00:00:00 +0000
+
+foo (1.0-1) unstable; urgency=low
+
+  * First.
+
+ -- Someone <someone@example.com>  Sun, 01 Jan 2017 00:00:00 +0000
+"""
+
+
+class ExtractChangelogTest(unittest.TestCase):
+    def setUp(self):
+        th.config_create_root()
+        th.config_add_distro('cldistro', 'file:///nonexistent')
+        PoolIndex.CACHE.clear()
+        self.pkg = Package(Distro.get('cldistro'), 'stable', 'main', 'foo')
+        os.makedirs(self.pkg.poolPath)
+
+    def tearDown(self):
+        PoolIndex.CACHE.clear()
+
+    def addSource(self, version, names):
+        # Write a .dsc listing names, which must already be in the pool
+        with open('%s/foo_%s.dsc' % (self.pkg.poolPath, version), 'w') as fd:
+            fd.write('Format: 3.0 (quilt)\nSource: foo\nVersion: %s\n'
+                     'Files:\n' % version)
+            for name in names:
+                fd.write(' 0123 45 %s\n' % name)
+        PoolIndex.CACHE.clear()
+        return PackageVersion(self.pkg, Version(version))
+
+    def writeDebianTar(self, name, prefix=''):
+        filename = os.path.join(self.pkg.poolPath, name)
+        tar = tarfile.open(filename.replace('.xz', ''), 'w:gz'
+                           if name.endswith('.gz') else 'w')
+        for (member, data) in (('debian/control', 'Source: foo\n'),
+                               ('debian/changelog', CHANGELOG),
+                               ('debian/rules', '#!/usr/bin/make -f\n')):
+            info = tarfile.TarInfo(prefix + member)
+            info.size = len(data)
+            tar.addfile(info, StringIO.StringIO(data))
+        tar.close()
+        if name.endswith('.xz'):
+            shell.run(('xz', filename.replace('.xz', '')))
+
+    def writeDiff(self, name, old_start='0,0'):
+        lines = ['--- foo-1.0.orig/README\n', '+++ foo-1.0/README\n',
+                 '@@ -1 +1,2 @@\n', ' readme\n', '+more\n',
+                 '--- foo-1.0.orig/debian/changelog\n',
+                 '+++ foo-1.0/debian/changelog\n']
+        cl_lines = CHANGELOG.splitlines(True)
+        lines.append('@@ -%s +1,%d @@\n' % (old_start, len(cl_lines)))
+        lines.extend('+' + line for line in cl_lines)
+        lines.extend(['--- foo-1.0.orig/debian/rules\n',
+                      '+++ foo-1.0/debian/rules\n', '@@ -0,0 +1 @@\n',
+                      '+#!/usr/bin/make -f\n'])
+        with gzip.open(os.path.join(self.pkg.poolPath, name), 'wb') as fd:
+            fd.writelines(lines)
+
+    def test_debianTarGz(self):
+        self.writeDebianTar('foo_1.0-2.debian.tar.gz')
+        pv = self.addSource('1.0-2', ['foo_1.0.orig.tar.gz',
+                                      'foo_1.0-2.debian.tar.gz'])
+        self.assertEqual(extract_changelog(pv), CHANGELOG)
+
+    def test_debianTarXz(self):
+        self.writeDebianTar('foo_1.0-2.debian.tar.xz', './')
+        pv = self.addSource('1.0-2', ['foo_1.0.orig.tar.gz',
+                                      'foo_1.0-2.debian.tar.xz'])
+        self.assertEqual(extract_changelog(pv), CHANGELOG)
+
+    def test_diffGz(self):
+        self.writeDiff('foo_1.0-2.diff.gz')
+        pv = self.addSource('1.0-2', ['foo_1.0.orig.tar.gz',
+                                      'foo_1.0-2.diff.gz'])
+        self.assertEqual(extract_changelog(pv), CHANGELOG)
+
+    # A diff that only changes the orig tarball's changelog isn't enough
+    def test_diffGzModifiesChangelog(self):
+        self.writeDiff('foo_1.0-2.diff.gz', '1,5')
+        pv = self.addSource('1.0-2', ['foo_1.0.orig.tar.gz',
+                                      'foo_1.0-2.diff.gz'])
+        self.assertEqual(extract_changelog(pv), None)
+
+    def test_native(self):
+        pv = self.addSource('1.0', ['foo_1.0.tar.gz'])
+        self.assertEqual(extract_changelog(pv), None)
+
+    # The changelog is kept, so the pool isn't looked at again
+    def test_sourceChangelog(self):
+        self.writeDebianTar('foo_1.0-2.debian.tar.gz')
+        pv = self.addSource('1.0-2', ['foo_1.0.orig.tar.gz',
+                                      'foo_1.0-2.debian.tar.gz'])
+        filename = source_changelog(pv)
+        self.assertEqual(filename, changelog_file(pv))
+        with open(filename) as fd:
+            self.assertEqual(fd.read(), CHANGELOG)
+
+        os.unlink(os.path.join(self.pkg.poolPath, 'foo_1.0-2.debian.tar.gz'))
+        self.assertEqual(source_changelog(pv), filename)
+
+
+class ReadChangelogTest(unittest.TestCase):
+    def setUp(self):
+        (fd, self.filename) = tempfile.mkstemp(prefix='momtest.changelog.')
+        with os.fdopen(fd, 'w') as cl:
+            cl.write('\n' + CHANGELOG + '\nold junk\n')
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def test_readChangelog(self):
+        entries = list(read_changelog(self.filename))
+        self.assertEqual([ver for (ver, offset, length) in entries],
+                         [Version('1.0-2'), Version('1.0-1'), None])
+        self.assertEqual(changelog_text(self.filename, *entries[0][1:]),
+                         CHANGELOG[:CHANGELOG.index('\n\nfoo (1.0-1)') + 1])
+        self.assertEqual(changelog_text(self.filename, *entries[2][1:]),
+                         'old junk\n')
+
+    # Nothing past the entries that are asked for is read
+    def test_stopEarly(self):
+        entries = read_changelog(self.filename)
+        self.assertEqual(next(entries)[0], Version('1.0-2'))
+        entries.close()
+
+        (ver, text) = next(changelog_entries(self.filename))
+        self.assertEqual(ver, Version('1.0-2'))
+        self.assertTrue(text.startswith('foo (1.0-2) unstable;'))
+        self.assertTrue(text.endswith('+0000\n'))
@@ -0,0 +1,81 @@
+import os
+import unittest
+
+import config
+from model import Distro
+from model.changes import ChangeTracker, package_filter
+from util import get_option_parser
+
+import testhelper as th
+
+
+class ChangeTrackerTest(unittest.TestCase):
+    def setUp(self):
+        th.config_create_root()
+        th.config_add_distro('changedistro', 'file:///nonexistent')
+        self.distro = Distro.get('changedistro')
+        self.tracker = ChangeTracker()
+
+    def tearDown(self):
+        Distro.SOURCES_CACHE.clear()
+
+    def writeSources(self, packages):
+        listsdir = os.path.join(config.get('ROOT'), 'dists',
+                                'changedistro-stable/var/lib/apt/lists')
+        if not os.path.isdir(listsdir):
+            os.makedirs(listsdir)
+        with open(os.path.join(listsdir,
+                               'mirror_dists_stable_main_source_Sources'),
+                  'w') as fd:
+            for (name, version) in packages:
+                fd.write('Package: %s\nVersion: %s\n\n' % (name, version))
+        Distro.SOURCES_CACHE.clear()
+
+    def detect(self):
+        return self.tracker.detect([(self.distro, 'stable', 'main')])
+
+    def filter(self, *args):
+        (options, args) = get_option_parser().parse_args(list(args))
+        return package_filter(options)
+
+    def test_detect(self):
+        self.assertEqual(self.tracker.pending(), None)
+        self.assertTrue(self.filter()('anything'))
+
+        self.writeSources([('foo', '1.0'), ('bar', '2.0'), ('baz', '3.0')])
+        self.assertEqual(self.detect(), set(['foo', 'bar', 'baz']))
+        self.tracker.finish()
+        self.assertEqual(self.tracker.pending(), set())
+        self.assertFalse(self.filter()('foo'))
+
+        # foo is upgraded, bar removed and qux added
+        self.writeSources([('foo', '1.1'), ('baz', '3.0'), ('qux', '1')])
+        self.assertEqual(self.detect(), set(['foo', 'bar', 'qux']))
+        self.assertTrue(self.filter()('foo'))
+        self.assertFalse(self.filter()('baz'))
+        self.assertTrue(self.filter('--full')('baz'))
+        self.assertTrue(self.filter('--force')('baz'))
+        self.assertTrue(self.filter('-p', 'baz')('baz'))
+        self.assertFalse(self.filter('-p', 'baz')('foo'))
+
+    # Changes stay pending until a run finishes, and deferred packages
+    # stay pending after that
+    def test_finish(self):
+        self.writeSources([('foo', '1.0'), ('bar', '2.0')])
+        self.detect()
+        self.tracker.finish()
+
+        self.writeSources([('foo', '1.1'), ('bar', '2.1')])
+        self.detect()
+        self.assertEqual(self.detect(), set(['foo', 'bar']))
+        self.tracker.defer(['bar'])
+        self.tracker.finish()
+        self.assertEqual(self.tracker.pending(), set(['bar']))
+        self.tracker.finish()
+        self.assertEqual(self.tracker.pending(), set())
+
+    # Until changes have been detected everything is pending, and
+    # deferring doesn't change that
+    def test_deferUndetected(self):
+        self.tracker.defer(['foo'])
+        self.assertEqual(self.tracker.pending(), None)
@@ -0,0 +1,83 @@
+from StringIO import StringIO
+import os
+import tempfile
+import unittest
+
+from deb.controlfile import ControlFile
+
+
+SOURCES = \
+    "Package: foo\n" \
+    "Version: 1.0-1\n" \
+    "Binary: foo,\n" \
+    " foo-doc\n" \
+    "directory: pool/main/f/foo\n" \
+    "\n" \
+    "\n" \
+    "Package: bar\n" \
+    "Version: 2.0\n" \
+    "Checksums-Sha256:\n" \
+    " abc 123 bar_2.0.dsc\n" \
+    " def 456 bar_2.0.tar.xz\n"
+
+
+class IterParasTest(unittest.TestCase):
+    # Paragraphs match what parse() would produce
+    def test_sameAsParse(self):
+        parsed = ControlFile(fileobj=StringIO(SOURCES), multi_para=True)
+        paras = list(ControlFile().iter_paras(StringIO(SOURCES)))
+        self.assertEqual(paras, parsed.paras)
+        self.assertEqual(paras[0]['Binary'], 'foo,\nfoo-doc')
+        self.assertEqual(paras[0]['Directory'], 'pool/main/f/foo')
+
+    # Only the requested fields are kept
+    def test_fields(self):
+        paras = list(ControlFile().iter_paras(StringIO(SOURCES),
+                                              ['Package', 'Binary']))
+        self.assertEqual(paras, [{'Package': 'foo', 'Binary': 'foo,\nfoo-doc'},
+                                 {'Package': 'bar'}])
+
+    def test_invalid(self):
+        with self.assertRaises(IOError):
+            list(ControlFile().iter_paras(StringIO(" continuation\n")))
+
+
+class MapParasTest(unittest.TestCase):
+    def setUp(self):
+        (fd, self.filename) = tempfile.mkstemp()
+        os.write(fd, SOURCES)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    # Mapped paragraphs compare equal to what iter_paras() produces
+    def test_sameAsIterParas(self):
+        paras = ControlFile().map_paras(self.filename)
+        self.assertEqual(paras, list(ControlFile().iter_paras(self.filename)))
+        self.assertEqual(paras[1]['Checksums-Sha256'],
+                         '\nabc 123 bar_2.0.dsc\ndef 456 bar_2.0.tar.xz')
+        self.assertTrue('Binary' in paras[0])
+        self.assertFalse('Binary' in paras[1])
+        self.assertEqual(paras[1].get('Binary', 'none'), 'none')
+
+    # Key fields are available without decoding the paragraph
+    def test_keys(self):
+        paras = ControlFile().map_paras(self.filename)
+        self.assertEqual([p.span[2] for p in paras],
+                         [('foo', '1.0-1'), ('bar', '2.0')])
+        self.assertEqual(paras[0]['Package'], 'foo')
+        self.assertEqual(paras[0]._fields, None)
+        self.assertEqual(paras[0]['Directory'], 'pool/main/f/foo')
+        self.assertNotEqual(paras[0]._fields, None)
+
+    # Spans from an earlier scan can be reused
+    def test_spans(self):
+        spans = [p.span for p in ControlFile().map_paras(self.filename)]
+        paras = ControlFile().map_paras(self.filename, spans=spans)
+        self.assertEqual(paras, list(ControlFile().iter_paras(self.filename)))
+
+    def test_empty(self):
+        with open(self.filename, 'w'):
+            pass
+        self.assertEqual(ControlFile().map_paras(self.filename), [])
@@ -284,6 +284,12 @@ class DebTreeMergerTest(unittest.TestCase):
         check_call(['patch', '-p1', '--dry-run', '--fuzz=0', '-i',
                     'debian/patches/one.patch'], cwd=self.merged_dir)
 
+        # Check that the patches were only pushed in copies of left and base
+        for path in (self.left_dir, self.base_dir):
+            self.assertFalse(os.path.exists(path + '/.pc'))
+            with open(path + '/myfile') as fd:
+                self.assertNotIn('=ubuntu', fd.read())
+
     # Our downstream changes just append a quilt patch to the end of the list.
     # Upstream then makes conflicting changes to the series file.
     # This should be merged by taking the new upstream series file and
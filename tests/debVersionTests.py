@@ -1,6 +1,6 @@
 import unittest
 
-from deb.version import Version
+from deb.version import Version, max_version, sort_versions
 
 import testhelper
 
@@ -30,3 +30,37 @@ class EpochTest(unittest.TestCase):
     def test_zeroEpoch(self):
         version = Version('0:1.2.3-4')
         self.assertEqual(str(version), '0:1.2.3-4')
+
+
+class CompareTest(unittest.TestCase):
+    def test_tilde(self):
+        self.assertTrue(Version('1.0~rc1') < Version('1.0'))
+        self.assertTrue(Version('1.0-1~bpo1') < Version('1.0-1'))
+        self.assertTrue(Version('1.0') > '1.0~')
+
+    def test_equal(self):
+        self.assertEqual(Version('1.0'), '1.00')
+        self.assertEqual(Version('1.0-0'), Version('1.0'))
+        self.assertEqual(Version('0:1.0'), Version('1.0'))
+        self.assertEqual(hash(Version('1.0-0')), hash(Version('1.0')))
+
+    def test_sort(self):
+        versions = [Version(v) for v in ('1:0.1', '1.0', '1.0a', '1.0.1',
+                                         '1.0~beta', '1.0-1')]
+        sort_versions(versions)
+        self.assertEqual([str(v) for v in versions],
+                         ['1.0~beta', '1.0', '1.0-1', '1.0a', '1.0.1',
+                          '1:0.1'])
+        self.assertEqual(str(max_version(versions)), '1:0.1')
+
+
+class InternTest(unittest.TestCase):
+    def test_interned(self):
+        self.assertIs(Version('1.2-3'), Version('1.2-3'))
+        self.assertIs(Version(Version('1.2-3')), Version('1.2-3'))
+
+    def test_immutable(self):
+        version = Version('1.2-3')
+        with self.assertRaises(AttributeError):
+            version.revision = '4'
+        self.assertEqual(str(version), '1.2-3')
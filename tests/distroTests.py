@@ -3,6 +3,7 @@ import shutil
 import os
 
 import config
+from model.base import Distro, SourcesIndex
 from model.error import PackageNotFound
 
 import testhelper as th
@@ -62,3 +63,86 @@ class DistroTest(unittest.TestCase):
         with self.assertRaises(PackageNotFound):
             target.distro.findPackage(foo.name, searchDist=target.dist,
                                       version="9")
+
+    # Test the newest-version table built from the Sources indexes
+    def test_findNewest(self):
+        th.build_and_import_simple_package('foo', '1.0', self.target_repo)
+        th.update_all_distro_sources()
+
+        target = config.targets()[0]
+        newest = target.distro.findNewest('foo', target.dist)
+        self.assertEqual(newest.version, '1.0')
+        self.assertEqual(newest.package.component, target.component)
+        self.assertEqual(target.distro.findNewest('bar', target.dist), None)
+
+        # The table is rebuilt when the Sources file is
+        th.build_and_import_simple_package('foo', '1.1', self.target_repo)
+        th.update_all_distro_sources()
+        self.assertEqual(
+            target.distro.findNewest('foo', target.dist).version, '1.1')
+
+    # Test the per-package lookups served by the Sources index
+    def test_sourcesIndex(self):
+        th.build_and_import_simple_package('foo', '1.0', self.target_repo)
+        th.build_and_import_simple_package('bar', '2.0', self.target_repo)
+        th.update_all_distro_sources()
+
+        target = config.targets()[0]
+        pkgs = target.distro.packages(target.dist, target.component)
+        self.assertEqual([p.name for p in pkgs], ['bar', 'foo'])
+
+        foo = target.distro.package(target.dist, target.component, 'foo')
+        self.assertEqual(foo.newestVersion().version, '1.0')
+        self.assertEqual(len(foo.getCurrentSources()), 1)
+
+        with self.assertRaises(PackageNotFound):
+            target.distro.package(target.dist, target.component, 'baz')
+
+    # Test that the Sources index is snapshotted and reused
+    def test_sourcesSnapshot(self):
+        th.build_and_import_simple_package('foo', '1.0', self.target_repo)
+        th.update_all_distro_sources()
+
+        target = config.targets()[0]
+        filename = target.distro.sourcesFile(target.dist, target.component)
+        self.assertTrue(os.path.isfile(SourcesIndex.snapshotPath(filename)))
+
+        Distro.SOURCES_CACHE.clear()
+        sources = target.distro.getSources(target.dist, target.component)
+        self.assertEqual(len(sources), 1)
+        self.assertEqual(sources[0]['Package'], 'foo')
+
+
+class NewestVersionsTest(unittest.TestCase):
+    def setUp(self):
+        th.config_create_root()
+        th.config_add_distro('newestdistro', 'file:///nonexistent',
+                             components=['main', 'contrib'])
+        self.distro = Distro.get('newestdistro')
+        Distro.SOURCES_CACHE.clear()
+        Distro.NEWEST_CACHE.clear()
+
+    def tearDown(self):
+        Distro.SOURCES_CACHE.clear()
+        Distro.NEWEST_CACHE.clear()
+
+    def writeSources(self, component, packages):
+        listsdir = os.path.join(config.get('ROOT'), 'dists',
+                                'newestdistro-stable/var/lib/apt/lists')
+        if not os.path.isdir(listsdir):
+            os.makedirs(listsdir)
+        with open(os.path.join(listsdir, 'mirror_dists_stable_%s_source_'
+                               'Sources' % component), 'w') as fd:
+            for (name, version) in packages:
+                fd.write('Package: %s\nVersion: %s\n\n' % (name, version))
+
+    # The newest version is picked across all the components
+    def test_newestVersions(self):
+        self.writeSources('main', [('foo', '1.0'), ('foo', '1:0.9'),
+                                   ('bar', '2.0')])
+        self.writeSources('contrib', [('foo', '1.1'), ('bar', '2.0~rc1')])
+        newest = self.distro.newestVersions('stable')
+        self.assertEqual(newest['foo'], ('1:0.9', 'main'))
+        self.assertEqual(newest['bar'], ('2.0', 'main'))
+        self.assertEqual(self.distro.findNewest('foo', 'stable').version,
+                         '1:0.9')
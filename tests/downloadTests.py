@@ -0,0 +1,267 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib2
+
+import config
+from model import Distro
+from util.download import Downloader
+
+import testhelper as th
+
+
+class DownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.mirror = th.TestHTTPMirror()
+        self.output_dir = tempfile.mkdtemp(prefix='momtest.download.')
+
+    def tearDown(self):
+        self.mirror.close()
+        shutil.rmtree(self.output_dir)
+
+    def output(self, name):
+        with open(os.path.join(self.output_dir, name)) as fd:
+            return fd.read()
+
+    # Sequential downloads share a single kept-alive connection
+    def test_connectionReuse(self):
+        downloader = Downloader(jobs=1)
+        for i in range(5):
+            url = self.mirror.add_file('pool/f%d' % i, 'file %d' % i)
+            downloader.fetch(url, os.path.join(self.output_dir, 'f%d' % i))
+
+        for i in range(5):
+            self.assertEqual(self.output('f%d' % i), 'file %d' % i)
+        self.assertEqual(self.mirror.connections, 1)
+
+    # No more than jobs files are downloaded at once, nor are there more
+    # connections than that
+    def test_fetchAll(self):
+        self.mirror.delay = 0.05
+        downloads = []
+        for i in range(12):
+            url = self.mirror.add_file('pool/f%d' % i, 'file %d' % i * 1000)
+            downloads.append((url, os.path.join(self.output_dir, 'f%d' % i)))
+
+        Downloader(jobs=3).fetch_all(downloads)
+
+        for i in range(12):
+            self.assertEqual(self.output('f%d' % i), 'file %d' % i * 1000)
+        self.assertEqual(len(self.mirror.requests), 12)
+        self.assertTrue(self.mirror.max_active <= 3)
+        self.assertTrue(self.mirror.connections <= 3)
+
+    # The limit holds across threads sharing a downloader too
+    def test_fetchAllShared(self):
+        self.mirror.delay = 0.05
+        downloads = [[], []]
+        for i in range(12):
+            url = self.mirror.add_file('pool/f%d' % i, 'file %d' % i)
+            downloads[i % 2].append(
+                (url, os.path.join(self.output_dir, 'f%d' % i)))
+
+        downloader = Downloader(jobs=2)
+        threads = [threading.Thread(target=downloader.fetch_all, args=(d,))
+                   for d in downloads]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for i in range(12):
+            self.assertEqual(self.output('f%d' % i), 'file %d' % i)
+        self.assertTrue(self.mirror.max_active <= 2)
+
+    # A missing file raises HTTPError, and the downloader stays usable
+    def test_notFound(self):
+        downloader = Downloader()
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            downloader.fetch(self.mirror.url + '/missing',
+                             os.path.join(self.output_dir, 'missing'))
+        self.assertEqual(cm.exception.code, 404)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.output_dir, 'missing')))
+
+        url = self.mirror.add_file('present', 'here')
+        self.assertEqual(downloader.read(url), 'here')
+
+    def test_fetchAllError(self):
+        downloads = [(self.mirror.add_file('a', 'a'),
+                      os.path.join(self.output_dir, 'a')),
+                     (self.mirror.url + '/missing',
+                      os.path.join(self.output_dir, 'missing'))]
+        with self.assertRaises(urllib2.HTTPError):
+            Downloader(jobs=2).fetch_all(downloads)
+
+    # The file is only put in place once its checksum has been verified
+    def test_checksum(self):
+        url = self.mirror.add_file('file', 'good')
+        filename = os.path.join(self.output_dir, 'file')
+        Downloader().fetch(url, filename, 4,
+                           hashlib.sha256('good').hexdigest())
+        self.assertEqual(self.output('file'), 'good')
+
+        os.unlink(filename)
+        with self.assertRaises(IOError):
+            Downloader().fetch(url, filename, 4,
+                               hashlib.sha256('bad').hexdigest())
+        self.assertEqual(len(self.mirror.requests), 4)
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+    # An interrupted download is carried on from where it stopped
+    def test_resume(self):
+        url = self.mirror.add_file('file', 'first half, second half')
+        filename = os.path.join(self.output_dir, 'file')
+        with open(filename + '.partial', 'w') as fd:
+            fd.write('first half, ')
+
+        Downloader().fetch(url, filename, 23)
+        self.assertEqual(self.output('file'), 'first half, second half')
+        self.assertEqual(self.mirror.range_requests, [('/file', 'bytes=12-')])
+        self.assertEqual(os.listdir(self.output_dir), ['file'])
+
+    # The whole file is fetched if the server doesn't support ranges
+    def test_resumeUnsupported(self):
+        self.mirror.ranges = False
+        url = self.mirror.add_file('file', 'first half, second half')
+        filename = os.path.join(self.output_dir, 'file')
+        with open(filename + '.partial', 'w') as fd:
+            fd.write('first half, ')
+
+        Downloader().fetch(url, filename, 23)
+        self.assertEqual(self.output('file'), 'first half, second half')
+        self.assertEqual(os.listdir(self.output_dir), ['file'])
+
+    # A partial file that doesn't belong to the current file is discarded
+    def test_resumeMismatch(self):
+        contents = 'first half, second half'
+        url = self.mirror.add_file('file', contents)
+        filename = os.path.join(self.output_dir, 'file')
+        with open(filename + '.partial', 'w') as fd:
+            fd.write('stale data, ')
+
+        Downloader().fetch(url, filename, len(contents),
+                           hashlib.sha256(contents).hexdigest())
+        self.assertEqual(self.output('file'), contents)
+        self.assertEqual(len(self.mirror.requests), 2)
+
+        # Likewise if the partial file is longer than the real one
+        os.unlink(filename)
+        with open(filename + '.partial', 'w') as fd:
+            fd.write(contents + ' and more')
+        Downloader().fetch(url, filename, len(contents))
+        self.assertEqual(self.output('file'), contents)
+
+    # A server that stops answering makes the download fail rather than
+    # hang
+    def test_timeout(self):
+        self.mirror.delay = 1
+        url = self.mirror.add_file('slow', 'slow')
+        with self.assertRaises(IOError):
+            Downloader(timeout=0.1).read(url)
+
+    # Downloads go through the proxy in http_proxy, if there is one
+    def test_proxy(self):
+        environ = dict(os.environ)
+        try:
+            os.environ['http_proxy'] = self.mirror.url
+            os.environ.pop('no_proxy', None)
+            downloader = Downloader()
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+        self.mirror.add_file('file', 'first half, second half')
+        url = 'http://mirror.invalid/file'
+        filename = os.path.join(self.output_dir, 'file')
+        with open(filename + '.partial', 'w') as fd:
+            fd.write('first half, ')
+
+        downloader.fetch(url, filename, 23)
+        self.assertEqual(self.output('file'), 'first half, second half')
+        self.assertEqual(self.mirror.range_requests, [(url, 'bytes=12-')])
+
+    def test_redirect(self):
+        self.mirror.add_file('new/file', 'moved')
+        self.mirror.redirects['/old/file'] = '/new/file'
+        self.assertEqual(Downloader().read(self.mirror.url + '/old/file'),
+                         'moved')
+
+
+class DownloadPackageTest(unittest.TestCase):
+    def setUp(self):
+        th.config_create_root()
+        self.mirror = th.TestHTTPMirror()
+        th.config_add_distro('httpdistro', self.mirror.url)
+        th.config_add_distro('otherdistro', self.mirror.url)
+        config.configdb.DISTROS['httpdistro']['download_jobs'] = 2
+        Distro.DOWNLOADERS.clear()
+
+        self.contents = {}
+        for name, version in (('foo', '1.0'), ('bar', '2.0')):
+            self.contents['%s_%s.dsc' % (name, version)] = \
+                'Source: %s\nVersion: %s\n' % (name, version)
+            self.contents['%s_%s.tar.xz' % (name, version)] = \
+                'tarball of %s %s' % (name, version)
+        for name, contents in self.contents.iteritems():
+            self.mirror.add_file('pool/main/%s/%s' % (name[0], name),
+                                 contents)
+
+        sources = ''
+        for name, version in (('foo', '1.0'), ('bar', '2.0')):
+            sources += 'Package: %s\nVersion: %s\n' % (name, version)
+            sources += 'Directory: pool/main/%s\nChecksums-Sha256:\n' % \
+                name[0]
+            for ext in ('dsc', 'tar.xz'):
+                filename = '%s_%s.%s' % (name, version, ext)
+                contents = self.contents[filename]
+                sha256 = hashlib.sha256(contents).hexdigest()
+                sources += ' %s %d %s\n' % (sha256, len(contents), filename)
+            sources += '\n'
+
+        for distro in ('httpdistro', 'otherdistro'):
+            listsdir = os.path.join(config.get('ROOT'), 'dists',
+                                    '%s-stable/var/lib/apt/lists' % distro)
+            os.makedirs(listsdir)
+            with open(os.path.join(listsdir,
+                                   'mirror_dists_stable_main_source_Sources'),
+                      'w') as fd:
+                fd.write(sources)
+
+    def tearDown(self):
+        self.mirror.close()
+        Distro.DOWNLOADERS.clear()
+
+    def test_downloadPackage(self):
+        distro = Distro.get('httpdistro')
+        self.assertEqual(distro.downloader().jobs, 2)
+        self.assertTrue(distro.downloadPackage('stable', 'main'))
+
+        for name, contents in self.contents.iteritems():
+            pkg = distro.package('stable', 'main', name.split('_')[0])
+            with open(os.path.join(pkg.poolPath, name)) as fd:
+                self.assertEqual(fd.read(), contents)
+        self.assertTrue(self.mirror.connections <= 2)
+
+        # Everything is already there the second time round
+        self.assertFalse(distro.downloadPackage('stable', 'main'))
+        self.assertEqual(len(self.mirror.requests), 4)
+
+        # The new .dsc files were recorded in the pool index
+        self.assertEqual(distro.getPoolIndex('main').versions('foo'), ['1.0'])
+
+    # Files already in another distro's pool are linked, not downloaded
+    def test_sharedBlobs(self):
+        Distro.get('httpdistro').downloadPackage('stable', 'main')
+        self.assertEqual(len(self.mirror.requests), 4)
+
+        other = Distro.get('otherdistro')
+        self.assertTrue(other.downloadPackage('stable', 'main'))
+        self.assertEqual(len(self.mirror.requests), 4)
+
+        pkg = other.package('stable', 'main', 'foo')
+        st = os.stat(os.path.join(pkg.poolPath, 'foo_1.0.tar.xz'))
+        self.assertEqual(st.st_nlink, 3)
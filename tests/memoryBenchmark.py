@@ -0,0 +1,55 @@
+# memoryBenchmark.py - measure the memory used by indexed Sources files
+#
+# Usage: python -m tests.memoryBenchmark SOURCES [SOURCES...]
+#
+# Each (uncompressed) Sources file is mapped and indexed the way
+# Distro.getSourcesIndex() does, then a PackageVersion is created for every
+# version of every source package, as a full run's currentVersions(),
+# findPackage() and getPoolVersions() calls do. The peak resident set size
+# is reported at each step.
+
+import gc
+import imp
+import resource
+import sys
+import time
+
+import config
+from deb.controlfile import ControlFile
+from model.base import Distro, Package, PackageVersion, SourcesIndex
+
+
+def maxrss():
+    """Return the peak resident set size of this process, in MiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def main(filenames):
+    config.loadConfig(imp.new_module('benchconfig'))
+    config.configdb.DISTROS = {'bench': {}}
+    distro = Distro('bench')
+
+    print "%-40s %10s %8s" % ("step", "RSS (MiB)", "secs")
+    print "%-40s %10.1f %8s" % ("start", maxrss(), "")
+
+    start = time.time()
+    indices = []
+    for filename in filenames:
+        indices.append(SourcesIndex(ControlFile().map_paras(filename)))
+    print "%-40s %10.1f %8.2f" % ("parse and index", maxrss(),
+                                  time.time() - start)
+
+    start = time.time()
+    pvs = []
+    for (i, index) in enumerate(indices):
+        for name in index.names():
+            pkg = Package(distro, 'dist%d' % i, 'main', name)
+            for version in index.versions(name):
+                pvs.append(PackageVersion(pkg, version))
+    gc.collect()
+    print "%-40s %10.1f %8.2f" % ("%d PackageVersions" % len(pvs), maxrss(),
+                                  time.time() - start)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,109 @@
+import os
+import unittest
+
+from model import Distro
+from model.base import Package, PoolIndex
+
+import testhelper as th
+
+
+class PoolIndexTest(unittest.TestCase):
+    def setUp(self):
+        th.config_create_root()
+        th.config_add_distro('pooldistro', 'file:///nonexistent')
+        PoolIndex.CACHE.clear()
+        self.distro = Distro.get('pooldistro')
+
+    def tearDown(self):
+        PoolIndex.CACHE.clear()
+
+    def writeDsc(self, name, version, fmt='3.0 (quilt)'):
+        pkg = Package(self.distro, 'stable', 'main', name)
+        filename = '%s/%s_%s.dsc' % (pkg.poolPath, name, version)
+        if not os.path.isdir(pkg.poolPath):
+            os.makedirs(pkg.poolPath)
+        with open(filename, 'w') as fd:
+            fd.write('Format: %s\nSource: %s\nVersion: %s\n'
+                     'Files:\n 0123 45 %s_%s.tar.xz\n' %
+                     (fmt, name, version, name, version))
+        return filename
+
+    def reload(self):
+        PoolIndex.CACHE.clear()
+        return self.distro.getPoolIndex('main')
+
+    def test_scan(self):
+        self.writeDsc('foo', '1.0-1')
+        self.writeDsc('foo', '1.0-2', '1.0')
+        self.writeDsc('libbar', '2.0')
+
+        index = self.distro.getPoolIndex('main')
+        self.assertEqual(index.versions('foo'), ['1.0-1', '1.0-2'])
+        self.assertEqual(index.versions('libbar'), ['2.0'])
+        self.assertEqual(index.versions('baz'), [])
+        self.assertEqual(index.entry('foo', '1.0-2')['Format'], '1.0')
+
+        pkg = Package(self.distro, 'stable', 'main', 'foo')
+        self.assertEqual(sorted(pv.version for pv in pkg.getPoolVersions()),
+                         ['1.0-1', '1.0-2'])
+        self.assertEqual(pkg.getPoolVersions()[0].getPoolEntry()['Files'],
+                         '\n0123 45 foo_1.0-1.tar.xz')
+
+    # Once the index exists, the pool itself is no longer looked at
+    def test_snapshot(self):
+        self.writeDsc('foo', '1.0-1')
+        self.distro.getPoolIndex('main')
+        self.writeDsc('foo', '1.0-2')
+        self.assertEqual(self.reload().versions('foo'), ['1.0-1'])
+
+    # Changes are journalled, and survive reloading the index
+    def test_recordAndForget(self):
+        self.writeDsc('foo', '1.0-1')
+        index = self.distro.getPoolIndex('main')
+        filename = self.writeDsc('foo', '1.0-2')
+        PoolIndex.forDsc(filename).record(filename)
+        index.forget('foo', '1.0-1')
+        self.assertEqual(index.versions('foo'), ['1.0-2'])
+
+        self.assertEqual(self.reload().versions('foo'), ['1.0-2'])
+        self.assertTrue(os.path.getsize(index.journal) > 0)
+
+    # A long journal is folded into the snapshot
+    def test_compact(self):
+        index = self.distro.getPoolIndex('main')
+        for i in range(PoolIndex.MAX_JOURNAL + 1):
+            filename = self.writeDsc('foo', '1.%d' % i)
+            index.record(filename)
+
+        index = self.reload()
+        self.assertEqual(len(index.versions('foo')), PoolIndex.MAX_JOURNAL + 1)
+        self.assertEqual(os.path.getsize(index.journal), 0)
+        self.assertEqual(len(self.reload().versions('foo')),
+                         PoolIndex.MAX_JOURNAL + 1)
+
+    # Versions another process records or forgets show up here too, and
+    # so does its folding the journal into the snapshot
+    def test_otherProcess(self):
+        self.writeDsc('foo', '1.0-1')
+        index = self.distro.getPoolIndex('main')
+        other = PoolIndex(index.pooldir)
+
+        filename = self.writeDsc('foo', '1.0-2')
+        other.record(filename)
+        other.forget('foo', '1.0-1')
+        self.assertEqual(self.distro.getPoolIndex('main').versions('foo'),
+                         ['1.0-2'])
+
+        # Its own records aren't replayed, but those after them are
+        index.record(self.writeDsc('foo', '1.0-3'))
+        other.record(self.writeDsc('bar', '1.0'))
+        self.assertEqual(self.distro.getPoolIndex('main').versions('bar'),
+                         ['1.0'])
+
+        for i in range(PoolIndex.MAX_JOURNAL + 1):
+            other.record(self.writeDsc('baz', '1.%d' % i))
+        PoolIndex(index.pooldir)
+        self.assertEqual(os.path.getsize(index.journal), 0)
+        index = self.distro.getPoolIndex('main')
+        self.assertEqual(len(index.versions('baz')), PoolIndex.MAX_JOURNAL + 1)
+        self.assertEqual(index.versions('foo'), ['1.0-2', '1.0-3'])
@@ -1,5 +1,7 @@
 from copy import copy
 from filecmp import dircmp
+import logging
+from optparse import Values
 import os
 import shutil
 import stat
@@ -7,9 +9,14 @@ from subprocess import check_call
 import unittest
 
 import config
+from deb.version import Version
+from model import Distro
+from model.base import Package, PackageVersion, UpdateInfo
+from model.changes import ChangeTracker
+import produce_merges
 from produce_merges import produce_merge
-from merge_report import MergeResult
-from momlib import result_dir
+from merge_report import MergeReport, MergeResult
+from momlib import result_dir, scratch_root
 
 import testhelper as th
 from testhelper import config_add_distro_from_repo, config_add_distro_sources
@@ -192,3 +199,288 @@ class ProduceMergeTest(unittest.TestCase):
         report = produce_merge(target, base, our_version, upstream,
                                output_dir)
         self.assertEqual(report.result, MergeResult.MERGED)
+
+
+class ProduceMergesJobsTest(unittest.TestCase):
+    def setUp(self):
+        th.config_create_root()
+        th.config_add_distro('jobsdistro', 'file:///nonexistent')
+        for name in ('t1', 't2'):
+            th.config_add_distro_target(name, 'jobsdistro', 'stable', 'main',
+                                        [], [])
+        self.handle_package = produce_merges.handle_package
+        produce_merges.handle_package = self.fakeHandlePackage
+
+        self.handled = []
+        self.messages = []
+        self.handler = logging.Handler()
+        self.handler.emit = lambda record: \
+            self.messages.append(record.getMessage())
+        logging.getLogger().addHandler(self.handler)
+
+    def tearDown(self):
+        produce_merges.handle_package = self.handle_package
+        logging.getLogger().removeHandler(self.handler)
+
+    def fakeHandlePackage(self, options, output_dir, target, pkg,
+                          our_version):
+        self.handled.append(pkg.name)
+        if pkg.name == 'broken':
+            raise ValueError('broken package')
+        logging.getLogger('produce_merges').info(
+            'merging %s for %s in %s', pkg.name, target.name, scratch_root())
+        report = MergeReport(left=our_version)
+        report.target = target.name
+        report.result = MergeResult.KEEP_OURS
+        report.merged_version = our_version.version
+        return report
+
+    def work(self):
+        distro = Distro.get('jobsdistro')
+        work = []
+        for (name, targets) in (('foo', ('t1', 't2')), ('broken', ('t1',)),
+                                ('bar', ('t1', 't2'))):
+            pkg = Package(distro, 'stable', 'main', name)
+            if not os.path.isdir(pkg.poolPath):
+                os.makedirs(pkg.poolPath)
+            with open('%s/%s_1.0-1.dsc' % (pkg.poolPath, name), 'w') as fd:
+                fd.write('Format: 3.0 (quilt)\nSource: %s\n'
+                         'Version: 1.0-1\nFiles:\n 0123 1000 %s_1.0.tar.xz\n'
+                         % (name, name))
+            pv = PackageVersion(pkg, Version('1.0-1'))
+            work.append([(config.Target(t), pv) for t in targets])
+        return work
+
+    def reports(self):
+        reports = {}
+        for target in ('t1', 't2'):
+            for name in ('foo', 'bar', 'broken'):
+                filename = result_dir(target, name) + '/REPORT.json'
+                if os.path.exists(filename):
+                    with open(filename) as fd:
+                        reports[(target, name)] = fd.read()
+                    os.unlink(filename)
+        return reports
+
+    # The reports written and the messages logged are the same however
+    # many jobs there are, but workers merge in scratch directories of
+    # their own
+    def test_jobs(self):
+        options = Values({'force': False, 'sync_to_upstream': False})
+        root = config.get('ROOT')
+
+        produce_merges.produce_merges(options, self.work(), 1)
+        serial = self.reports()
+        self.assertEqual(sorted(serial), [('t1', 'bar'), ('t1', 'foo'),
+                                          ('t2', 'bar'), ('t2', 'foo')])
+        self.assertIn('merging foo for t2 in %s' % root, self.messages)
+
+        del self.messages[:]
+        produce_merges.produce_merges(options, self.work(), 2)
+        self.assertEqual(self.reports(), serial)
+        merging = [m for m in self.messages if m.startswith('merging ')]
+        self.assertEqual(len(merging), 4)
+        for message in merging:
+            self.assertTrue(message.split(' in ')[1].startswith(
+                root + '/scratch/'), message)
+        self.assertIn('Failed handling merge for jobsdistro/stable/main/'
+                      'broken', self.messages)
+        self.assertFalse(os.path.exists(root + '/scratch'))
+
+    # Packages whose merges failed are kept pending for the next run
+    def test_retry(self):
+        tracker = ChangeTracker()
+        tracker.detect([])
+        options = Values({'force': False, 'sync_to_upstream': False})
+        produce_merges.produce_merges(options, self.work(), 1)
+        self.assertEqual(tracker.pending(), set(['broken']))
+
+    # Without the disk space for more, merges are produced one at a time
+    # rather than not at all
+    def test_diskSpace(self):
+        options = Values({'force': False, 'sync_to_upstream': False})
+        produce_merges.produce_merges(options, self.work(), 1)
+        serial = self.reports()
+
+        config.configdb.MERGE_MIN_FREE_SPACE = 1 << 62
+        try:
+            produce_merges.produce_merges(options, self.work(), 2)
+        finally:
+            del config.configdb.MERGE_MIN_FREE_SPACE
+        self.assertEqual(self.reports(), serial)
+
+    # The packages expected to take longest are merged first, and how long
+    # each took is remembered
+    def test_schedule(self):
+        options = Values({'force': False, 'sync_to_upstream': False})
+        produce_merges.save_merge_times({'foo': [2000, 1.0],
+                                         'bar': [2000, 5.0]})
+        produce_merges.produce_merges(options, self.work(), 1)
+        self.assertEqual(self.handled, ['bar', 'bar', 'broken', 'foo', 'foo'])
+
+        times = produce_merges.load_merge_times()
+        self.assertEqual(sorted(times), ['bar', 'foo'])
+        self.assertTrue(times['bar'][1] < 5.0)
+        self.assertEqual(times['bar'][0], 2000)
+        self.assertTrue([m for m in self.messages
+                         if m.startswith('  bar: ')])
+
+    def test_predictTime(self):
+        history = {'foo': [1000, 2.0], 'bar': [3000, 6.0]}
+        self.assertEqual(produce_merges.predict_time('foo', 1000, history),
+                         2.0)
+        # Otherwise at the rate of past merges, 500 bytes a second
+        self.assertEqual(produce_merges.predict_time('foo', 2000, history),
+                         4.0)
+        self.assertEqual(produce_merges.predict_time('baz', 500, history),
+                         1.0)
+        self.assertEqual(produce_merges.predict_time('baz', 4 << 20, {}),
+                         1.0)
+
+
+class UnpackReleaseTest(unittest.TestCase):
+    def setUp(self):
+        self.released = []
+        self.unpack_source = produce_merges.unpack_source
+        self.cleanup_source = produce_merges.cleanup_source
+        produce_merges.unpack_source = self.fakeUnpack
+        produce_merges.cleanup_source = self.released.append
+
+    def tearDown(self):
+        produce_merges.unpack_source = self.unpack_source
+        produce_merges.cleanup_source = self.cleanup_source
+
+    def fakeUnpack(self, pv):
+        if pv == 'base':
+            raise IOError('cannot unpack %s' % pv)
+        return '/unpacked/%s' % pv
+
+    # The trees already unpacked are released if a later one fails
+    def test_unpackFailure(self):
+        with self.assertRaises(IOError):
+            produce_merge(None, 'base', 'left', 'upstream', None)
+        self.assertEqual(self.released, ['upstream', 'left'])
+
+
+class FingerprintTest(unittest.TestCase):
+    def setUp(self):
+        th.config_create_root()
+        th.config_add_distro('fpdistro', 'file:///nonexistent')
+        th.config_add_distro_target('fptarget', 'fpdistro', 'stable', 'main',
+                                    [], [])
+        self.target = config.Target('fptarget')
+        self.target.findSourcePackage = self.findSourcePackage
+        self.pkg = Package(Distro.get('fpdistro'), 'stable', 'main', 'foo')
+        self.pv = PackageVersion(self.pkg, Version('1.0-1local1'))
+        os.makedirs(self.pkg.poolPath)
+        with open(self.pv.dscPath, 'w') as fd:
+            fd.write('Format: 3.0 (quilt)\nSource: foo\n'
+                     'Version: 1.0-1local1\nFiles:\n'
+                     ' 0123 1000 foo_1.0.orig.tar.gz\n')
+        self.output_dir = result_dir('fptarget', 'foo')
+        self.options = Values({'force': False, 'sync_to_upstream': False})
+        self.looked = False
+
+        info = UpdateInfo(self.pkg)
+        info.set_version('1.0-1local1')
+        info.set_upstream_version('1.1-1')
+        info.set_base_version('1.0-1')
+        info.save()
+
+    def findSourcePackage(self, name, version):
+        self.looked = True
+        return []
+
+    def save(self, result):
+        produce_merges.save_fingerprint(
+            self.output_dir,
+            produce_merges.merge_fingerprint(self.target, self.pv,
+                                             UpdateInfo(self.pkg)),
+            result)
+
+    def handle(self):
+        self.looked = False
+        return produce_merges.handle_package(self.options, self.output_dir,
+                                             self.target, self.pkg, self.pv)
+
+    # An up to date report is found without looking in the pool
+    def test_upToDate(self):
+        self.save(MergeResult.MERGED)
+        self.assertEqual(self.handle(), None)
+        self.assertFalse(self.looked)
+
+        self.options.force = True
+        self.handle()
+        self.assertTrue(self.looked)
+
+    # Failures are retried
+    def test_failed(self):
+        self.save(MergeResult.FAILED)
+        self.assertEqual(self.handle().result, MergeResult.FAILED)
+        self.assertTrue(self.looked)
+
+    # As is everything if the versions or the configuration change
+    def test_changed(self):
+        self.save(MergeResult.MERGED)
+        info = UpdateInfo(self.pkg)
+        info.set_upstream_version('1.2-1')
+        info.save()
+        self.handle()
+        self.assertTrue(self.looked)
+
+        info.set_upstream_version('1.1-1')
+        info.save()
+        self.save(MergeResult.MERGED)
+        self.handle()
+        self.assertFalse(self.looked)
+
+        self.target.config()['sync_upstream_packages'] = ['foo']
+        self.handle()
+        self.assertTrue(self.looked)
+
+    # A package to be synced that has nothing newer to sync to is settled,
+    # rather than tried again every run
+    def test_syncKeepOurs(self):
+        self.target.config()['sync_upstream_packages'] = ['foo']
+        info = UpdateInfo(self.pkg)
+        info.set_upstream_version('1.0-1')
+        info.save()
+        report = self.handle()
+        self.assertEqual(report.result, MergeResult.KEEP_OURS)
+        produce_merges.write_merge_report(report, self.target, self.pv)
+        self.assertEqual(
+            produce_merges.unsettled_packages([[(self.target, self.pv)]]),
+            set())
+
+
+class CreatePatchTest(unittest.TestCase):
+    def setUp(self):
+        th.config_create_root()
+        th.config_add_distro('cpdistro', 'file:///nonexistent')
+        self.root = config.get('ROOT')
+        self.pv = PackageVersion(
+            Package(Distro.get('cpdistro'), 'stable', 'main', 'foo'),
+            Version('1.0-1'))
+        for (name, data) in (('left/debian/rules', 'old\n'),
+                             ('merged/debian/rules', 'new\n'),
+                             ('merged/README', 'readme\n')):
+            filename = os.path.join(self.root, name)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'w') as fd:
+                fd.write(data)
+
+    # The trees are diffed where they are, with paths named by version
+    def test_createPatch(self):
+        filename = os.path.join(self.root, 'foo.patch')
+        self.assertEqual(
+            produce_merges.create_patch(Version('1.0-1merged1'), filename,
+                                        self.root + '/merged', self.pv,
+                                        self.root + '/left'),
+            'foo.patch')
+        with open(filename) as fd:
+            lines = [line for line in fd if line.startswith(('---', '+++'))]
+        self.assertEqual([line.split('\t')[0] for line in lines],
+                         ['--- 1.0-1/README', '+++ 1.0-1merged1/README',
+                          '--- 1.0-1/debian/rules',
+                          '+++ 1.0-1merged1/debian/rules'])
@@ -1,11 +1,19 @@
 import atexit
+import BaseHTTPServer
 import imp
 import glob
 import logging
 import os
 import shutil
+import SimpleHTTPServer
+import socket
+import SocketServer
 import subprocess
 import tempfile
+import threading
+import time
+import urllib
+import urlparse
 
 import config
 import deb
@@ -148,6 +156,131 @@ class TestPackage(object):
             shutil.rmtree(self.base_path)
 
 
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+# Serve the files in a temporary directory over HTTP/1.1 on localhost,
+# standing in for a remote mirror. Each request waits for `delay` seconds
+# first. The number of connections accepted, the paths and ranges
+# requested and the most requests ever handled at once are recorded.
+# Paths in `redirects` are redirected to the path they map to. Range
+# requests of the form "bytes=N-" are only honoured if `ranges` is True.
+class TestHTTPMirror(object):
+    def __init__(self, delay=0, ranges=True):
+        self.path = tempfile.mkdtemp(prefix='mommirror.')
+        self.delay = delay
+        self.ranges = ranges
+        self.redirects = {}
+        self.connections = 0
+        self.sockets = []
+        self.requests = []
+        self.range_requests = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+        mirror = self
+
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+                with mirror.lock:
+                    mirror.connections += 1
+                    mirror.sockets.append(self.connection)
+
+            def translate_path(self, path):
+                path = urllib.unquote(urlparse.urlsplit(path).path)
+                parts = [p for p in path.split('/')
+                         if p not in ('', '.', '..')]
+                return os.path.join(mirror.path, *parts)
+
+            def do_GET(self):
+                byte_range = self.headers.get('Range')
+                with mirror.lock:
+                    mirror.requests.append(self.path)
+                    if byte_range is not None:
+                        mirror.range_requests.append((self.path, byte_range))
+                    mirror.active += 1
+                    mirror.max_active = max(mirror.active, mirror.max_active)
+                try:
+                    time.sleep(mirror.delay)
+                    if self.path in mirror.redirects:
+                        self.send_response(302)
+                        self.send_header('Location',
+                                         mirror.redirects[self.path])
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                    elif self.not_modified():
+                        self.send_response(304)
+                        self.end_headers()
+                    elif mirror.ranges and byte_range is not None \
+                            and os.path.isfile(self.translate_path(self.path)):
+                        self.send_range(byte_range)
+                    else:
+                        SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+                finally:
+                    with mirror.lock:
+                        mirror.active -= 1
+
+            def not_modified(self):
+                since = self.headers.get('If-Modified-Since')
+                path = self.translate_path(self.path)
+                if since is None or not os.path.isfile(path):
+                    return False
+                return since == self.date_time_string(
+                    int(os.stat(path).st_mtime))
+
+            def send_range(self, byte_range):
+                with open(self.translate_path(self.path), 'rb') as fd:
+                    data = fd.read()
+                start = int(byte_range[len('bytes='):].rstrip('-'))
+                if start >= len(data):
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                                 (start, len(data) - 1, len(data)))
+                self.send_header('Content-Length', str(len(data) - start))
+                self.end_headers()
+                self.wfile.write(data[start:])
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Put a file with the given contents at path (relative to the top of
+    # the mirror) and return its URL
+    def add_file(self, path, contents):
+        filename = os.path.join(self.path, path)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as fd:
+            fd.write(contents)
+        return '%s/%s' % (self.url, path)
+
+    # Stop the server, dropping any connections the client kept open
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            for sock in self.sockets:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        shutil.rmtree(self.path)
+
+
 # Install a new configuration with a target distro, plus a number of
 # stable and unstable source (upstreaam) repos. Corresponding empty
 # TestRepo objects are created and returned as a flat list:
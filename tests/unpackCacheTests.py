@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from util.unpackcache import UnpackCache
+
+
+class UnpackCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='momtest.unpacked.')
+        self.created = []
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def cache(self, budget=1000):
+        return UnpackCache(os.path.join(self.root, 'unpacked'), budget)
+
+    def create(self, size):
+        # Return a function for acquire() that makes a directory holding
+        # a file of the given size
+        def create(destdir):
+            self.created.append(size)
+            os.makedirs(destdir)
+            with open(os.path.join(destdir, 'file'), 'w') as fd:
+                fd.write('x' * size)
+        return create
+
+    def unpacked(self, cache, key):
+        return os.path.isdir(cache.directory(key))
+
+    # A directory is only created once, and stays after it's released
+    def test_reuse(self):
+        cache = self.cache()
+        path = cache.acquire('f/foo/1.0', self.create(100))
+        self.assertEqual(path, os.path.join(self.root, 'unpacked/f/foo/1.0'))
+        cache.release('f/foo/1.0')
+        self.assertEqual(cache.acquire('f/foo/1.0', self.create(100)), path)
+        self.assertEqual(self.created, [100])
+        self.assertTrue(cache.size() >= 100)
+
+        # Another process finds it in the manifest
+        cache = self.cache()
+        self.assertTrue(cache.size() >= 100)
+        cache.acquire('f/foo/1.0', self.create(100))
+        self.assertEqual(self.created, [100])
+
+    # Going over budget evicts the least recently used directories that
+    # aren't in use
+    def test_evict(self):
+        cache = self.cache()
+        for version in ('1', '2', '3'):
+            cache.acquire('f/foo/' + version, self.create(300))
+            time.sleep(0.01)
+        cache.release('f/foo/1')
+        cache.release('f/foo/2')
+        cache.acquire('f/foo/1', self.create(300))
+        cache.release('f/foo/1')
+
+        cache.acquire('f/foo/4', self.create(300))
+        self.assertFalse(self.unpacked(cache, 'f/foo/2'))
+        for version in ('1', '3', '4'):
+            self.assertTrue(self.unpacked(cache, 'f/foo/' + version))
+
+        # Everything left is in use but for 1, so only it can go
+        cache.acquire('f/foo/5', self.create(300))
+        time.sleep(0.01)
+        cache.acquire('f/foo/6', self.create(300))
+        self.assertFalse(self.unpacked(cache, 'f/foo/1'))
+        self.assertTrue(self.unpacked(cache, 'f/foo/3'))
+        self.assertEqual(cache.size(), 1200)
+
+        # Until trim() drops every reference
+        cache.trim()
+        self.assertEqual(cache.size(), 900)
+        self.assertFalse(self.unpacked(cache, 'f/foo/3'))
+        self.assertTrue(self.unpacked(cache, 'f/foo/4'))
+
+    # A changed directory is thrown away, along with its empty parents
+    def test_discard(self):
+        cache = self.cache()
+        cache.acquire('f/foo/1.0', self.create(10))
+        cache.release('f/foo/1.0', discard=True)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'unpacked/f')))
+        self.assertEqual(cache.size(), 0)
+
+        cache.acquire('f/foo/1.0', self.create(10))
+        self.assertEqual(self.created, [10, 10])
+
+    # Directories unpacked before there was a manifest are used too
+    def test_adopt(self):
+        self.create(10)(os.path.join(self.root, 'unpacked/f/foo/1.0'))
+        cache = self.cache()
+        cache.acquire('f/foo/1.0', self.create(10))
+        self.assertEqual(self.created, [10])
+        self.assertTrue(cache.size() >= 10)
+
+    # Directories another process is using aren't evicted, until it has
+    # gone away
+    def test_otherProcess(self):
+        (started, stop) = (os.pipe(), os.pipe())
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.cache().acquire('f/foo/1', self.create(600))
+                os.write(started[1], 'x')
+                os.read(stop[0], 1)
+            finally:
+                os._exit(0)
+
+        os.read(started[0], 1)
+        cache = self.cache()
+        cache.acquire('f/foo/2', self.create(600))
+        self.assertTrue(self.unpacked(cache, 'f/foo/1'))
+        self.assertEqual(cache.size(), 1200)
+
+        os.write(stop[1], 'x')
+        os.waitpid(pid, 0)
+        cache.release('f/foo/2')
+        self.assertFalse(self.unpacked(cache, 'f/foo/1'))
+        self.assertTrue(self.unpacked(cache, 'f/foo/2'))
+        for fd in started + stop:
+            os.close(fd)
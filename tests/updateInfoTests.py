@@ -0,0 +1,89 @@
+import json
+import os
+import threading
+import unittest
+
+import config
+from model import Distro
+from model.base import Package, UpdateInfo, UpdateInfoStore
+
+import testhelper as th
+
+
+class UpdateInfoTest(unittest.TestCase):
+    def setUp(self):
+        th.config_create_root()
+        th.config_add_distro('infodistro', 'file:///nonexistent')
+        self.distro = Distro.get('infodistro')
+
+    def package(self, name):
+        return Package(self.distro, 'stable', 'main', name)
+
+    def test_saveAndLoad(self):
+        info = UpdateInfo(self.package('foo'))
+        self.assertEqual(info.version, None)
+        info.set_version('1.0-1')
+        info.set_upstream_version('1.1-1')
+        info.save()
+
+        info = UpdateInfo(self.package('foo'))
+        self.assertEqual(info.version, '1.0-1')
+        self.assertEqual(info.upstream_version, '1.1-1')
+        self.assertEqual(info.base_version, None)
+        self.assertTrue(os.path.exists(UpdateInfoStore.path()))
+
+        info.set_upstream_version(None)
+        info.save()
+        self.assertEqual(UpdateInfo(self.package('foo')).upstream_version,
+                         None)
+
+    def test_loadAll(self):
+        for name in ('foo', 'bar'):
+            info = UpdateInfo(self.package(name))
+            info.set_version('1.0')
+            info.save()
+
+        infos = UpdateInfo.load_all(self.distro)
+        self.assertEqual(sorted(infos), ['bar', 'foo'])
+        self.assertEqual(UpdateInfo(self.package('foo'), infos['foo']).version,
+                         '1.0')
+
+    # Each thread uses a connection of its own
+    def test_threads(self):
+        def save(name):
+            info = UpdateInfo(self.package(name))
+            info.set_version('2.0')
+            info.save()
+        threads = [threading.Thread(target=save, args=('pkg%d' % i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(UpdateInfo.load_all(self.distro)), 8)
+
+    # Files left by older versions are imported the first time the store
+    # is opened
+    def test_migrate(self):
+        path = os.path.join(config.get('ROOT'), 'baseinfo', 'infodistro')
+        os.makedirs(path)
+        with open(os.path.join(path, 'foo'), 'w') as fd:
+            json.dump({'version': '1.0', 'base_version': '0.9'}, fd)
+
+        info = UpdateInfo(self.package('foo'))
+        self.assertEqual(info.version, '1.0')
+        self.assertEqual(info.base_version, '0.9')
+        self.assertEqual(sorted(UpdateInfo.load_all(self.distro)), ['foo'])
+
+    # A file that can't be read doesn't stop the rest being imported
+    def test_migrateCorrupt(self):
+        path = os.path.join(config.get('ROOT'), 'baseinfo', 'infodistro')
+        os.makedirs(path)
+        with open(os.path.join(path, 'foo'), 'w') as fd:
+            json.dump({'version': '1.0'}, fd)
+        with open(os.path.join(path, 'bar'), 'w') as fd:
+            fd.write('{"version": ')
+
+        self.assertEqual(UpdateInfo(self.package('foo')).version, '1.0')
+        self.assertEqual(UpdateInfo(self.package('bar')).version, None)
+        self.assertEqual(sorted(UpdateInfo.load_all(self.distro)), ['foo'])
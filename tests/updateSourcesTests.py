@@ -7,7 +7,7 @@ import unittest
 
 import config
 from deb.controlfile import ControlFile
-from model import UpdateInfo, Version
+from model import Distro, UpdateInfo, Version
 from momlib import files
 import update_sources
 
@@ -292,6 +292,7 @@ class DebsnapFetchTest(unittest.TestCase):
     def setUp(self):
         # Create a single package (not in any repo) and then set up json files
         # and directory structure in a way that matches snapshot.debian.org
+        th.config_create_root()
         assert(update_sources.SNAPSHOT_BASE.startswith('file://'))
         self.debsnap_base = update_sources.SNAPSHOT_BASE[7:]
 
@@ -353,3 +354,118 @@ class DebsnapFetchTest(unittest.TestCase):
         dir_contents = os.listdir(self.output_dir)
         self.assertEqual(len(dir_contents), 3)
         self.assertIn('foo_1.2-1.dsc', dir_contents)
+
+
+class UpdatePackagesTest(unittest.TestCase):
+    def setUp(self):
+        self.handled = []
+        self.handle_package = update_sources.handle_package
+        update_sources.handle_package = self.fakeHandlePackage
+
+    def tearDown(self):
+        update_sources.handle_package = self.handle_package
+
+    def fakeHandlePackage(self, target, package, force, specific_upstream):
+        if package == 'broken':
+            raise ValueError('broken package')
+        self.handled.append((target, package))
+
+    # One package failing doesn't stop the others from being handled, and
+    # the targets for each package are handled in order
+    def test_failureIsolation(self):
+        work = [[('t1', 'foo'), ('t2', 'foo')],
+                [('t1', 'broken')],
+                [('t1', 'bar'), ('t2', 'bar')]]
+        for jobs in (1, 3):
+            del self.handled[:]
+            failed = update_sources.update_packages(work, jobs=jobs)
+            self.assertEqual(failed, ['broken'])
+            self.assertEqual(sorted(self.handled),
+                             [('t1', 'bar'), ('t1', 'foo'),
+                              ('t2', 'bar'), ('t2', 'foo')])
+            self.assertTrue(self.handled.index(('t1', 'foo')) <
+                            self.handled.index(('t2', 'foo')))
+
+
+class RefreshSourcesTest(unittest.TestCase):
+    def setUp(self):
+        th.config_create_root()
+        th.config_add_distro('one', 'file:///nonexistent')
+        th.config_add_distro('two', 'file:///nonexistent')
+        self.updateSources = Distro.updateSources
+        Distro.updateSources = lambda distro, dist: distro.name == 'two'
+
+    def tearDown(self):
+        Distro.updateSources = self.updateSources
+
+    # Results come back in order whether the suites are refreshed in this
+    # process or in children
+    def test_refresh(self):
+        suites = [('one', 'stable'), ('two', 'stable'), ('one', 'testing')]
+        for jobs in (1, 2):
+            results = update_sources.refresh_sources(suites, jobs)
+            self.assertEqual([(suite, changed)
+                              for (suite, elapsed, changed) in results],
+                             [(('one', 'stable'), False),
+                              (('two', 'stable'), True),
+                              (('one', 'testing'), False)])
+
+
+class DebsnapCacheTest(unittest.TestCase):
+    def setUp(self):
+        th.config_create_root()
+        self.mirror = th.TestHTTPMirror()
+        self.snapshot_base = update_sources.SNAPSHOT_BASE
+        update_sources.SNAPSHOT_BASE = self.mirror.url
+        self.mirror.add_file('mr/package/foo/index.html', json.dumps(
+            {'result': [{'version': '1.0-1'}, {'version': '1.1-1'}]}))
+        self.mirror.add_file('mr/package/foo/1.0-1/srcfiles', json.dumps(
+            {'fileinfo': {'abc': [{'name': 'foo_1.0-1.dsc'}],
+                          'def': [{'name': 'foo_1.0.orig.tar.gz'}]}}))
+
+    def tearDown(self):
+        update_sources.SNAPSHOT_BASE = self.snapshot_base
+        self.mirror.close()
+
+    def test_versions(self):
+        cache = update_sources.DebsnapCache()
+        self.assertEqual(cache.versions('foo'), ['1.0-1', '1.1-1'])
+        self.assertEqual(cache.versions('foo'), ['1.0-1', '1.1-1'])
+        self.assertEqual(len(self.mirror.requests), 1)
+
+        # Packages snapshot.debian.org doesn't have are cached too
+        self.assertEqual(cache.versions('bar'), [])
+        self.assertEqual(cache.versions('bar'), [])
+        self.assertEqual(len(self.mirror.requests), 2)
+
+    # Lists older than the TTL are fetched again, but kept if that fails
+    def test_ttl(self):
+        update_sources.DebsnapCache(ttl=0).versions('foo')
+        self.mirror.add_file('mr/package/foo/index.html', json.dumps(
+            {'result': [{'version': '1.2-1'}]}))
+        self.assertEqual(update_sources.DebsnapCache(ttl=0).versions('foo'),
+                         ['1.2-1'])
+
+        # Nothing listens on port 1
+        update_sources.SNAPSHOT_BASE = 'http://127.0.0.1:1'
+        self.assertEqual(update_sources.DebsnapCache(ttl=0).versions('foo'),
+                         ['1.2-1'])
+        self.assertRaises(IOError,
+                          update_sources.DebsnapCache(ttl=0).versions, 'bar')
+
+    def test_fileHashes(self):
+        cache = update_sources.DebsnapCache()
+        hashes = {'foo_1.0-1.dsc': 'abc', 'foo_1.0.orig.tar.gz': 'def'}
+        self.assertEqual(cache.file_hashes('foo', '1.0-1'), hashes)
+        self.assertEqual(cache.file_hashes('foo', '1.0-1'), hashes)
+        self.assertEqual(cache.file_hashes('foo', '9'), None)
+        self.assertEqual(len(self.mirror.requests), 2)
+
+    # Nothing is requested in offline mode
+    def test_offline(self):
+        update_sources.DebsnapCache().versions('foo')
+        cache = update_sources.DebsnapCache(ttl=0, offline=True)
+        self.assertEqual(cache.versions('foo'), ['1.0-1', '1.1-1'])
+        self.assertEqual(cache.versions('bar'), [])
+        self.assertEqual(cache.file_hashes('foo', '1.0-1'), None)
+        self.assertEqual(len(self.mirror.requests), 1)
@@ -20,6 +20,10 @@
 import sys
 import os
 import json
+import multiprocessing
+import Queue
+import threading
+import time
 import urllib2
 
 import osc.core
@@ -28,82 +32,196 @@ from momlib import *
 from deb.version import Version
 from deb.controlfile import ControlFile
 from model import Distro, UpdateInfo
+from model.base import PoolIndex, sha256sums
+from model.changes import ChangeTracker, package_filter
 from model.obs import OBSDistro
 import config
 import model.error
 import logging
-from util import run
+from util import pathhash, run, tree
+from util.download import Downloader, DEFAULT_JOBS, DEFAULT_TIMEOUT
 
 logger = logging.getLogger('update_sources')
 
 SNAPSHOT_BASE = 'http://snapshot.debian.org'
 
+# How long the list of a package's versions on snapshot.debian.org is
+# cached for, in seconds, unless DEBSNAP_CACHE_TTL says otherwise
+DEBSNAP_CACHE_TTL = 24 * 60 * 60
 
-# Get the list of available versions archived on snapshot.debian.org
-def get_debian_snapshot_versions(package_name):
-    url = '%s/mr/package/%s/' % (SNAPSHOT_BASE, package_name)
-    try:
-        fd = urllib2.urlopen(url)
-        data = json.load(fd)
-    except urllib2.HTTPError, e:
-        if e.code == 404:
-            return []
-        raise
-    except urllib2.URLError, e:
-        if isinstance(e.reason, OSError) and e.reason.errno == errno.ENOENT:
-            return []
-        raise
+_debsnap_downloader = None
+_debsnap_cache = None
+_debsnap_lock = threading.Lock()
+
+
+def debsnap_downloader():
+    # snapshot.debian.org is not in DISTROS, so its concurrency limit is
+    # a setting of its own
+    global _debsnap_downloader
+    with _debsnap_lock:
+        if _debsnap_downloader is None:
+            jobs = config.get('DEBSNAP_DOWNLOAD_JOBS', default=DEFAULT_JOBS)
+            timeout = config.get('DOWNLOAD_TIMEOUT', default=DEFAULT_TIMEOUT)
+            _debsnap_downloader = Downloader(jobs, timeout)
+        return _debsnap_downloader
+
+
+class DebsnapCache(object):
+    """Metadata from snapshot.debian.org, kept under ROOT/debsnap.
+
+    Each package has a JSON file there holding the versions that
+    snapshot.debian.org has of it (or null if it has never heard of the
+    package), and the name and hash of each file of the versions that
+    have been looked up. Version lists are fetched again once they are
+    older than ttl seconds, or kept if that fails; the files of a
+    version never change, so they are kept for good.
+
+    In offline mode, snapshot.debian.org is never contacted, and only
+    what is already cached is used.
+    """
+
+    def __init__(self, ttl=DEBSNAP_CACHE_TTL, offline=False):
+        self.ttl = ttl
+        self.offline = offline
 
-    versions = []
-    for vdict in data['result']:
-        versions.append(Version(vdict['version']))
+    def _path(self, package_name):
+        return os.path.join(config.get('ROOT'), 'debsnap',
+                            pathhash(package_name), package_name)
+
+    def _load(self, package_name):
+        try:
+            with open(self._path(package_name)) as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return {}
+
+    def _update(self, package_name, **kwargs):
+        # Only one thread handles any given package, so there's no need
+        # to lock around reading and rewriting its entry
+        entry = self._load(package_name)
+        entry.update(kwargs)
+        filename = self._path(package_name)
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        tree.ensure(filename)
+        with open(tmpname, 'w') as fd:
+            json.dump(entry, fd, sort_keys=True)
+        os.rename(tmpname, filename)
+
+    def versions(self, package_name):
+        """Return the Versions of package_name on snapshot.debian.org."""
+        entry = self._load(package_name)
+        fetched = entry.get('fetched')
+        if self.offline or (fetched is not None
+                            and time.time() - fetched < self.ttl):
+            return [Version(v) for v in entry.get('versions') or ()]
+
+        url = '%s/mr/package/%s/' % (SNAPSHOT_BASE, package_name)
+        try:
+            data = json.loads(debsnap_downloader().read(url))
+            versions = [vdict['version'] for vdict in data['result']]
+        except IOError, e:
+            if _debsnap_not_found(e):
+                versions = None
+            elif fetched is not None:
+                logger.warning('Using cached debsnap versions of %s: %s',
+                               package_name, e)
+                return [Version(v) for v in entry.get('versions') or ()]
+            else:
+                raise
+
+        self._update(package_name, fetched=time.time(), versions=versions)
+        return [Version(v) for v in versions or ()]
+
+    def file_hashes(self, package_name, version):
+        """Return a dictionary mapping the name of each file of the given
+        version of package_name to its hash on snapshot.debian.org, or
+        None if that isn't known.
+        """
+        srcfiles = self._load(package_name).get('srcfiles', {})
+        if str(version) in srcfiles or self.offline:
+            return srcfiles.get(str(version))
+
+        url = '%s/mr/package/%s/%s/srcfiles?fileinfo=1' % \
+              (SNAPSHOT_BASE, package_name, version)
+        logger.debug('Fetching debsnap metadata %s', url)
+        try:
+            data = json.loads(debsnap_downloader().read(url))
+        except urllib2.URLError, e:
+            if _debsnap_not_found(e):
+                return None
+            raise
+
+        hashes = {}
+        for filehash, fileinfos in data['fileinfo'].iteritems():
+            for fileinfo in fileinfos:
+                hashes.setdefault(fileinfo['name'], filehash)
+
+        srcfiles = self._load(package_name).get('srcfiles', {})
+        srcfiles[str(version)] = hashes
+        self._update(package_name, srcfiles=srcfiles)
+        return hashes
 
-    return versions
 
+def _debsnap_not_found(e):
+    # Return True if the IOError e means snapshot.debian.org doesn't have
+    # what was asked for. The tests' file:// stand-in raises ENOENT.
+    if isinstance(e, urllib2.HTTPError):
+        return e.code == 404
+    return isinstance(e, urllib2.URLError) \
+        and isinstance(e.reason, OSError) and e.reason.errno == errno.ENOENT
 
-def debsnap_get_file_hash(data, filename):
-    # Find the sha1 hash for a given file from the debsnap data
-    for filehash, files in data['fileinfo'].iteritems():
-        for fileinfo in files:
-            if fileinfo['name'] == filename:
-                return filehash
-    return None
 
+def debsnap_cache():
+    global _debsnap_cache
+    with _debsnap_lock:
+        if _debsnap_cache is None:
+            _debsnap_cache = DebsnapCache(
+                config.get('DEBSNAP_CACHE_TTL', default=DEBSNAP_CACHE_TTL),
+                config.get('DEBSNAP_OFFLINE', default=False))
+        return _debsnap_cache
 
-def debsnap_download_file(url, output_path):
-    # Download a specific file from debsnap
-    logging.debug('Downloading debsnap file %s', url)
-    fd = urllib2.urlopen(url)
-    with open(output_path, 'w') as output:
-        output.write(fd.read())
+
+# Get the list of available versions archived on snapshot.debian.org
+def get_debian_snapshot_versions(package_name):
+    return debsnap_cache().versions(package_name)
 
 
 def download_from_debsnap(target_dir, package_name, version):
     # Download a given package version from debsnap
-    url = '%s/mr/package/%s/%s/srcfiles?fileinfo=1' % \
-          (SNAPSHOT_BASE, package_name, version)
-    logging.debug('Fetching debsnap metadata %s', url)
-    fd = urllib2.urlopen(url)
-    data = json.load(fd)
+    hashes = debsnap_cache().file_hashes(package_name, version)
+    if hashes is None:
+        logger.debug('No debsnap metadata for %s %s', package_name, version)
+        return False
+    if debsnap_cache().offline:
+        logger.debug('Not downloading %s %s from debsnap while offline',
+                     package_name, version)
+        return False
 
     dsc_name = '%s_%s.dsc' % (package_name, version.without_epoch)
-    dsc_hash = debsnap_get_file_hash(data, dsc_name)
+    dsc_hash = hashes.get(dsc_name)
+    if dsc_hash is None:
+        logger.warning('%s is not listed on debsnap', dsc_name)
+        return False
     dsc_path = os.path.join(target_dir, dsc_name)
     dsc_path_tmp = '%s.tmp' % dsc_path
 
+    blobs = Distro.blobStore()
     url = '%s/file/%s' % (SNAPSHOT_BASE, dsc_hash)
-    debsnap_download_file(url, dsc_path_tmp)
+    debsnap_downloader().fetch(url, dsc_path_tmp, blobs=blobs)
 
     dsc_data = ControlFile(dsc_path_tmp, multi_para=False, signed=True).para
+    sums = sha256sums(dsc_data)
+    downloads = []
     for filehash, size, filename in files(dsc_data):
-        snapshot_hash = debsnap_get_file_hash(data, filename)
-        url = '%s/file/%s' % (SNAPSHOT_BASE, snapshot_hash)
-        path = os.path.join(target_dir, filename)
-        debsnap_download_file(url, path)
+        url = '%s/file/%s' % (SNAPSHOT_BASE, hashes.get(filename))
+        downloads.append((url, os.path.join(target_dir, filename), size,
+                          sums.get(filename)))
+    debsnap_downloader().fetch_all(downloads, blobs)
 
     # Atomically put the .dsc file in place as the last step, making the
     # pool entry valid.
     os.rename(dsc_path_tmp, dsc_path)
+    PoolIndex.forDsc(dsc_path).record(dsc_path)
     logger.info('Downloaded %s base %s from debsnap', package_name, version)
     return True
 
@@ -120,17 +238,13 @@ def find_upstream(target, pv, specific_upstream=None):
                                             include_unstable=False)
 
     for srclist in sourcelists:
-        for src in srclist:
-            logger.debug('considering source %s', src)
-            try:
-                for possible in src.distro.findPackage(package_name,
-                                                       searchDist=src.dist):
-                    logger.debug('- contains version %s', possible)
-                    if upstream is None or possible > upstream:
-                        logger.debug('    - that version is the best yet seen')
-                        upstream = possible
-            except model.error.PackageNotFound:
-                pass
+        logger.debug('considering sources %s', srclist)
+        possible = srclist.findNewest(package_name)
+        if possible is not None:
+            logger.debug('- contains version %s', possible)
+            if upstream is None or possible > upstream:
+                logger.debug('    - that version is the best yet seen')
+                upstream = possible
 
     # There are two situations in which we will look in unstable distros
     # for a better version:
@@ -165,18 +279,13 @@ def find_upstream(target, pv, specific_upstream=None):
 
     if try_unstable:
         for srclist in target.unstable_sources:
-            for src in srclist:
-                logger.debug('considering unstable source %s', src)
-                try:
-                    for possible in src.distro.findPackage(
-                            package_name, searchDist=src.dist):
-                        logger.debug('- contains version %s', possible)
-                        if upstream is None or possible > upstream:
-                            logger.debug('    - that version is the best '
-                                         'yet seen')
-                            upstream = possible
-                except model.error.PackageNotFound:
-                    pass
+            logger.debug('considering unstable sources %s', srclist)
+            possible = srclist.findNewest(package_name)
+            if possible is not None:
+                logger.debug('- contains version %s', possible)
+                if upstream is None or possible > upstream:
+                    logger.debug('    - that version is the best yet seen')
+                    upstream = possible
 
             # Stop at the first upstream that provides a version upgrade
             if upstream is not None and upstream.version >= our_base_version:
@@ -220,44 +329,54 @@ def download_removed_package(target_dir, target, package_name, version):
     # We try this on just one of the upstreams - the first one we find that
     # indexes a package version newer than the one we are looking for.
     found = None
-    for pv in target.findSourcePackage(package_name):
-        if pv.version >= version:
-            found = pv
+    for srclist in target.getSourceLists(package_name):
+        # Only the first source in each list that has the package at all
+        for source in srclist:
+            pv = source.findNewest(package_name)
+            if pv is not None:
+                if pv.version >= version:
+                    found = pv
+                break
+        if found:
             break
 
     if not found:
         return False
 
     mirror = found.package.distro.mirrorURL()
+    downloader = found.package.distro.downloader()
     pooldir = found.package.getCurrentSources()[0]['Directory']
     name = "%s_%s.dsc" % (package_name, version.without_epoch)
     url = "%s/%s/%s" % (mirror, pooldir, name)
     dsc_file = "%s/%s" % (target_dir, name)
     dsc_file_tmp = "%s.tmp" % dsc_file
     logger.debug("Downloading %s to %s", url, dsc_file_tmp)
+    blobs = Distro.blobStore()
     try:
-        fd = urllib2.urlopen(url)
-        open(dsc_file_tmp, 'w').write(fd.read())
+        downloader.fetch(url, dsc_file_tmp, blobs=blobs)
     except urllib2.HTTPError, e:
         if e.code == 404:
             return False
         raise
 
     dsc_data = ControlFile(dsc_file_tmp, multi_para=False, signed=True).para
+    sums = sha256sums(dsc_data)
+    downloads = []
     for md5sum, size, name in files(dsc_data):
         url = "%s/%s/%s" % (mirror, pooldir, name)
-        outfile = "%s/%s" % (target_dir, name)
-        try:
-            fd = urllib2.urlopen(url)
-            open(outfile, 'w').write(fd.read())
-        except urllib2.HTTPError, e:
-            if e.code == 404:
-                return False
-            raise
+        downloads.append((url, "%s/%s" % (target_dir, name), size,
+                          sums.get(name)))
+    try:
+        downloader.fetch_all(downloads, blobs)
+    except urllib2.HTTPError, e:
+        if e.code == 404:
+            return False
+        raise
 
     # Atomically put the .dsc file in place as the last step, making it's
     # entry in the pool valid.
     os.rename(dsc_file_tmp, dsc_file)
+    PoolIndex.forDsc(dsc_file).record(dsc_file)
     logger.info('Downloaded removed package %s %s', package_name, version)
     return True
 
@@ -351,10 +470,8 @@ def handle_package(target, package, force=False, specific_upstream=None):
     # changelog and see if we have access to any of the other previous
     # versions there. They might be close enough to enable a 3-way merge.
     logging.debug('Checking changelog for older base versions')
-    unpacked_dir = unpack_source(pv)
-    changelog_versions = read_changelog(unpacked_dir + '/debian/changelog')
     found = None
-    for cl_version, text in changelog_versions:
+    for cl_version, offset, length in read_changelog(source_changelog(pv)):
         # Only consider versions that correspond to unmodified packages
         if cl_version.base() != cl_version:
             continue
@@ -380,7 +497,6 @@ def handle_package(target, package, force=False, specific_upstream=None):
                 found = cl_version
                 break
 
-    cleanup_source(pv)
     if found:
         logger.info('Couldn\'t find %s true base %s, using %s instead',
                     pv, base_version, found)
@@ -395,33 +511,163 @@ def handle_package(target, package, force=False, specific_upstream=None):
     update_info.save()
 
 
+def refresh_suite(suite):
+    # Refresh the Sources files for a (distro name, dist) pair, returning
+    # (suite, seconds taken, whether anything changed). This runs in a
+    # child process when several suites are refreshed at once.
+    (name, dist) = suite
+    start = time.time()
+    changed = Distro.get(name).updateSources(dist)
+    return (suite, time.time() - start, changed)
+
+
+def refresh_sources(suites, jobs=1):
+    # Refresh each (distro name, dist) pair in suites, up to jobs at a
+    # time. Each suite has its own apt root, but apt's configuration is
+    # global, so they are refreshed in separate processes.
+    start = time.time()
+    if jobs <= 1 or len(suites) <= 1:
+        results = map(refresh_suite, suites)
+    else:
+        pool = multiprocessing.Pool(min(jobs, len(suites)))
+        try:
+            results = pool.map(refresh_suite, suites, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    for ((name, dist), elapsed, changed) in results:
+        logger.info('Refreshed %s/%s in %.1fs: %s', name, dist, elapsed,
+                    'changed' if changed else 'unchanged')
+        # The child processes re-indexed the Sources files, so anything
+        # this process has cached for them is out of date
+        Distro.get(name).forgetSourcesIndex(dist)
+
+    logger.info('Refreshed %d suites (%d changed) in %.1fs', len(results),
+                len([r for r in results if r[2]]), time.time() - start)
+    return results
+
+
+def update_package(target, package, force=False, specific_upstream=None):
+    # Handle a single package, logging rather than raising any failure so
+    # that it doesn't affect the others. Return True on success.
+    try:
+        handle_package(target, package, force, specific_upstream)
+    except urllib2.HTTPError, e:
+        logger.warning('Caught HTTPError while handling %s: %s:',
+                       package, e)
+        return False
+    except Exception:
+        logger.exception('Failed to handle %s:', package)
+        return False
+    return True
+
+
+def update_packages(work, force=False, specific_upstream=None, jobs=1):
+    # Call update_package() for each of the (target, package) lists in
+    # work, up to jobs lists at a time. Each list holds the same package
+    # name in different targets: those share an unpacked source tree and
+    # possibly an UpdateInfo file, so they are handled one after another,
+    # in order, which also keeps the results the same as a serial run.
+    # Return the packages that failed.
+    queue = Queue.Queue()
+    for items in work:
+        queue.put(items)
+
+    failed = []
+
+    def worker():
+        while True:
+            try:
+                items = queue.get_nowait()
+            except Queue.Empty:
+                return
+            for target, package in items:
+                if not update_package(target, package, force,
+                                      specific_upstream):
+                    failed.append(package)
+
+    if jobs <= 1:
+        worker()
+        return failed
+
+    threads = []
+    for i in range(min(jobs, queue.qsize())):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        # Join with a timeout so that KeyboardInterrupt gets through
+        while thread.is_alive():
+            thread.join(1)
+
+    return failed
+
+
+def options(parser):
+    parser.add_option("-j", "--jobs", type="int", metavar="N", default=1,
+                      help="Handle up to N packages at once")
+    parser.add_option("--debsnap-offline", action="store_true",
+                      help="Don't contact snapshot.debian.org, only use "
+                      "what is cached from it")
+
+
 def main(options, args):
     logger.info('Updating source packages in target and source distros...')
 
-    upstreamSources = []
-    packages = []
-    for target in config.targets(args):
-        logger.info("Updating sources for %s", target)
-        d = target.distro
-        d.updateSources(target.dist)
+    if options.debsnap_offline:
+        debsnap_cache().offline = True
 
+    # Each suite is refreshed once, however many targets use it
+    targets = config.targets(args)
+    suites = []
+    for target in targets:
+        suite = (target.distro.name, target.dist)
+        if suite not in suites:
+            suites.append(suite)
         for upstreamList in target.getAllSourceLists():
             for source in upstreamList:
-                if source not in upstreamSources:
-                    logger.info("Updating upstream sources for %s", source)
-                    source.distro.updateSources(source.dist)
-
+                suite = (source.distro.name, source.dist)
+                if suite not in suites:
+                    suites.append(suite)
+
+    logger.info('Refreshing sources for %d suites...', len(suites))
+    refresh_sources(suites, options.jobs)
+
+    # Find out which packages' sources changed since the last run
+    components = []
+    for target in targets:
+        components.append((target.distro, target.dist, target.component))
+    for (name, dist) in suites:
+        distro = Distro.get(name)
+        for component in distro.components():
+            components.append((distro, dist, component))
+    tracker = ChangeTracker()
+    changed = tracker.detect(components)
+    logger.info('%d packages have changes to handle', len(changed))
+    wanted = package_filter(options)
+
+    work = []
+    byName = {}
+    for target in targets:
         for package in target.distro.packages(target.dist, target.component):
-            if options.package and package.name not in options.package:
+            if not wanted(package.name):
                 continue
-            try:
-                handle_package(target, package, options.force,
-                               options.use_upstream)
-            except urllib2.HTTPError, e:
-                logger.warning('Caught HTTPError while handling %s: %s:',
-                               package, e)
+            if package.name not in byName:
+                byName[package.name] = []
+                work.append(byName[package.name])
+            byName[package.name].append((target, package))
+
+    failed = update_packages(work, options.force, options.use_upstream,
+                             options.jobs)
+    if failed:
+        logger.warning('Failed to handle %d packages: %s', len(failed),
+                       ', '.join(sorted(str(p) for p in failed)))
+        # Try them again next time, even if nothing changes
+        tracker.defer(p.name for p in failed)
 
 
 if __name__ == "__main__":
-    run(main, usage="%prog [DISTRO...]",
+    run(main, options, usage="%prog [DISTRO...]",
         description="update the Sources file in a distribution's pool")
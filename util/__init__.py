@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import time
 import logging
 from optparse import OptionParser
@@ -33,6 +34,15 @@ def pathhash(path):
         return path[:1]
 
 
+def sha256sum(filename):
+    """Return the hex SHA-256 digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1024 * 1024), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 # --------------------------------------------------------------------------- #
 # Command-line tool functions
 # --------------------------------------------------------------------------- #
@@ -47,6 +57,9 @@ def get_option_parser(usage=None, description=None):
     parser.add_option("-f", "--force", action="store_true",
                       help="Force processing (ignore caches and previous "
                       "merges)")
+    parser.add_option("--full", action="store_true",
+                      help="Process every package, not only those whose "
+                      "sources changed since the last complete run")
     parser.add_option("--use-upstream", help="Only consider the specified "
                       "upstream distro")
     parser.add_option("--sync-to-upstream", action="store_true",
@@ -0,0 +1,369 @@
+from __future__ import with_statement
+
+import gzip
+import json
+import logging
+import os
+import re
+import StringIO
+import urllib2
+from distutils.spawn import find_executable
+from hashlib import sha256
+
+from util import shell, sha256sum, tree
+
+logger = logging.getLogger('util.aptlists')
+
+# Characters that apt escapes when turning a URI into a filename in its
+# lists directory
+APT_QUOTED = set('\\|{}[]<>"^~_=!@#$%^&*')
+
+# An ed command in a pdiff, such as "12a", "3,5c" or "7d"
+ED_COMMAND = re.compile(r'^(\d+)(?:,(\d+))?([acd])$')
+
+
+class SourcesFetcher(object):
+    """Fetch the Sources files of one release of an apt repository into an
+    apt lists directory, without involving apt itself.
+
+    The files are named just as apt would name them, so the rest of the
+    code can find them the same way whichever fetched them. The InRelease
+    file is requested conditionally on the validators the server gave
+    last time, so a release that hasn't changed costs a single request.
+    When it has changed, each Sources file whose checksum differs is
+    brought up to date with the pdiffs listed in Sources.diff/Index if
+    possible, or downloaded in full otherwise. The pdiffs are applied one
+    after another, or if the Index says they are merged, just the one for
+    the version we have.
+
+    As with the "[trusted=yes]" apt sources this replaces, the signature
+    on InRelease is not checked, but every file is checked against the
+    checksums it lists.
+    """
+
+    def __init__(self, mirror, dist, components, listsdir, downloader):
+        self.mirror = mirror.rstrip('/')
+        self.dist = dist
+        self.components = components
+        self.listsdir = listsdir
+        self.downloader = downloader
+        self.validators = self.listPath('InRelease') + '.validators'
+
+    def url(self, name):
+        return '%s/dists/%s/%s' % (self.mirror, self.dist, name)
+
+    def listPath(self, name):
+        """Return the filename apt would give to the release file name."""
+        return os.path.join(self.listsdir, uri_to_filename(self.url(name)))
+
+    def sourcesPath(self, component):
+        return self.listPath('%s/source/Sources' % component)
+
+    def update(self):
+        """Bring the Sources files up to date. Return True if any of them
+        changed.
+        """
+        headers = {}
+        if all(os.path.isfile(self.sourcesPath(c)) for c in self.components):
+            headers = self._loadValidators()
+
+        try:
+            response = self.downloader.open(self.url('InRelease'), headers)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                logger.debug('%s is unchanged', self.url('InRelease'))
+                return False
+            if e.code != 404:
+                raise
+            response = self.downloader.open(self.url('Release'))
+        except urllib2.URLError:
+            # file:// mirrors raise URLError for missing files
+            response = self.downloader.open(self.url('Release'))
+
+        try:
+            release = response.read()
+            validators = {}
+            for (header, name) in (('If-None-Match', 'ETag'),
+                                   ('If-Modified-Since', 'Last-Modified')):
+                value = response.getheader(name)
+                if value is not None:
+                    validators[header] = value
+        finally:
+            response.close()
+
+        checksums = parse_release(release)
+        changed = False
+        for component in self.components:
+            if self._updateSources(component, checksums):
+                changed = True
+
+        # Only once everything is in place, so that a failed update is
+        # retried in full next time
+        tree.ensure(self.validators)
+        with open(self.validators + '.tmp', 'w') as fd:
+            json.dump(validators, fd, sort_keys=True)
+        os.rename(self.validators + '.tmp', self.validators)
+        return changed
+
+    def _loadValidators(self):
+        try:
+            with open(self.validators) as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return {}
+
+    def _updateSources(self, component, checksums):
+        name = '%s/source/Sources' % component
+        filename = self.sourcesPath(component)
+        expected = checksums.get(name)
+        if not any(name + ext in checksums for ext in ('.xz', '.gz', '')):
+            # As apt does, carry on with the other components
+            logger.warning('%s is not listed in %s, skipping it', name,
+                           self.url('Release'))
+            return False
+
+        current = None
+        if os.path.isfile(filename):
+            current = sha256sum(filename)
+            if expected is not None and current == expected[0]:
+                return False
+
+        lines = None
+        if current is not None and expected is not None \
+                and name + '.diff/Index' in checksums:
+            try:
+                lines = self._patch(name, filename, current, expected,
+                                    checksums)
+            except (IOError, ValueError), e:
+                logger.warning('Cannot apply pdiffs to %s, downloading it '
+                               'in full: %s', filename, e)
+
+        tree.ensure(filename)
+        tmpname = filename + '.tmp'
+        try:
+            if lines is not None:
+                with open(tmpname, 'wb') as fd:
+                    fd.writelines(lines)
+            else:
+                self._download(name, tmpname, expected, checksums)
+            os.rename(tmpname, filename)
+        finally:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+        return True
+
+    def _patch(self, name, filename, current, expected, checksums):
+        """Return the lines of the new filename, found by applying the
+        pdiffs that lead from its current version to the expected one,
+        or None if there is no such series of pdiffs.
+        """
+        index = self.downloader.read(self.url(name + '.diff/Index'))
+        _verify(index, checksums[name + '.diff/Index'], 'Index')
+        index = parse_pdiff_index(index)
+
+        history = index.get('SHA256-History', [])
+        patches = dict((p[2], p) for p in index.get('SHA256-Patches', []))
+        downloads = dict((p[2][:-len('.gz')], p)
+                         for p in index.get('SHA256-Download', [])
+                         if p[2].endswith('.gz'))
+
+        names = [h[2] for h in history]
+        starts = [i for (i, h) in enumerate(history) if h[0] == current]
+        if not starts:
+            logger.debug('%s is not in the pdiff history', filename)
+            return None
+        if index.get('X-Patch-Precedence') == 'merged':
+            # Each pdiff goes straight from its point in the history to
+            # the current version, as on Debian's mirrors
+            names = [names[starts[-1]]]
+        else:
+            names = names[starts[0]:]
+        if not all(n in patches for n in names):
+            return None
+
+        # Not worth it if the pdiffs add up to more than the whole file
+        size = sum(downloads[n][1] if n in downloads else patches[n][1]
+                   for n in names)
+        full = min(checksums[name + ext][1] for ext in ('.xz', '.gz', '')
+                   if name + ext in checksums)
+        if size >= full:
+            logger.debug('pdiffs for %s are bigger than the file', filename)
+            return None
+
+        logger.debug('Applying %d pdiffs to %s', len(names), filename)
+        with open(filename, 'rb') as fd:
+            lines = fd.readlines()
+        for patch in names:
+            data = self.downloader.read(self.url('%s.diff/%s.gz' %
+                                                 (name, patch)))
+            if patch in downloads:
+                _verify(data, downloads[patch], patch)
+            data = _gunzip(data)
+            _verify(data, patches[patch], patch)
+            apply_ed(lines, data.splitlines(True))
+
+        digest = sha256()
+        for line in lines:
+            digest.update(line)
+        if digest.hexdigest() != expected[0]:
+            raise ValueError('pdiffs gave the wrong result')
+        return lines
+
+    def _download(self, name, tmpname, expected, checksums):
+        """Download the release file name into tmpname, decompressing it
+        from whichever of the compressed forms listed we can handle.
+        """
+        compressed = tmpname + '.download'
+        for ext in ('.xz', '.gz', ''):
+            if name + ext not in checksums:
+                continue
+            if ext == '.xz' and find_executable('xz') is None:
+                continue
+
+            (digest, size) = checksums[name + ext]
+            logger.debug('Downloading %s', self.url(name + ext))
+            try:
+                self.downloader.fetch(self.url(name + ext), compressed, size,
+                                      digest)
+                with open(tmpname, 'wb') as output:
+                    if ext == '.xz':
+                        shell.run(('xz', '-dc', compressed), stdout=output)
+                    elif ext == '.gz':
+                        with gzip.open(compressed, 'rb') as fd:
+                            for chunk in iter(lambda: fd.read(1 << 20), ''):
+                                output.write(chunk)
+                    else:
+                        with open(compressed, 'rb') as fd:
+                            for chunk in iter(lambda: fd.read(1 << 20), ''):
+                                output.write(chunk)
+            finally:
+                if os.path.exists(compressed):
+                    os.unlink(compressed)
+
+            if expected is not None and sha256sum(tmpname) != expected[0]:
+                raise IOError('%s does not match its checksum' %
+                              self.url(name + ext))
+            return
+
+        raise IOError('%s is not listed in %s' % (name, self.url('Release')))
+
+
+def uri_to_filename(uri):
+    """Return the name apt gives to the file at uri in its lists directory:
+    the URI without its scheme or credentials, with awkward characters
+    escaped and slashes turned into underscores.
+    """
+    rest = uri.split('://', 1)[-1] if '://' in uri else uri.split(':', 1)[-1]
+    if '@' in rest.split('/', 1)[0]:
+        rest = rest.split('@', 1)[1]
+    quoted = ''.join('%%%02x' % ord(c)
+                     if c in APT_QUOTED or ord(c) <= 0x20 or ord(c) >= 0x7f
+                     else c for c in rest)
+    return quoted.replace('/', '_')
+
+
+def parse_release(text):
+    """Return {name: (sha256, size)} for the files listed in the SHA256
+    field of a Release or InRelease file.
+    """
+    checksums = {}
+    for (digest, size, name) in _field_lines(_strip_signature(text),
+                                             'SHA256'):
+        checksums[name] = (digest, int(size))
+    return checksums
+
+
+def parse_pdiff_index(text):
+    """Return the fields of a Sources.diff/Index file, as a dictionary
+    mapping each field name to its lines, each as a (sha256, size, name)
+    tuple. SHA256-Current, which has just one line, has no name.
+    X-Patch-Precedence, if there is one, maps to its value.
+    """
+    fields = {}
+    for words in _field_lines(text, 'X-Patch-Precedence'):
+        fields['X-Patch-Precedence'] = words[0]
+    for field in ('SHA256-Current', 'SHA256-History', 'SHA256-Patches',
+                  'SHA256-Download'):
+        entries = []
+        for words in _field_lines(text, field):
+            if len(words) == 2:
+                words.append(None)
+            entries.append((words[0], int(words[1]), words[2]))
+        if entries:
+            fields[field] = entries
+    return fields
+
+
+def apply_ed(lines, script):
+    """Apply the ed script from a pdiff to lines, a list of lines with
+    their line endings, in place.
+
+    Only the a, c and d commands that "diff --ed" produces are understood.
+    They come in descending order of line number, so each can be applied
+    as it is read.
+    """
+    i = 0
+    while i < len(script):
+        match = ED_COMMAND.match(script[i].rstrip('\n'))
+        if match is None:
+            raise ValueError('Unsupported ed command %r' % script[i])
+        i += 1
+
+        start = int(match.group(1))
+        end = int(match.group(2) or start)
+        command = match.group(3)
+
+        text = []
+        if command in 'ac':
+            while i < len(script) and script[i] != '.\n':
+                text.append(script[i])
+                i += 1
+            if i == len(script):
+                raise ValueError('Unterminated ed text')
+            i += 1
+
+        if command == 'a':
+            if start > len(lines):
+                raise ValueError('ed command beyond the end of the file')
+            lines[start:start] = text
+        else:
+            if start < 1 or end < start or end > len(lines):
+                raise ValueError('ed command beyond the end of the file')
+            lines[start - 1:end] = text
+
+
+def _strip_signature(text):
+    # Return the signed text from a clearsigned InRelease file, or text
+    # itself if it isn't signed
+    if not text.startswith('-----BEGIN PGP SIGNED MESSAGE-----'):
+        return text
+    (header, body) = text.split('\n\n', 1)
+    body = body.split('\n-----BEGIN PGP SIGNATURE-----', 1)[0]
+    return '\n'.join(line[2:] if line.startswith('- ') else line
+                     for line in body.split('\n'))
+
+
+def _field_lines(text, field):
+    # Yield the words of the value of field, and of each of its
+    # continuation lines
+    in_field = False
+    for line in text.split('\n'):
+        if line.startswith(' ') and in_field:
+            words = line.split()
+            if words:
+                yield words
+        else:
+            (name, sep, value) = line.partition(':')
+            in_field = name == field
+            if in_field and value.split():
+                yield value.split()
+
+
+def _verify(data, checksum, name):
+    if len(data) != checksum[1] or sha256(data).hexdigest() != checksum[0]:
+        raise ValueError('%s does not match its checksum' % name)
+
+
+def _gunzip(data):
+    with gzip.GzipFile(fileobj=StringIO.StringIO(data)) as fd:
+        return fd.read()
@@ -0,0 +1,135 @@
+import errno
+import logging
+import os
+import stat
+
+from util import tree, sha256sum
+
+logger = logging.getLogger('util.blobstore')
+
+# Errors from os.link() meaning that hard links can't be used here
+LINK_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EMLINK)
+
+
+class BlobStore(object):
+    """Files stored by the SHA-256 of their contents.
+
+    Each blob is kept as <path>/<first two hex digits>/<hex digest>, and
+    files elsewhere on the same filesystem (such as the pools) are hard
+    links to it, so identical files are only stored once. A blob that has
+    no other links left is garbage, and is removed by collect().
+
+    Nothing must ever write to a file that is linked into the store, only
+    replace it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def blob_path(self, sha256):
+        """Return the filename of the blob with the given hex digest."""
+        return os.path.join(self.path, sha256[:2], sha256)
+
+    def link(self, sha256, filename):
+        """Make filename a link to the blob with the given digest.
+
+        Return True if that was possible, or False if there is no such
+        blob (or it can't be linked to).
+        """
+        blob = self.blob_path(sha256)
+        try:
+            blob_st = os.stat(blob)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+        if _same_file(blob_st, filename):
+            return True
+
+        tree.ensure(filename)
+        tmpname = '%s.link' % filename
+        try:
+            tree.remove(tmpname)
+            os.link(blob, tmpname)
+        except OSError, e:
+            if e.errno not in LINK_ERRNOS:
+                raise
+            logger.debug('Cannot link %s to %s: %s', filename, blob, e)
+            return False
+        os.rename(tmpname, filename)
+        return True
+
+    def add(self, filename, sha256):
+        """Store the contents of filename, whose digest the caller has
+        already checked, as a blob.
+
+        If there is already a blob with that digest, filename is replaced
+        by a link to it.
+        """
+        blob = self.blob_path(sha256)
+        tree.ensure(blob)
+        try:
+            os.link(filename, blob)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                self.link(sha256, filename)
+            elif e.errno in LINK_ERRNOS:
+                logger.debug('Cannot link %s to %s: %s', blob, filename, e)
+            else:
+                raise
+
+    def release(self, filename, sha256=None):
+        """Remove filename, and also its blob if nothing else links to it.
+
+        If the digest isn't given, it is calculated when needed.
+        """
+        try:
+            st = os.lstat(filename)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+
+        if stat.S_ISREG(st.st_mode) and st.st_nlink == 2:
+            if sha256 is None:
+                sha256 = sha256sum(filename)
+            blob = self.blob_path(sha256)
+            if _same_file(st, blob):
+                logger.debug('Removing blob %s', sha256)
+                os.unlink(blob)
+
+        os.unlink(filename)
+
+    def collect(self):
+        """Remove every blob that nothing else links to.
+
+        Return the number of blobs and bytes that were freed.
+        """
+        count = 0
+        freed = 0
+        if not os.path.isdir(self.path):
+            return (count, freed)
+
+        for subdir in os.listdir(self.path):
+            subdir = os.path.join(self.path, subdir)
+            for sha256 in os.listdir(subdir):
+                blob = os.path.join(subdir, sha256)
+                st = os.lstat(blob)
+                if stat.S_ISREG(st.st_mode) and st.st_nlink == 1:
+                    logger.debug('Removing blob %s', sha256)
+                    os.unlink(blob)
+                    count += 1
+                    freed += st.st_size
+
+        return (count, freed)
+
+
+def _same_file(st, filename):
+    try:
+        other = os.stat(filename)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    return (st.st_dev, st.st_ino) == (other.st_dev, other.st_ino)
@@ -769,19 +769,59 @@ class DebTreeMerger(object):
                              filename)
                 return False
 
-        # Set up temporary copies of base, left and right which we will
-        # use for patch reconstruction
-        tmpdir = mkdtemp(prefix='mom.sbtm_refresh.')
+        # Set up temporary copies of base and left which we will use for
+        # patch reconstruction. They're made next to the merged tree, in
+        # the hope of being on the same filesystem as base and left.
+        tmpdir = mkdtemp(prefix='mom.sbtm_refresh.',
+                         dir=os.path.dirname(self.merged_dir))
         try:
             base_tmp = os.path.join(tmpdir, 'base')
             left_tmp = os.path.join(tmpdir, 'left')
-            shutil.copytree(self.base_dir, base_tmp, symlinks=True)
-            shutil.copytree(self.left_dir, left_tmp, symlinks=True)
+            self.__quilt_copy(self.base_dir, base_tmp)
+            self.__quilt_copy(self.left_dir, left_tmp)
             return self.__sbtm_refresh(patch, patched_files, base_tmp,
                                        left_tmp, merged_tmp)
         finally:
             shutil.rmtree(tmpdir)
 
+    def __quilt_copy(self, src_dir, dest_dir):
+        # Copy src_dir to dest_dir for quilt to push patches in, without
+        # changing src_dir, which belongs to the unpacked source cache.
+        # Files are hardlinked, but for those the quilt series patches,
+        # which get copies of their own.
+        try:
+            tree.copytree(src_dir, dest_dir, link=True)
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                raise
+            tree.remove(dest_dir)
+            tree.copytree(src_dir, dest_dir)
+            return
+
+        series_file = os.path.join(dest_dir, 'debian/patches/series')
+        patches = []
+        if os.path.isfile(series_file):
+            with open(series_file) as series:
+                for line in series:
+                    words = line.split('#', 1)[0].split()
+                    if words:
+                        patches.append('debian/patches/' + words[0])
+        if not patches:
+            return
+
+        try:
+            patched_files = subprocess.check_output(
+                ['lsdiff', '--strip=1'] + patches, cwd=dest_dir)
+        except CalledProcessError:
+            # Without knowing what the patches touch, copy everything
+            logger.debug('Failed to list files patched in %s', src_dir)
+            tree.remove(dest_dir)
+            tree.copytree(src_dir, dest_dir)
+            return
+
+        for filename in set(patched_files.splitlines()):
+            tree.unshare(os.path.join(dest_dir, filename))
+
     def __refresh_quilt_patches(self, tmpdir):
         # Put our downstream-added patches in place. Must be done
         # before we 'quilt push' the preceding patch to avoid quilt being
@@ -1035,23 +1075,33 @@ class DebTreeMerger(object):
         """Merge a changelog file."""
         logger.debug("Knitting %s", filename)
 
-        left_cl = read_changelog("%s/%s" % (self.left_dir, filename))
-        right_cl = read_changelog("%s/%s" % (self.right_dir, filename))
+        left_file = "%s/%s" % (self.left_dir, filename)
+        left_cl = read_changelog(left_file)
+        right_cl = changelog_entries("%s/%s" % (self.right_dir, filename))
         tree.ensure(filename)
 
-        with open("%s/%s" % (self.merged_dir, filename), "w") as output:
+        # Only the versions of the left entries are kept; their text is
+        # copied straight from the file as each is written
+        left_entry = next(left_cl, None)
+        with open(left_file) as left, \
+                open("%s/%s" % (self.merged_dir, filename), "w") as output:
+            def write_left(offset, length):
+                left.seek(offset)
+                print >>output, left.read(length)
+
             for right_ver, right_text in right_cl:
-                while len(left_cl) and left_cl[0][0] > right_ver:
-                    (left_ver, left_text) = left_cl.pop(0)
-                    print >>output, left_text
+                while left_entry is not None and left_entry[0] > right_ver:
+                    write_left(*left_entry[1:])
+                    left_entry = next(left_cl, None)
 
-                while len(left_cl) and left_cl[0][0] == right_ver:
-                    (left_ver, left_text) = left_cl.pop(0)
+                while left_entry is not None and left_entry[0] == right_ver:
+                    left_entry = next(left_cl, None)
 
                 print >>output, right_text
 
-            for left_ver, left_text in left_cl:
-                print >>output, left_text
+            while left_entry is not None:
+                write_left(*left_entry[1:])
+                left_entry = next(left_cl, None)
 
         return False
 
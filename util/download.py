@@ -0,0 +1,400 @@
+from __future__ import with_statement
+
+import contextlib
+import errno
+import hashlib
+import httplib
+import logging
+import os
+import Queue
+import socket
+import sys
+import threading
+import urllib
+import urllib2
+import urlparse
+
+from util import tree
+
+logger = logging.getLogger('util.download')
+
+# Number of files downloaded at once from a mirror that doesn't say
+DEFAULT_JOBS = 4
+
+# Number of seconds to wait for a mirror to accept a connection or send
+# more data before giving up on it
+DEFAULT_TIMEOUT = 60
+
+# Number of bytes read from the network at a time
+CHUNK_SIZE = 256 * 1024
+
+# Number of HTTP redirects followed before giving up
+MAX_REDIRECTS = 5
+
+# Number of times a file that doesn't match its checksum is downloaded
+# before giving up
+VERIFY_ATTEMPTS = 3
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# Files being written by some thread, see _claim()
+_claimed = set()
+_claimed_changed = threading.Condition()
+
+
+class ConnectionPool(object):
+    """Idle HTTP and HTTPS connections, kept open for reuse.
+
+    Connections are keyed by (scheme, netloc). A connection is only
+    returned to the pool once the response to its last request has been
+    read completely and the server has not asked for it to be closed.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (connection, reused) for the given (scheme, netloc)."""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return (idle.pop(), True)
+
+        (scheme, netloc) = key
+        if scheme == 'https':
+            return (httplib.HTTPSConnection(netloc, timeout=self.timeout),
+                    False)
+        return (httplib.HTTPConnection(netloc, timeout=self.timeout), False)
+
+    def put(self, key, conn):
+        """Make conn available to later requests to the same host."""
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+
+class Response(object):
+    """The body of a response being read.
+
+    Closing the response hands its connection back to the pool if the body
+    was read to the end, or closes the connection otherwise, and gives up
+    the Downloader's slot that the response was holding.
+    """
+
+    def __init__(self, url, response, pool=None, key=None, conn=None):
+        self.url = url
+        self._response = response
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._slot = None
+
+    def resumes(self, offset):
+        """Return True if this is the rest of the body from offset on,
+        in answer to a Range request.
+        """
+        if self._conn is None:
+            status = self._response.getcode()
+        else:
+            status = self._response.status
+        if status != 206:
+            return False
+        content_range = self.getheader('Content-Range', '')
+        return content_range.startswith('bytes %d-' % offset)
+
+    def getheader(self, name, default=None):
+        """Return the value of the named response header, or default."""
+        if isinstance(self._response, httplib.HTTPResponse):
+            return self._response.getheader(name, default)
+        return self._response.info().getheader(name, default)
+
+    def read(self, size=-1):
+        try:
+            if size < 0:
+                return self._response.read()
+            return self._response.read(size)
+        except httplib.HTTPException, e:
+            raise IOError('Reading %s failed: %r' % (self.url, e))
+
+    def close(self):
+        try:
+            if self._conn is None:
+                self._response.close()
+            elif self._response.isclosed() and not self._response.will_close:
+                self._pool.put(self._key, self._conn)
+            else:
+                self._conn.close()
+            self._conn = None
+        finally:
+            if self._slot is not None:
+                self._slot.release()
+                self._slot = None
+
+
+class Downloader(object):
+    """Download files, several at a time, reusing connections to each host.
+
+    At most `jobs` responses are open at once, however many threads share
+    the Downloader, so there are never more than that many connections in
+    use to any one server. Only http and https
+    URLs get connection reuse; anything else (such as the file:// mirrors
+    used by the tests), or anything to be fetched through a proxy given
+    by the http_proxy or https_proxy environment variables, is opened with
+    urllib2.
+
+    Connecting, and each read, gives up after `timeout` seconds.
+
+    HTTP errors are raised as urllib2.HTTPError, so callers can check the
+    code as they would for urllib2.urlopen(); other failures raise IOError.
+    """
+
+    def __init__(self, jobs=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT):
+        self.jobs = max(1, int(jobs))
+        self.timeout = timeout
+        self.connections = ConnectionPool(timeout)
+        self.proxies = urllib.getproxies()
+        self._opener = urllib2.build_opener(urllib2.ProxyHandler(self.proxies))
+        self._slots = threading.Semaphore(self.jobs)
+
+    def open(self, url, headers={}):
+        """Request url and return its Response, which must be closed.
+
+        This waits while `jobs` other responses are open.
+        """
+        self._slots.acquire()
+        try:
+            response = self._open(url, headers)
+        except Exception:
+            self._slots.release()
+            raise
+        response._slot = self._slots
+        return response
+
+    def _open(self, url, headers):
+        for i in range(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ('http', 'https') \
+                    or self._proxied(parts):
+                request = urllib2.Request(url, headers=headers)
+                return Response(url, self._opener.open(request,
+                                                       timeout=self.timeout))
+
+            path = parts.path or '/'
+            if parts.query:
+                path = '%s?%s' % (path, parts.query)
+            response = self._request(url, (parts.scheme, parts.netloc), path,
+                                     headers)
+
+            status = response._response.status
+            if status in (200, 206):
+                return response
+
+            location = response._response.getheader('Location')
+            reason = response._response.reason
+            msg = response._response.msg
+            response.read()
+            response.close()
+
+            if status not in REDIRECT_CODES or location is None:
+                raise urllib2.HTTPError(url, status, reason, msg, None)
+            logger.debug('%s redirected to %s', url, location)
+            url = urlparse.urljoin(url, location)
+
+        raise IOError('Too many redirects fetching %s' % url)
+
+    def _proxied(self, parts):
+        """Return True if the split URL is to be fetched through a proxy."""
+        return parts.scheme in self.proxies \
+            and not urllib.proxy_bypass(parts.hostname)
+
+    def _request(self, url, key, path, headers):
+        while True:
+            (conn, reused) = self.connections.get(key)
+            try:
+                conn.request('GET', path, headers=headers)
+                return Response(url, conn.getresponse(), self.connections,
+                                key, conn)
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                # The server may have timed out a kept-alive connection
+                # while it was idle, so go round again on another one
+                if not reused:
+                    raise IOError('Requesting %s failed: %r' % (url, e))
+
+    def read(self, url):
+        """Return the whole body of url as a string."""
+        response = self.open(url)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+    def fetch(self, url, filename, size=None, sha256=None, blobs=None):
+        """Download url into filename.
+
+        The body is streamed into filename.partial, which is only renamed
+        into place once it is complete and matches the expected size and
+        hex SHA-256 digest, if they are given. A download that doesn't
+        match is tried again from scratch, up to VERIFY_ATTEMPTS times in
+        all, before IOError is raised.
+
+        If the download is interrupted, the .partial file is left behind
+        and the next fetch of the same file asks the server for just the
+        rest of it with a Range request.
+
+        If a BlobStore is given, filename is linked to the blob with the
+        expected digest instead if there is one, and otherwise the
+        download is added to it.
+        """
+        if blobs is not None and sha256 is not None \
+                and blobs.link(sha256, filename):
+            logger.debug('Linked %s from the blob store', filename)
+            return
+
+        tree.ensure(filename)
+        partial = '%s.partial' % filename
+
+        with _claim(partial):
+            for attempt in range(1, VERIFY_ATTEMPTS + 1):
+                (length, digest) = self._stream(url, partial)
+
+                if (size is None or length == int(size)) \
+                        and (sha256 is None or digest == sha256):
+                    os.rename(partial, filename)
+                    if blobs is not None:
+                        blobs.add(filename, digest)
+                    return
+
+                _unlink(partial)
+                logger.warning('%s has size %d and SHA-256 %s, expected %s '
+                               'and %s (attempt %d of %d)', url, length,
+                               digest, size, sha256, attempt, VERIFY_ATTEMPTS)
+
+        raise IOError('%s does not match its checksum' % url)
+
+    def _stream(self, url, partial):
+        """Write url into partial, carrying on from wherever an earlier
+        download left off, and return the (size, hex SHA-256) of the
+        whole file.
+        """
+        digest = hashlib.sha256()
+        length = 0
+        if os.path.isfile(partial):
+            with open(partial, 'rb') as fd:
+                while True:
+                    data = fd.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+                    length += len(data)
+
+        if length:
+            logger.debug('Resuming %s from byte %d', url, length)
+            try:
+                response = self.open(url, {'Range': 'bytes=%d-' % length})
+            except urllib2.HTTPError, e:
+                if e.code != 416:
+                    raise
+                # Nothing left to fetch: either the partial file is already
+                # complete or it isn't the file we want, which the caller
+                # will find out when it checks the result
+                return (length, digest.hexdigest())
+
+            if not response.resumes(length):
+                logger.debug('%s cannot be resumed, downloading it all', url)
+                digest = hashlib.sha256()
+                length = 0
+        else:
+            logger.debug('Downloading %s', url)
+            response = self.open(url)
+
+        try:
+            if length:
+                flags = os.O_WRONLY | os.O_APPEND
+            else:
+                flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+            fd = os.open(partial, flags, 0666)
+            with os.fdopen(fd, 'wb') as output:
+                while True:
+                    data = response.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+                    length += len(data)
+                    output.write(data)
+            return (length, digest.hexdigest())
+        finally:
+            response.close()
+
+    def fetch_all(self, downloads, blobs=None):
+        """Download each (url, filename[, size, sha256]) in downloads, up to
+        jobs at a time, as fetch() does.
+
+        If a download fails, those not yet started are abandoned and the
+        first error is raised once the others have finished.
+        """
+        queue = Queue.Queue()
+        for download in downloads:
+            queue.put(download)
+
+        errors = []
+
+        def worker():
+            while not errors:
+                try:
+                    download = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.fetch(*download, blobs=blobs)
+                except Exception, e:
+                    logger.debug('Downloading %s failed: %s', download[0], e)
+                    errors.append(sys.exc_info())
+
+        threads = []
+        for i in range(min(self.jobs, queue.qsize())):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            (exc_type, exc_value, exc_tb) = errors[0]
+            raise exc_type, exc_value, exc_tb
+
+
+@contextlib.contextmanager
+def _claim(filename):
+    """Wait until no other thread is writing to filename, then stop any
+    others from doing so until the block is done.
+    """
+    with _claimed_changed:
+        while filename in _claimed:
+            _claimed_changed.wait()
+        _claimed.add(filename)
+    try:
+        yield
+    finally:
+        with _claimed_changed:
+            _claimed.remove(filename)
+            _claimed_changed.notify_all()
+
+
+def _unlink(filename):
+    try:
+        os.unlink(filename)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
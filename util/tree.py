@@ -138,6 +138,20 @@ def copyfile(srcpath, dstpath, link=False, dereference=False):
         shutil.copy2(srcpath, dstpath)
 
 
+def unshare(path):
+    """Give a hardlinked file a copy of its own.
+
+    Afterwards it can be changed in place without changing the files it
+    was linked to.  Anything else is left alone.
+    """
+    if os.path.islink(path) or not os.path.isfile(path) \
+            or os.stat(path).st_nlink < 2:
+        return
+
+    shutil.copy2(path, path + ".unshare")
+    os.rename(path + ".unshare", path)
+
+
 def movetree(path, newpath, eat_toplevel=False):
     """Move the contents of one tree into another.
 
@@ -216,4 +230,9 @@ def ensure(path):
     """Ensure that the parent directories for path exist."""
     dirname = os.path.dirname(path)
     if not os.path.isdir(dirname):
-        os.makedirs(dirname)
+        try:
+            os.makedirs(dirname)
+        except OSError, e:
+            # Another thread or process may have just created it
+            if e.errno != errno.EEXIST or not os.path.isdir(dirname):
+                raise
@@ -0,0 +1,214 @@
+from __future__ import with_statement
+
+from contextlib import contextmanager
+import errno
+import fcntl
+import json
+import logging
+import os
+import thread
+import threading
+import time
+
+from util import tree
+
+logger = logging.getLogger('util.unpackcache')
+
+
+class UnpackCache(object):
+    """Directories unpacked from source packages, kept under path so that
+    each is only unpacked once however many times it's used.
+
+    Each directory is known by a key, its path relative to path, and is
+    in use from acquire() until the matching release(). Whenever the
+    directories add up to more than budget bytes, the least recently used
+    of those not in use are removed until they fit again. The size and
+    last use of each are kept in path/MANIFEST.json, so that the cache
+    carries on from one process to the next.
+
+    Several processes can share the cache at once. The manifest is only
+    read and changed with path/MANIFEST.lock locked, and records which
+    processes are using each directory, so that none is removed from
+    under another; references held by processes that have gone away are
+    ignored. Directories are unpacked under path/.unpacking and then
+    moved into place, so that none is seen half unpacked.
+    """
+
+    MANIFEST = 'MANIFEST.json'
+    LOCK = 'MANIFEST.lock'
+    UNPACKING = '.unpacking'
+
+    def __init__(self, path, budget):
+        self.path = path
+        self.budget = budget
+        # References held by this process
+        self.refs = {}
+        self._lock = threading.RLock()
+
+    def directory(self, key):
+        return os.path.join(self.path, key)
+
+    def _manifestPath(self):
+        return os.path.join(self.path, self.MANIFEST)
+
+    @contextmanager
+    def _manifest(self):
+        # Lock the manifest against other threads and processes, and
+        # yield its {key: [size, last used, pids using it]}, forgetting
+        # any directories that have gone away behind our back. It's saved
+        # again afterwards.
+        filename = self._manifestPath()
+        with self._lock:
+            tree.ensure(filename)
+            with open(os.path.join(self.path, self.LOCK), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    with open(filename) as fd:
+                        entries = json.load(fd)
+                except (IOError, ValueError):
+                    entries = {}
+                entries = dict((key, (entry + [[]])[:3])
+                               for (key, entry) in entries.iteritems()
+                               if os.path.isdir(self.directory(key)))
+
+                yield entries
+
+                with open(filename + '.tmp', 'w') as fd:
+                    json.dump(entries, fd, sort_keys=True)
+                os.rename(filename + '.tmp', filename)
+
+    def acquire(self, key, create):
+        """Return the directory for key, and hold on to it until release().
+
+        If it isn't in the cache, create(directory) is called to make it.
+        """
+        destdir = self.directory(key)
+        with self._manifest() as entries:
+            if os.path.isdir(destdir):
+                if key not in entries:
+                    # Left from before there was a manifest
+                    entries[key] = [_tree_size(destdir), 0, []]
+                self._addRef(entries, key)
+                return destdir
+
+        # Unpack somewhere private, in case another thread or process is
+        # unpacking the same thing
+        tmpdir = os.path.join(self.path, self.UNPACKING, '%d.%d' %
+                              (os.getpid(), thread.get_ident()))
+        tree.remove(tmpdir)
+        try:
+            create(tmpdir)
+            size = _tree_size(tmpdir)
+
+            with self._manifest() as entries:
+                if os.path.isdir(destdir):
+                    logger.debug('%s was unpacked twice at once', key)
+                    entries.setdefault(key, [size, 0, []])
+                else:
+                    tree.ensure(destdir)
+                    os.rename(tmpdir, destdir)
+                    entries[key] = [size, 0, []]
+                self._addRef(entries, key)
+                self._evict(entries)
+        finally:
+            tree.remove(tmpdir)
+        return destdir
+
+    def _addRef(self, entries, key):
+        self.refs[key] = self.refs.get(key, 0) + 1
+        entries[key][1] = time.time()
+        if os.getpid() not in entries[key][2]:
+            entries[key][2].append(os.getpid())
+
+    def release(self, key, discard=False):
+        """Stop holding on to the directory for key.
+
+        If discard is True the directory is removed, as it must be if it
+        has been changed.
+        """
+        with self._manifest() as entries:
+            refs = self.refs.pop(key, 0) - 1
+            if refs > 0:
+                self.refs[key] = refs
+            elif key in entries and os.getpid() in entries[key][2]:
+                entries[key][2].remove(os.getpid())
+
+            if discard:
+                entries.pop(key, None)
+                self._remove(key)
+            self._evict(entries)
+
+    def trim(self):
+        """Drop every reference this process holds, and remove
+        directories until the cache is within its budget.
+        """
+        with self._manifest() as entries:
+            self.refs.clear()
+            for entry in entries.itervalues():
+                entry[2] = [pid for pid in entry[2]
+                            if pid != os.getpid() and _is_running(pid)]
+            self._evict(entries)
+
+    def size(self):
+        """Return the total size of the directories in the cache."""
+        with self._manifest() as entries:
+            return sum(entry[0] for entry in entries.itervalues())
+
+    def _inUse(self, entry):
+        return any(_is_running(pid) for pid in entry[2])
+
+    def _evict(self, entries):
+        # Remove the least recently used directories not in use until the
+        # cache fits its budget
+        total = sum(entry[0] for entry in entries.itervalues())
+        if total <= self.budget:
+            return
+
+        for key in sorted(entries, key=lambda k: entries[k][1]):
+            if total <= self.budget:
+                break
+            if self._inUse(entries[key]):
+                continue
+            logger.debug('Evicting %s from the unpacked source cache', key)
+            total -= entries.pop(key)[0]
+            self._remove(key)
+
+        if total > self.budget:
+            logger.debug('Unpacked source cache is %d bytes over its '
+                         'budget, but everything left is in use',
+                         total - self.budget)
+
+    def _remove(self, key):
+        # Remove the directory for key, and any parents left empty
+        path = self.directory(key)
+        tree.remove(path)
+        path = os.path.dirname(path)
+        while path != self.path and path.startswith(self.path):
+            try:
+                os.rmdir(path)
+            except OSError, e:
+                if e.errno in (errno.ENOTEMPTY, errno.ENOENT):
+                    break
+                raise
+            path = os.path.dirname(path)
+
+
+def _is_running(pid):
+    # Return whether there's a process with the given pid
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _tree_size(path):
+    # Return the total size of the files under path
+    size = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return size